@@ -0,0 +1,112 @@
+# gemato: Changed file list parsing
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import re
+
+
+# YXcstpoguax (rsync 3.1+) or YXcstpogz (older versions)
+RSYNC_ITEMIZE_RE = re.compile(r'^([<>ch.*])([fdLDS])([^ ]{7,9}) (.+)$')
+RSYNC_DELETING_PREFIX = '*deleting '
+GIT_NAME_STATUS_RE = re.compile(r'^([ACDMRTUX])([0-9]*)\t(.+)$')
+
+
+def parse_git_name_status(lines):
+    """
+    Parse the output of 'git diff --name-status' (or 'git log
+    --name-status --format=') in @lines. Returns a list of all paths
+    that were changed, including both old and new paths of renamed
+    files.
+
+    Raises ValueError if the input is invalid.
+    """
+
+    ret = []
+    for l in lines:
+        l = l.rstrip('\n')
+        if not l:
+            continue
+        m = GIT_NAME_STATUS_RE.match(l)
+        if m is None:
+            raise ValueError('Invalid git --name-status line: {}'.format(l))
+        status, score, paths = m.groups()
+        paths = paths.split('\t')
+        if status in ('R', 'C'):
+            if len(paths) != 2:
+                raise ValueError('Invalid git --name-status line: {}'
+                        .format(l))
+            # copy source is not changed
+            if status == 'C':
+                paths = paths[1:]
+        elif len(paths) != 1:
+            raise ValueError('Invalid git --name-status line: {}'.format(l))
+        ret.extend(paths)
+    return ret
+
+
+def parse_rsync_itemize_changes(lines):
+    """
+    Parse the output of 'rsync --itemize-changes' in @lines. Returns
+    a list of all paths that were transferred, created or deleted.
+    Files whose attributes changed only, and directories that were
+    not created or deleted are skipped. Other lines (e.g. verbose
+    rsync output) are ignored.
+    """
+
+    ret = []
+    for l in lines:
+        l = l.rstrip('\n')
+        if l.startswith(RSYNC_DELETING_PREFIX):
+            ret.append(l[len(RSYNC_DELETING_PREFIX):].lstrip(' ')
+                    .rstrip('/'))
+            continue
+        m = RSYNC_ITEMIZE_RE.match(l)
+        if m is None:
+            continue
+        update_type, file_type, attrs, path = m.groups()
+        if file_type == 'd':
+            if attrs.startswith('+'):
+                ret.append(path.rstrip('/'))
+        elif update_type != '.':
+            # hardlinks and symlinks have ' -> target' suffix
+            if update_type == 'h' or file_type == 'L':
+                path = path.split(' => ', 1)[0].split(' -> ', 1)[0]
+            ret.append(path)
+    return ret
+
+
+def parse_path_list(lines):
+    """
+    Parse a plain list of paths in @lines, one path per line.
+    """
+
+    ret = []
+    for l in lines:
+        l = l.rstrip('\n')
+        if l:
+            ret.append(l)
+    return ret
+
+
+def parse_changed_files(f):
+    """
+    Parse the list of changed files from open text file @f. The format
+    is detected from the first non-empty line: the output of 'git
+    diff --name-status', 'rsync --itemize-changes' or a plain list
+    of paths is supported. Returns a list of paths.
+
+    Raises ValueError if the input is invalid.
+    """
+
+    lines = f.readlines()
+    for l in lines:
+        if not l.strip():
+            continue
+        if GIT_NAME_STATUS_RE.match(l.rstrip('\n')):
+            return parse_git_name_status(lines)
+        if (l.startswith(RSYNC_DELETING_PREFIX)
+                or RSYNC_ITEMIZE_RE.match(l.rstrip('\n'))):
+            return parse_rsync_itemize_changes(lines)
+        break
+    return parse_path_list(lines)
@@ -6,15 +6,32 @@
 from __future__ import print_function
 
 import argparse
+import collections
 import datetime
 import io
 import logging
+import multiprocessing.pool
 import os.path
+import shutil
+import signal
+import sys
+import tarfile
+import tempfile
 import timeit
 
+import gemato.changelist
+import gemato.compression
+import gemato.exceptions
 import gemato.find_top_level
 import gemato.profile
+import gemato.ratelimit
 import gemato.recursiveloader
+import gemato.sampling
+import gemato.serve
+import gemato.state
+import gemato.tarball
+import gemato.util
+import gemato.verify
 
 
 def verify_failure(e):
@@ -22,26 +39,260 @@ def verify_failure(e):
     return False
 
 
+def set_process_priority(args):
+    if args.nice is not None:
+        os.nice(args.nice)
+    if args.ionice is not None:
+        try:
+            gemato.ratelimit.set_io_priority(*args.ionice)
+        except OSError as e:
+            logging.warning('Unable to set I/O priority: {}'.format(e))
+
+
+def get_openpgp_env(args):
+    """
+    Get the OpenPGPEnvironment with the key(s) from --openpgp-key
+    imported (if specified). If --openpgp-keyring-cache is specified,
+    the keyring is reused across invocations.
+    """
+
+    if args.openpgp_key is None:
+        return gemato.openpgp.OpenPGPEnvironment()
+    with io.open(args.openpgp_key, 'rb') as f:
+        if args.openpgp_keyring_cache is not None:
+            return gemato.openpgp.open_cached_environment(f,
+                    args.openpgp_keyring_cache)
+        env = gemato.openpgp.OpenPGPEnvironment()
+        try:
+            env.import_key(f)
+        except:
+            env.close()
+            raise
+        return env
+
+
+def get_hash_policy(args):
+    if args.verify_hashes is None and not args.fastest_hash:
+        return None
+    allowed = None
+    if args.verify_hashes is not None:
+        allowed = args.verify_hashes.split()
+    return gemato.verify.HashPolicy(allowed=allowed,
+            fastest=args.fastest_hash)
+
+
+def get_write_kwargs(args, argp):
+    """
+    Validate the Manifest writing options common to update and create.
+    Returns a tuple of keyword arguments for ManifestRecursiveLoader
+    and for save_manifests().
+    """
+
+    init_kwargs = {}
+    save_kwargs = {}
+    if args.hashes is not None:
+        init_kwargs['hashes'] = args.hashes.split()
+    if args.compress_watermark is not None:
+        if args.compress_watermark < 0:
+            argp.error('--compress-watermark must not be negative!')
+        init_kwargs['compress_watermark'] = args.compress_watermark
+    if args.compress_format is not None:
+        init_kwargs['compress_format'] = args.compress_format
+    if args.compress_level is not None:
+        compress_format = args.compress_format or 'gz'
+        try:
+            lo, hi = gemato.compression.get_compression_level_range(
+                    compress_format)
+        except gemato.exceptions.UnsupportedCompression as e:
+            argp.error(str(e))
+        if not lo <= args.compress_level <= hi:
+            argp.error('--compress-level must be in range {}..{} for {}!'
+                    .format(lo, hi, compress_format))
+        init_kwargs['compress_level'] = args.compress_level
+    if args.jobs is not None:
+        if args.jobs <= 0:
+            argp.error('--jobs must be positive!')
+        save_kwargs['jobs'] = args.jobs
+    if args.force_rewrite:
+        save_kwargs['force'] = True
+    if args.openpgp_id is not None:
+        init_kwargs['openpgp_keyid'] = args.openpgp_id
+    if args.profile is not None:
+        init_kwargs['profile'] = gemato.profile.get_profile_by_name(
+                args.profile)
+    if args.sign is not None:
+        init_kwargs['sign_openpgp'] = args.sign
+    return (init_kwargs, save_kwargs)
+
+
+def do_verify_tarball(args, argp):
+    if args.paths != ['.']:
+        argp.error('--from-tar can not be used along with paths!')
+    if args.state_file is not None:
+        argp.error('--from-tar can not be used along with --state-file!')
+    if args.checkpoint is not None:
+        argp.error('--from-tar can not be used along with --checkpoint!')
+    if args.sample is not None:
+        argp.error('--from-tar can not be used along with --sample!')
+    if args.level != 'full':
+        argp.error('--from-tar can not be used along with --level!')
+    if args.verify_hashes is not None or args.fastest_hash:
+        argp.error('--from-tar can not be used along with --verify-hashes or --fastest-hash!')
+    if args.max_rate is not None or args.max_file_rate is not None:
+        argp.error('--from-tar can not be used along with --max-rate or --max-file-rate!')
+
+    set_process_priority(args)
+    init_kwargs = {}
+    kwargs = {}
+    if args.keep_going:
+        kwargs['fail_handler'] = verify_failure
+    if not args.openpgp_verify:
+        init_kwargs['verify_openpgp'] = False
+    with get_openpgp_env(args) as env:
+        if args.openpgp_key is not None:
+            init_kwargs['openpgp_env'] = env
+
+        start = timeit.default_timer()
+        try:
+            m = gemato.tarball.TarballManifestLoader(args.from_tar,
+                    **init_kwargs)
+        except gemato.exceptions.OpenPGPNoImplementation as e:
+            logging.error(str(e))
+            return 1
+        except gemato.exceptions.OpenPGPVerificationFailure as e:
+            logging.error(str(e))
+            return 1
+        except gemato.exceptions.ManifestMismatch as e:
+            logging.error(str(e))
+            return 1
+        except (gemato.exceptions.ManifestSyntaxError,
+                gemato.exceptions.UnsupportedCompression,
+                gemato.exceptions.UnsupportedHash,
+                gemato.exceptions.UnsupportedTarballMember) as e:
+            logging.error(str(e))
+            return 1
+        except (IOError, ValueError, tarfile.TarError) as e:
+            logging.error(str(e))
+            return 1
+        if args.require_signed_manifest and not m.openpgp_signed:
+            logging.error('Top-level Manifest in {} is not OpenPGP signed'
+                    .format(args.from_tar))
+            return 1
+
+        try:
+            ret = m.assert_directory_verifies(**kwargs)
+        except gemato.exceptions.ManifestIncompatibleEntry as e:
+            logging.error(str(e))
+            return 1
+        except gemato.exceptions.ManifestMismatch as e:
+            logging.error(str(e))
+            return 1
+
+        stop = timeit.default_timer()
+        logging.info('{} validated in {:.2f} seconds'.format(args.from_tar, stop - start))
+    return 0 if ret else 1
+
+
 def do_verify(args, argp):
     ret = True
 
-    for p in args.paths:
-        tlm = gemato.find_top_level.find_top_level_manifest(p)
+    if args.from_tar is not None:
+        return do_verify_tarball(args, argp)
+    if args.max_file_rate is not None and args.max_file_rate <= 0:
+        argp.error('--max-file-rate must be positive!')
+    if args.checkpoint is not None:
+        if args.state_file is not None:
+            argp.error('--checkpoint can not be used along with --state-file!')
+        if len(args.paths) != 1:
+            argp.error('--checkpoint can be used with a single path only!')
+        if args.time_budget is not None and args.time_budget <= 0:
+            argp.error('--time-budget must be positive!')
+    elif args.time_budget is not None or args.byte_budget is not None:
+        argp.error('--time-budget and --byte-budget require --checkpoint!')
+    if args.sample is not None:
+        if not 0 < args.sample <= 1:
+            argp.error('--sample must be in (0, 1] range!')
+        if args.state_file is not None or args.checkpoint is not None:
+            argp.error('--sample can not be used along with --state-file or --checkpoint!')
+    if args.level == 'stat':
+        if args.sample is not None:
+            argp.error('--level=stat can not be used along with --sample!')
+        if args.state_file is not None:
+            argp.error('--level=stat can not be used along with --state-file!')
+
+    set_process_priority(args)
+    rate_limiter = None
+    if args.max_rate is not None or args.max_file_rate is not None:
+        rate_limiter = gemato.ratelimit.RateLimiter(
+                bytes_per_second=args.max_rate,
+                files_per_second=args.max_file_rate)
+    state = None
+    if args.state_file is not None:
+        state = gemato.state.VerificationState(args.state_file)
+    hash_policy = get_hash_policy(args)
+    openpgp_cache = None
+    if args.openpgp_cache is not None:
+        if args.openpgp_cache_ttl <= 0:
+            argp.error('--openpgp-cache-ttl must be positive!')
+        openpgp_cache = gemato.state.SignatureCache(args.openpgp_cache,
+                ttl=args.openpgp_cache_ttl)
+    jobs = args.jobs
+    if jobs is None:
+        jobs = 1
+    elif jobs <= 0:
+        argp.error('--jobs must be positive!')
+    elif (jobs > 1 and (state is not None or args.checkpoint is not None
+            or rate_limiter is not None)):
+        argp.error('--jobs can not be used along with --state-file, --checkpoint, --max-rate or --max-file-rate!')
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = gemato.state.VerificationCheckpoint(args.checkpoint,
+                time_budget=args.time_budget,
+                byte_budget=args.byte_budget)
+
+    # group the paths by top-level Manifest, to load every tree once
+    trees = collections.OrderedDict()
+    tlms = gemato.find_top_level.find_top_level_manifests(args.paths)
+    for p, tlm in zip(args.paths, tlms):
         if tlm is None:
             logging.error('Top-level Manifest not found in {}'.format(p))
             return 1
-
-        init_kwargs = {}
-        kwargs = {}
-        if args.keep_going:
-            kwargs['fail_handler'] = verify_failure
-        if not args.openpgp_verify:
-            init_kwargs['verify_openpgp'] = False
-        with gemato.openpgp.OpenPGPEnvironment() as env:
-            if args.openpgp_key is not None:
-                with io.open(args.openpgp_key, 'rb') as f:
-                    env.import_key(f)
-                init_kwargs['openpgp_env'] = env
+        relpath = os.path.relpath(p, os.path.dirname(tlm))
+        if relpath == '.':
+            relpath = ''
+        tlm, paths = trees.setdefault(os.path.realpath(tlm), (tlm, []))
+        paths.append((p, relpath))
+
+    kwargs = {}
+    if args.keep_going:
+        kwargs['fail_handler'] = verify_failure
+    if rate_limiter is not None:
+        kwargs['rate_limiter'] = rate_limiter
+    if state is not None:
+        kwargs['state'] = state
+    if checkpoint is not None:
+        kwargs['checkpoint'] = checkpoint
+    if args.level == 'stat':
+        kwargs['stat_only'] = True
+    if hash_policy is not None:
+        kwargs['hash_policy'] = hash_policy
+    init_kwargs = {}
+    if not args.openpgp_verify:
+        init_kwargs['verify_openpgp'] = False
+    if openpgp_cache is not None:
+        init_kwargs['openpgp_cache'] = openpgp_cache
+
+    with get_openpgp_env(args) as env:
+        if args.openpgp_key is not None:
+            init_kwargs['openpgp_env'] = env
+
+        for tlm, paths in trees.values():
+            # skip duplicate paths and paths inside other requested paths
+            relpaths = frozenset(relpath for p, relpath in paths)
+            paths = list(collections.OrderedDict(
+                (relpath, p) for p, relpath in paths
+                if not any(gemato.util.path_inside_dir(relpath, x)
+                           for x in relpaths)).items())
 
             start = timeit.default_timer()
             try:
@@ -52,15 +303,46 @@ def do_verify(args, argp):
             except gemato.exceptions.OpenPGPVerificationFailure as e:
                 logging.error(str(e))
                 return 1
+            if openpgp_cache is not None:
+                openpgp_cache.save()
             if args.require_signed_manifest and not m.openpgp_signed:
                 logging.error('Top-level Manifest {} is not OpenPGP signed'.format(tlm))
                 return 1
 
-            relpath = os.path.relpath(p, os.path.dirname(tlm))
-            if relpath == '.':
-                relpath = ''
+            def verify_one(path):
+                relpath, p = path
+                path_kwargs = dict(kwargs)
+                sampler = None
+                if args.sample is not None:
+                    sampler = gemato.sampling.VerificationSampler(args.sample)
+                    path_kwargs['sampler'] = sampler
+                path_start = timeit.default_timer()
+                ret = m.assert_directory_verifies(relpath, **path_kwargs)
+                stop = timeit.default_timer()
+                if checkpoint is not None and not checkpoint.complete:
+                    logging.info('{} verification interrupted after {:.2f} seconds, checkpoint saved to {}'
+                            .format(p, stop - path_start, args.checkpoint))
+                elif sampler is not None:
+                    logging.info('{} sampled: {} of {} files ({} of {} bytes, {:.1f}%) hashed'
+                            .format(p, sampler.files_hashed, sampler.files_total,
+                                sampler.bytes_hashed, sampler.bytes_total,
+                                100 * sampler.coverage))
+                return ret
+
+            pool = None
             try:
-                ret &= m.assert_directory_verifies(relpath, **kwargs)
+                if jobs > 1 and len(paths) > 1:
+                    # load the shared Manifests once, before verifying
+                    # the paths in parallel
+                    for relpath, p in paths:
+                        m.load_manifests_for_path(relpath, recursive=True)
+                    pool = multiprocessing.pool.ThreadPool(
+                            min(jobs, len(paths)))
+                    results = pool.imap(verify_one, paths)
+                else:
+                    results = (verify_one(x) for x in paths)
+                for pret in results:
+                    ret &= pret
             except gemato.exceptions.ManifestCrossDevice as e:
                 logging.error(str(e))
                 return 1
@@ -70,43 +352,123 @@ def do_verify(args, argp):
             except gemato.exceptions.ManifestMismatch as e:
                 logging.error(str(e))
                 return 1
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+                if state is not None:
+                    state.save()
+                if checkpoint is not None:
+                    checkpoint.save()
 
             stop = timeit.default_timer()
-            logging.info('{} validated in {:.2f} seconds'.format(p, stop - start))
+            if checkpoint is not None and not checkpoint.complete:
+                continue
+            logging.info('{} validated in {:.2f} seconds'.format(
+                ', '.join(p for relpath, p in paths), stop - start))
+    return 0 if ret else 1
+
+
+def do_verify_distfiles(args, argp):
+    if args.jobs is not None and args.jobs <= 0:
+        argp.error('--jobs must be positive!')
+
+    tlm = gemato.find_top_level.find_top_level_manifest(args.repo)
+    if tlm is None:
+        logging.error('Top-level Manifest not found in {}'.format(args.repo))
+        return 1
+
+    set_process_priority(args)
+    init_kwargs = {}
+    kwargs = {
+        'jobs': args.jobs,
+        'check_missing': not args.ignore_missing,
+        'check_unknown': not args.ignore_unknown,
+    }
+    if args.keep_going:
+        kwargs['fail_handler'] = verify_failure
+    if args.max_rate is not None:
+        kwargs['rate_limiter'] = gemato.ratelimit.RateLimiter(
+                bytes_per_second=args.max_rate)
+    hash_policy = get_hash_policy(args)
+    if hash_policy is not None:
+        kwargs['hash_policy'] = hash_policy
+    state = None
+    if args.state_file is not None:
+        state = gemato.state.VerificationState(args.state_file)
+        kwargs['state'] = state
+    if not args.openpgp_verify:
+        init_kwargs['verify_openpgp'] = False
+    with get_openpgp_env(args) as env:
+        if args.openpgp_key is not None:
+            init_kwargs['openpgp_env'] = env
+
+        start = timeit.default_timer()
+        try:
+            m = gemato.recursiveloader.ManifestRecursiveLoader(tlm, **init_kwargs)
+        except gemato.exceptions.OpenPGPNoImplementation as e:
+            logging.error(str(e))
+            return 1
+        except gemato.exceptions.OpenPGPVerificationFailure as e:
+            logging.error(str(e))
+            return 1
+        if args.require_signed_manifest and not m.openpgp_signed:
+            logging.error('Top-level Manifest {} is not OpenPGP signed'.format(tlm))
+            return 1
+
+        try:
+            ret = m.verify_distfiles(args.distdir, **kwargs)
+        except gemato.exceptions.ManifestIncompatibleEntry as e:
+            logging.error(str(e))
+            return 1
+        except gemato.exceptions.ManifestMismatch as e:
+            logging.error(str(e))
+            return 1
+        except OSError as e:
+            logging.error(str(e))
+            return 1
+        finally:
+            if state is not None:
+                state.save()
+
+        stop = timeit.default_timer()
+        logging.info('{} validated in {:.2f} seconds'.format(args.distdir, stop - start))
     return 0 if ret else 1
 
 
 def do_update(args, argp):
-    for p in args.paths:
-        tlm = gemato.find_top_level.find_top_level_manifest(p)
-        if tlm is None:
-            logging.error('Top-level Manifest not found in {}'.format(p))
+    changed_files = None
+    if args.changed_files is not None:
+        if args.incremental:
+            argp.error('--changed-files can not be used with --incremental')
+        try:
+            if args.changed_files == '-':
+                changed_files = gemato.changelist.parse_changed_files(
+                        sys.stdin)
+            else:
+                with io.open(args.changed_files, 'r',
+                        encoding='utf8') as f:
+                    changed_files = gemato.changelist.parse_changed_files(f)
+        except ValueError as e:
+            logging.error(str(e))
             return 1
 
-        init_kwargs = {}
-        save_kwargs = {}
-        update_kwargs = {}
-        if args.hashes is not None:
-            init_kwargs['hashes'] = args.hashes.split()
-        if args.compress_watermark is not None:
-            if args.compress_watermark < 0:
-                argp.error('--compress-watermark must not be negative!')
-            init_kwargs['compress_watermark'] = args.compress_watermark
-        if args.compress_format is not None:
-            init_kwargs['compress_format'] = args.compress_format
-        if args.force_rewrite:
-            save_kwargs['force'] = True
-        if args.openpgp_id is not None:
-            init_kwargs['openpgp_keyid'] = args.openpgp_id
-        if args.profile is not None:
-            init_kwargs['profile'] = gemato.profile.get_profile_by_name(
-                    args.profile)
-        if args.sign is not None:
-            init_kwargs['sign_openpgp'] = args.sign
-        with gemato.openpgp.OpenPGPEnvironment() as env:
+    dir_state = None
+    if args.dir_state is not None:
+        if changed_files is not None:
+            argp.error('--dir-state can not be used with --changed-files')
+        dir_state = gemato.state.DirectoryMtimeState(args.dir_state)
+
+    with get_openpgp_env(args) as env:
+        for p in args.paths:
+            tlm = gemato.find_top_level.find_top_level_manifest(p)
+            if tlm is None:
+                logging.error('Top-level Manifest not found in {}'.format(p))
+                return 1
+
+            init_kwargs, save_kwargs = get_write_kwargs(args, argp)
+            update_kwargs = {}
             if args.openpgp_key is not None:
-                with io.open(args.openpgp_key, 'rb') as f:
-                    env.import_key(f)
                 init_kwargs['openpgp_env'] = env
 
             start = timeit.default_timer()
@@ -139,7 +501,12 @@ def do_update(args, argp):
 
             try:
                 start_ts = datetime.datetime.utcnow()
-                m.update_entries_for_directory(relpath, **update_kwargs)
+                if changed_files is not None:
+                    m.update_entries_for_paths(
+                            [os.path.join(relpath, x) for x in changed_files])
+                else:
+                    m.update_entries_for_directory(relpath,
+                            dir_state=dir_state, **update_kwargs)
 
                 # write TIMESTAMP if requested, or if already there
                 if relpath != '':
@@ -153,6 +520,8 @@ def do_update(args, argp):
                         ts.ts = start_ts
 
                 m.save_manifests(**save_kwargs)
+                if dir_state is not None:
+                    dir_state.save()
             except gemato.exceptions.ManifestCrossDevice as e:
                 logging.error(str(e))
                 return 1
@@ -165,32 +534,111 @@ def do_update(args, argp):
     return 0
 
 
+def do_create_tarball(args, argp):
+    if args.output_tar is not None:
+        if args.paths != ['Manifest']:
+            argp.error('--output-tar can not be used along with paths!')
+    elif len(args.paths) != 1 or args.paths == ['Manifest']:
+        argp.error('--from-tar requires either a single output directory or --output-tar!')
+
+    init_kwargs, save_kwargs = get_write_kwargs(args, argp)
+    init_kwargs['allow_create'] = True
+
+    if args.output_tar is not None:
+        outdir = tempfile.mkdtemp()
+    else:
+        outdir = args.paths[0]
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        elif os.path.exists(os.path.join(outdir, 'Manifest')):
+            logging.error('Manifest already exists in {}'.format(outdir))
+            return 1
+
+    try:
+        with get_openpgp_env(args) as env:
+            if args.openpgp_key is not None:
+                init_kwargs['openpgp_env'] = env
+
+            start = timeit.default_timer()
+            try:
+                m = gemato.recursiveloader.ManifestRecursiveLoader(
+                        os.path.join(outdir, 'Manifest'), **init_kwargs)
+            except gemato.exceptions.OpenPGPNoImplementation as e:
+                logging.error(str(e))
+                return 1
+            except gemato.exceptions.OpenPGPVerificationFailure as e:
+                logging.error(str(e))
+                return 1
+
+            # if not specified by user, profile must set it
+            if m.hashes is None:
+                argp.error('--hashes must be specified if not implied by --profile')
+
+            out = None
+            outf = None
+            tmp_path = None
+            try:
+                if args.output_tar is not None:
+                    # write to a temporary file, and replace the target
+                    # only when the whole tarball was written
+                    fd, tmp_path = gemato.util.create_temporary_file(
+                            os.path.abspath(args.output_tar))
+                    outf = io.open(fd, 'wb')
+                    out = tarfile.open(args.output_tar,
+                            gemato.tarball.get_tarball_write_mode(
+                                args.output_tar),
+                            fileobj=outf)
+                start_ts = datetime.datetime.utcnow()
+                members = gemato.tarball.TarballMembers(args.from_tar,
+                        hashes=m.hashes, out=out)
+                prefix = members.find_common_prefix()
+                gemato.tarball.update_entries_from_members(m, members,
+                        prefix)
+
+                if args.timestamp:
+                    m.set_timestamp(start_ts)
+
+                m.save_manifests(**save_kwargs)
+                if out is not None:
+                    gemato.tarball.add_manifests_to_tarball(m, out, prefix,
+                            members)
+                    out.close()
+                    outf.close()
+                    os.rename(tmp_path, args.output_tar)
+                    tmp_path = None
+            except gemato.exceptions.ManifestInvalidPath as e:
+                logging.error(str(e))
+                return 1
+            except (IOError, OSError, tarfile.TarError) as e:
+                logging.error(str(e))
+                return 1
+            finally:
+                if out is not None:
+                    out.close()
+                if outf is not None:
+                    outf.close()
+                if tmp_path is not None:
+                    os.unlink(tmp_path)
+
+            stop = timeit.default_timer()
+            logging.info('{} processed in {:.2f} seconds'.format(args.from_tar, stop - start))
+    finally:
+        if args.output_tar is not None:
+            shutil.rmtree(outdir)
+    return 0
+
+
 def do_create(args, argp):
-    for p in args.paths:
-        init_kwargs = {}
-        save_kwargs = {}
-        init_kwargs['allow_create'] = True
-        if args.hashes is not None:
-            init_kwargs['hashes'] = args.hashes.split()
-        if args.compress_watermark is not None:
-            if args.compress_watermark < 0:
-                argp.error('--compress-watermark must not be negative!')
-            init_kwargs['compress_watermark'] = args.compress_watermark
-        if args.compress_format is not None:
-            init_kwargs['compress_format'] = args.compress_format
-        if args.force_rewrite:
-            save_kwargs['force'] = True
-        if args.openpgp_id is not None:
-            init_kwargs['openpgp_keyid'] = args.openpgp_id
-        if args.profile is not None:
-            init_kwargs['profile'] = gemato.profile.get_profile_by_name(
-                    args.profile)
-        if args.sign is not None:
-            init_kwargs['sign_openpgp'] = args.sign
-        with gemato.openpgp.OpenPGPEnvironment() as env:
+    if args.from_tar is not None:
+        return do_create_tarball(args, argp)
+    elif args.output_tar is not None:
+        argp.error('--output-tar requires --from-tar!')
+
+    with get_openpgp_env(args) as env:
+        for p in args.paths:
+            init_kwargs, save_kwargs = get_write_kwargs(args, argp)
+            init_kwargs['allow_create'] = True
             if args.openpgp_key is not None:
-                with io.open(args.openpgp_key, 'rb') as f:
-                    env.import_key(f)
                 init_kwargs['openpgp_env'] = env
 
             start = timeit.default_timer()
@@ -229,6 +677,51 @@ def do_create(args, argp):
     return 0
 
 
+def do_serve(args, argp):
+    tlm = gemato.find_top_level.find_top_level_manifest(args.path)
+    if tlm is None:
+        logging.error('Top-level Manifest not found in {}'.format(args.path))
+        return 1
+
+    set_process_priority(args)
+    init_kwargs = {}
+    if not args.openpgp_verify:
+        init_kwargs['verify_openpgp'] = False
+    with get_openpgp_env(args) as env:
+        if args.openpgp_key is not None:
+            init_kwargs['openpgp_env'] = env
+
+        server = gemato.serve.VerificationServer(tlm, args.socket,
+                **init_kwargs)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: server.stop())
+        try:
+            server.serve_forever()
+        except (IOError, OSError) as e:
+            logging.error(str(e))
+            return 1
+    return 0
+
+
+def do_query(args, argp):
+    ret = True
+    for p in args.paths:
+        try:
+            status, fails = gemato.serve.query(args.socket,
+                    'status' if args.no_wait else 'verify', p)
+        except (IOError, OSError) as e:
+            logging.error('Unable to query server: {}'.format(e))
+            return 1
+        if status == 'PENDING':
+            logging.error('{} is not verified yet'.format(p))
+        elif status.startswith('ERROR'):
+            logging.error(status[6:])
+        for f in fails:
+            logging.error('Verification failed: {}'.format(f))
+        ret &= status == 'OK'
+    return 0 if ret else 1
+
+
 def main(argv):
     argp = argparse.ArgumentParser(
             prog=argv[0],
@@ -239,17 +732,117 @@ def main(argv):
             help='Verify one or more directories against Manifests')
     verify.add_argument('paths', nargs='*', default=['.'],
             help='Paths to verify (defaults to "." if none specified)')
+    verify.add_argument('--from-tar',
+            help='Verify the Manifest tree inside the specified tarball (e.g. a snapshot), without extracting it')
+    verify.add_argument('-j', '--jobs', type=int,
+            help='Number of paths in the same Manifest tree to verify in parallel (defaults to 1)')
     verify.add_argument('-k', '--keep-going', action='store_true',
             help='Continue reporting errors rather than terminating on the first failure')
+    verify.add_argument('--fastest-hash', action='store_true',
+            help='Verify only the hash with the highest throughput on this host (out of --verify-hashes, if specified)')
+    verify.add_argument('--ionice', type=gemato.ratelimit.parse_ionice,
+            help='Set process I/O priority ("idle", "best-effort[:level]")')
+    verify.add_argument('--level', choices=('stat', 'full'), default='full',
+            help='Verification level: "stat" verifies only the existence, type and size of files without opening them, "full" (the default) verifies the checksums as well')
+    verify.add_argument('--max-file-rate', type=float,
+            help='Limit the number of files read per second')
+    verify.add_argument('--max-rate', type=gemato.ratelimit.parse_size,
+            help='Limit the number of bytes read per second (e.g. "20M")')
+    verify.add_argument('--nice', type=int,
+            help='Increase process CPU niceness by the specified value')
     verify.add_argument('-K', '--openpgp-key',
             help='Use only the OpenPGP key(s) from a specific file')
+    verify.add_argument('--openpgp-keyring-cache',
+            help='Keep the keyring for --openpgp-key in a subdirectory of the specified directory, and reuse it if the key file did not change')
+    verify.add_argument('--openpgp-cache',
+            help='Cache successful OpenPGP signature verifications in the specified file (used only with --openpgp-key)')
+    verify.add_argument('--openpgp-cache-ttl', type=int, default=3600,
+            help='Time after which the cached OpenPGP verification results expire, in seconds (default: 3600)')
     verify.add_argument('-P', '--no-openpgp-verify', action='store_false',
             dest='openpgp_verify',
             help='Disable OpenPGP verification of signed Manifests')
     verify.add_argument('-s', '--require-signed-manifest', action='store_true',
             help='Require that the top-level Manifest is OpenPGP signed')
+    verify.add_argument('--state-file',
+            help='Store verification state in the specified file, and skip hashing files that did not change since they were last verified')
+    verify.add_argument('--checkpoint',
+            help='Resume the verification from the checkpoint in the specified file, and store a new checkpoint there when the budget runs out')
+    verify.add_argument('--time-budget', type=float,
+            help='Stop the verification after the specified number of seconds (requires --checkpoint)')
+    verify.add_argument('--byte-budget', type=gemato.ratelimit.parse_size,
+            help='Stop the verification after hashing the specified number of bytes (e.g. "10G", requires --checkpoint)')
+    verify.add_argument('--sample', type=float,
+            help='Hash only a random sample of the specified fraction of files (e.g. "0.05"), verifying only the size of the remaining files')
+    verify.add_argument('--verify-hashes',
+            help='Whitespace-separated list of hashes to verify, if present in the entry (other hashes are verified only if the entry has none of them)')
     verify.set_defaults(func=do_verify)
 
+    verify_distfiles = subp.add_parser('verify-distfiles',
+            help='Verify the distfiles in a directory against DIST entries in a Manifest tree')
+    verify_distfiles.add_argument('distdir',
+            help='Path to the distfiles directory')
+    verify_distfiles.add_argument('repo', nargs='?', default='.',
+            help='Path to the Manifest tree (defaults to ".")')
+    verify_distfiles.add_argument('-j', '--jobs', type=int,
+            help='Number of files to hash in parallel (defaults to the number of CPUs)')
+    verify_distfiles.add_argument('-k', '--keep-going', action='store_true',
+            help='Continue reporting errors rather than terminating on the first failure')
+    verify_distfiles.add_argument('--ignore-missing', action='store_true',
+            help='Do not report distfiles that are not present in the directory')
+    verify_distfiles.add_argument('--ignore-unknown', action='store_true',
+            help='Do not report files that have no DIST entries')
+    verify_distfiles.add_argument('--fastest-hash', action='store_true',
+            help='Verify only the hash with the highest throughput on this host (out of --verify-hashes, if specified)')
+    verify_distfiles.add_argument('--ionice', type=gemato.ratelimit.parse_ionice,
+            help='Set process I/O priority ("idle", "best-effort[:level]")')
+    verify_distfiles.add_argument('--max-rate', type=gemato.ratelimit.parse_size,
+            help='Limit the number of bytes read per second (e.g. "20M")')
+    verify_distfiles.add_argument('--nice', type=int,
+            help='Increase process CPU niceness by the specified value')
+    verify_distfiles.add_argument('-K', '--openpgp-key',
+            help='Use only the OpenPGP key(s) from a specific file')
+    verify_distfiles.add_argument('--openpgp-keyring-cache',
+            help='Keep the keyring for --openpgp-key in a subdirectory of the specified directory, and reuse it if the key file did not change')
+    verify_distfiles.add_argument('-P', '--no-openpgp-verify', action='store_false',
+            dest='openpgp_verify',
+            help='Disable OpenPGP verification of signed Manifests')
+    verify_distfiles.add_argument('-s', '--require-signed-manifest', action='store_true',
+            help='Require that the top-level Manifest is OpenPGP signed')
+    verify_distfiles.add_argument('--state-file',
+            help='Store verification state in the specified file, and skip hashing distfiles that did not change since they were last verified')
+    verify_distfiles.add_argument('--verify-hashes',
+            help='Whitespace-separated list of hashes to verify, if present in the entry (other hashes are verified only if the entry has none of them)')
+    verify_distfiles.set_defaults(func=do_verify_distfiles)
+
+    serve = subp.add_parser('serve',
+            help='Watch a directory tree and answer verification queries on a UNIX socket')
+    serve.add_argument('path', nargs='?', default='.',
+            help='Path to the directory tree (defaults to ".")')
+    serve.add_argument('--ionice', type=gemato.ratelimit.parse_ionice,
+            help='Set process I/O priority ("idle", "best-effort[:level]")')
+    serve.add_argument('--nice', type=int,
+            help='Increase process CPU niceness by the specified value')
+    serve.add_argument('-K', '--openpgp-key',
+            help='Use only the OpenPGP key(s) from a specific file')
+    serve.add_argument('--openpgp-keyring-cache',
+            help='Keep the keyring for --openpgp-key in a subdirectory of the specified directory, and reuse it if the key file did not change')
+    serve.add_argument('-P', '--no-openpgp-verify', action='store_false',
+            dest='openpgp_verify',
+            help='Disable OpenPGP verification of signed Manifests')
+    serve.add_argument('-S', '--socket', required=True,
+            help='Path to the UNIX socket to listen on')
+    serve.set_defaults(func=do_serve)
+
+    query = subp.add_parser('query',
+            help='Query the verification status from a running "gemato serve"')
+    query.add_argument('paths', nargs='*', default=['.'],
+            help='Paths to query (defaults to "." if none specified)')
+    query.add_argument('-n', '--no-wait', action='store_true',
+            help='Return the current status instead of waiting for pending verification')
+    query.add_argument('-S', '--socket', required=True,
+            help='Path to the UNIX socket of the server')
+    query.set_defaults(func=do_query)
+
     update = subp.add_parser('update',
             help='Update the Manifest entries for one or more directory trees')
     update.add_argument('paths', nargs='*', default=['.'],
@@ -258,16 +851,26 @@ def main(argv):
             help='Minimum Manifest size for files to be compressed')
     update.add_argument('-C', '--compress-format',
             help='Format for compressed files (e.g. "gz", "bz2"...)')
+    update.add_argument('--compress-level', type=int,
+            help='Compression level for compressed files (0..9, 1..9 for bz2, defaults to the library default)')
+    update.add_argument('--changed-files',
+            help='Update only the paths listed in the specified file (output of "git diff --name-status", "rsync --itemize-changes" or plain list, relative to the updated directory, "-" for stdin)')
+    update.add_argument('--dir-state',
+            help='Store the list of directories in the specified file, and skip scanning unchanged directories in incremental updates (requires files to be replaced rather than modified in place)')
     update.add_argument('-f', '--force-rewrite', action='store_true',
             help='Force rewriting all the Manifests, even if they did not change')
     update.add_argument('-H', '--hashes',
             help='Whitespace-separated list of hashes to use')
+    update.add_argument('-j', '--jobs', type=int,
+            help='Number of threads used to compress Manifests (defaults to the CPU count)')
     update.add_argument('-i', '--incremental', action='store_true',
             help='Perform incremental update by comparing mtimes against TIMESTAMP')
     update.add_argument('-k', '--openpgp-id',
             help='Use the specified OpenPGP key (by ID or user)')
     update.add_argument('-K', '--openpgp-key',
             help='Use only the OpenPGP key(s) from a specific file')
+    update.add_argument('--openpgp-keyring-cache',
+            help='Keep the keyring for --openpgp-key in a subdirectory of the specified directory, and reuse it if the key file did not change')
     update.add_argument('-p', '--profile',
             help='Use the specified profile ("default", "ebuild", "old-ebuild"...)')
     signgroup = update.add_mutually_exclusive_group()
@@ -289,14 +892,24 @@ def main(argv):
             help='Minimum Manifest size for files to be compressed')
     create.add_argument('-C', '--compress-format',
             help='Format for compressed files (e.g. "gz", "bz2"...)')
+    create.add_argument('--compress-level', type=int,
+            help='Compression level for compressed files (0..9, 1..9 for bz2, defaults to the library default)')
     create.add_argument('-f', '--force-rewrite', action='store_true',
             help='Force rewriting all the Manifests, even if they did not change')
+    create.add_argument('--from-tar',
+            help='Create the Manifest tree for the files inside the specified tarball (e.g. a snapshot), without extracting it. The Manifests are written into the specified output directory, or to --output-tar')
     create.add_argument('-H', '--hashes',
             help='Whitespace-separated list of hashes to use')
+    create.add_argument('-j', '--jobs', type=int,
+            help='Number of threads used to compress Manifests (defaults to the CPU count)')
     create.add_argument('-k', '--openpgp-id',
             help='Use the specified OpenPGP key (by ID or user)')
     create.add_argument('-K', '--openpgp-key',
             help='Use only the OpenPGP key(s) from a specific file')
+    create.add_argument('--openpgp-keyring-cache',
+            help='Keep the keyring for --openpgp-key in a subdirectory of the specified directory, and reuse it if the key file did not change')
+    create.add_argument('-o', '--output-tar',
+            help='Write a copy of the --from-tar tarball including the Manifests into the specified file')
     create.add_argument('-p', '--profile',
             help='Use the specified profile ("default", "ebuild", "old-ebuild"...)')
     signgroup = create.add_mutually_exclusive_group()
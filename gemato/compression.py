@@ -6,7 +6,9 @@
 import gzip
 import io
 import os.path
+import struct
 import sys
+import zlib
 
 if sys.hexversion >= 0x03030000:
     import bz2
@@ -29,7 +31,35 @@ except ImportError:
 import gemato.exceptions
 
 
-def open_compressed_file(suffix, f, mode='rb'):
+# size of chunks compressed independently by compress_data()
+GZIP_CHUNK_SIZE = 128 * 1024
+# size of the dictionary (window) primed from the preceding chunk
+GZIP_DICT_SIZE = 32 * 1024
+
+
+# valid compression levels (presets) for each format
+COMPRESSION_LEVELS = {
+    'gz': (0, 9),
+    'bz2': (1, 9),
+    'lzma': (0, 9),
+    'xz': (0, 9),
+}
+
+
+def get_compression_level_range(suffix):
+    """
+    Get the range of compression levels supported by format @suffix.
+    Returns a tuple of (min, max). Raises UnsupportedCompression
+    for unknown formats.
+    """
+
+    try:
+        return COMPRESSION_LEVELS[suffix]
+    except KeyError:
+        raise gemato.exceptions.UnsupportedCompression(suffix)
+
+
+def open_compressed_file(suffix, f, mode='rb', level=None):
     """
     Get a file-like object for an open compressed file @fileobj
     of format @suffix. The file should be open in binary mode
@@ -38,11 +68,21 @@ def open_compressed_file(suffix, f, mode='rb'):
     e.g. "gz", "bz2". @mode specifies the mode to pass to
     the compressor.
 
+    @level can specify the compression level (preset for xz/lzma)
+    when writing. If None, the library default is used. Levels outside
+    the range supported by the format are clamped to it.
+
     Note that independently of @mode, the returned file objects
     are always open in binary mode (i.e. expect bytestrings).
     """
 
+    kwargs = {}
+    if level is not None and suffix in COMPRESSION_LEVELS:
+        lo, hi = COMPRESSION_LEVELS[suffix]
+        level = min(max(level, lo), hi)
     if suffix == "gz":
+        if level is not None:
+            kwargs['compresslevel'] = level
         # work-around the deficiency in GzipFile class in py<3.3 causing
         # it to break with TextIOWrapper
         if sys.hexversion < 0x03030000:
@@ -50,19 +90,88 @@ def open_compressed_file(suffix, f, mode='rb'):
                 def read1(self, *args, **kwargs):
                     return self.read(*args, **kwargs)
 
-            return FixedGzipFile(fileobj=f, mode=mode)
+            return FixedGzipFile(fileobj=f, mode=mode, **kwargs)
 
-        return gzip.GzipFile(fileobj=f, mode=mode)
+        return gzip.GzipFile(fileobj=f, mode=mode, **kwargs)
     elif suffix == "bz2" and bz2 is not None:
-        return bz2.BZ2File(f, mode=mode)
-    elif suffix == "lzma" and lzma is not None:
-        return lzma.LZMAFile(f, format=lzma.FORMAT_ALONE, mode=mode)
-    elif suffix == "xz" and lzma is not None:
-        return lzma.LZMAFile(f, format=lzma.FORMAT_XZ, mode=mode)
+        if level is not None:
+            kwargs['compresslevel'] = level
+        return bz2.BZ2File(f, mode=mode, **kwargs)
+    elif suffix in ("lzma", "xz") and lzma is not None:
+        if level is not None:
+            kwargs['preset'] = level
+        if suffix == "lzma":
+            kwargs['format'] = lzma.FORMAT_ALONE
+        else:
+            kwargs['format'] = lzma.FORMAT_XZ
+        return lzma.LZMAFile(f, mode=mode, **kwargs)
 
     raise gemato.exceptions.UnsupportedCompression(suffix)
 
 
+def _deflate_chunk(args):
+    """
+    Compress a single chunk for compress_data(). @args is a tuple
+    of (data, level, zdict, last). Returns raw deflate data, ending
+    on a byte boundary unless @last.
+    """
+
+    data, level, zdict, last = args
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (c.compress(data)
+            + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH))
+
+
+def compress_data(suffix, data, level=None, pool=None):
+    """
+    Compress bytestring @data into format @suffix (see
+    open_compressed_file()) with compression level @level. Returns
+    the compressed bytestring.
+
+    If @pool is not None, it specifies a thread pool. gzip data larger
+    than GZIP_CHUNK_SIZE is then split into chunks that are compressed
+    in parallel (the way pigz does it), and combined into a single
+    gzip stream. Other formats are compressed serially.
+    """
+
+    if suffix == 'gz' and pool is not None and len(data) > GZIP_CHUNK_SIZE:
+        if level is None:
+            level = 9
+        # the dictionary can be used only with py3.3+ zlib
+        use_dict = sys.hexversion >= 0x03030000
+        chunks = []
+        for i in range(0, len(data), GZIP_CHUNK_SIZE):
+            zdict = None
+            if use_dict and i > 0:
+                zdict = data[max(0, i - GZIP_DICT_SIZE):i]
+            chunks.append((data[i:i+GZIP_CHUNK_SIZE], level, zdict,
+                i + GZIP_CHUNK_SIZE >= len(data)))
+
+        if level == 9:
+            xfl = 2
+        elif level == 1:
+            xfl = 4
+        else:
+            xfl = 0
+        out = [b'\x1f\x8b\x08\x00' + struct.pack('<IBB', 0, xfl, 255)]
+        out.extend(pool.map(_deflate_chunk, chunks))
+        out.append(struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+            len(data) & 0xffffffff))
+        return b''.join(out)
+
+    f = io.BytesIO()
+    cf = open_compressed_file(suffix, f, 'wb', level=level)
+    try:
+        cf.write(data)
+    finally:
+        cf.close()
+    return f.getvalue()
+
+
 class FileStack(object):
     """
     A context manager for stacked files. Maintains handles for all files
@@ -3,24 +3,31 @@
 # (c) 2017 Michał Górny
 # Licensed under the terms of 2-clause BSD license
 
-class UnsupportedCompression(Exception):
+class GematoException(Exception):
+    """
+    Base class for all exceptions raised by gemato.
+    """
+    pass
+
+
+class UnsupportedCompression(GematoException):
     def __init__(self, suffix):
         super(UnsupportedCompression, self).__init__(
                 'Unsupported compression suffix: {}'.format(suffix))
 
 
-class UnsupportedHash(Exception):
+class UnsupportedHash(GematoException):
     def __init__(self, hash_name):
         super(UnsupportedHash, self).__init__(
                 'Unsupported hash name: {}'.format(hash_name))
 
 
-class ManifestSyntaxError(Exception):
+class ManifestSyntaxError(GematoException):
     def __init__(self, message):
         super(ManifestSyntaxError, self).__init__(message)
 
 
-class ManifestIncompatibleEntry(Exception):
+class ManifestIncompatibleEntry(GematoException):
     __slots__ = ['e1', 'e2', 'diff']
 
     def __init__(self, e1, e2, diff):
@@ -33,7 +40,7 @@ class ManifestIncompatibleEntry(Exception):
         self.diff = diff
 
 
-class ManifestMismatch(Exception):
+class ManifestMismatch(GematoException):
     """
     An exception raised for verification failure.
     """
@@ -50,7 +57,7 @@ class ManifestMismatch(Exception):
         self.diff = diff
 
 
-class ManifestCrossDevice(Exception):
+class ManifestCrossDevice(GematoException):
     """
     An exception caused by attempting to cross filesystem boundaries.
     """
@@ -64,7 +71,7 @@ class ManifestCrossDevice(Exception):
             .format(path))
 
 
-class ManifestUnsignedData(Exception):
+class ManifestUnsignedData(GematoException):
     """
     An exception caused by a Manifest file containing non-whitespace
     outside the OpenPGP-signed part.
@@ -75,7 +82,7 @@ class ManifestUnsignedData(Exception):
                 "Unsigned data found in an OpenPGP signed Manifest")
 
 
-class OpenPGPVerificationFailure(Exception):
+class OpenPGPVerificationFailure(GematoException):
     """
     An exception raised when OpenPGP verification fails.
     """
@@ -85,7 +92,7 @@ class OpenPGPVerificationFailure(Exception):
                 "OpenPGP verification failed:\n{}".format(output))
 
 
-class OpenPGPSigningFailure(Exception):
+class OpenPGPSigningFailure(GematoException):
     """
     An exception raised when OpenPGP signing fails.
     """
@@ -95,7 +102,7 @@ class OpenPGPSigningFailure(Exception):
                 "OpenPGP signing failed:\n{}".format(output))
 
 
-class OpenPGPNoImplementation(Exception):
+class OpenPGPNoImplementation(GematoException):
     """
     An exception raised when no supported OpenPGP implementation
     is available.
@@ -106,7 +113,7 @@ class OpenPGPNoImplementation(Exception):
                 "No supported OpenPGP implementation found (install gnupg)")
 
 
-class ManifestInvalidPath(Exception):
+class ManifestInvalidPath(GematoException):
     """
     An exception raised when an invalid path tries to be added to
     Manifest.
@@ -120,3 +127,35 @@ class ManifestInvalidPath(Exception):
         super(ManifestInvalidPath, self).__init__(
                 "Attempting to add invalid path {} to Manifest: {} must not be {}"
                 .format(path, detail[0], detail[1]))
+
+
+class UnsupportedTarballMember(GematoException):
+    """
+    An exception raised when a tarball member can not be verified
+    without extracting the tarball.
+    """
+
+    __slots__ = ['path', 'detail']
+
+    def __init__(self, path, detail):
+        self.path = path
+        self.detail = detail
+        super(UnsupportedTarballMember, self).__init__(
+                "Tarball member {} can not be verified: {}"
+                .format(path, detail))
+
+
+class ManifestCacheInvalid(GematoException):
+    """
+    An exception raised when a shared Manifest cache file is invalid
+    or does not match the Manifest tree.
+    """
+
+    __slots__ = ['path', 'detail']
+
+    def __init__(self, path, detail):
+        self.path = path
+        self.detail = detail
+        super(ManifestCacheInvalid, self).__init__(
+                "Manifest cache {} can not be used: {}"
+                .format(path, detail))
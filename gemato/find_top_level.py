@@ -11,61 +11,151 @@ import gemato.compression
 import gemato.manifest
 
 
-def find_top_level_manifest(path='.'):
+class TopLevelManifestFinder(object):
     """
-    Find top-level Manifest file that covers @path (defaults
-    to the current directory). Returns the path to the Manifest
-    or None.
+    Finder for top-level Manifest files. Every directory is listed
+    once to find the Manifest variants present in it, and the results
+    are memoized by (st_dev, st_ino) of the directory. The Manifests
+    are parsed once as well, and memoized by (st_dev, st_ino)
+    of the Manifest file. Therefore, the same instance can be used
+    to efficiently find top-level Manifests for multiple paths within
+    the same tree.
     """
 
-    cur_path = path
-    last_found = None
-    original_dev = None
-    m = gemato.manifest.ManifestFile()
+    __slots__ = ['root_st', 'dir_cache', 'manifest_cache']
+
+    def __init__(self):
+        self.root_st = os.stat('/')
+        # (st_dev, st_ino) of directory -> (Manifest filename, stat)
+        self.dir_cache = {}
+        # (st_dev, st_ino) of Manifest -> ManifestFile
+        self.manifest_cache = {}
 
-    root_st = os.stat('/')
+    def probe_directory(self, path, st):
+        """
+        Find Manifest in directory @path, with stat result @st.
+        Returns a tuple of Manifest filename and its stat result,
+        or None if there is no Manifest.
+        """
 
-    while True:
-        st = os.stat(cur_path)
+        key = (st.st_dev, st.st_ino)
+        try:
+            return self.dir_cache[key]
+        except KeyError:
+            pass
 
-        # verify that we are not crossing device boundaries
-        if original_dev is None:
-            original_dev = st.st_dev
-        elif original_dev != st.st_dev:
-            break
+        try:
+            names = frozenset(os.listdir(path))
+        except OSError:
+            # fall back to probing every name
+            names = None
 
-        m_path = os.path.join(cur_path, 'Manifest')
-        for m_path in (gemato.compression
-                .get_potential_compressed_names(m_path)):
+        ret = None
+        for name in (gemato.compression
+                .get_potential_compressed_names('Manifest')):
+            if names is not None and name not in names:
+                continue
             try:
-                with (gemato.compression
-                        .open_potentially_compressed_path(m_path, 'r',
-                            encoding='utf8')) as f:
-                    fst = os.fstat(f.fileno())
-                    if fst.st_dev != original_dev:
-                        return last_found
-
-                    m.load(f, verify_openpgp=False)
-            except IOError as e:
+                fst = os.stat(os.path.join(path, name))
+            except OSError as e:
                 if e.errno != errno.ENOENT:
                     raise
             else:
+                ret = (name, fst)
+                break
+
+        self.dir_cache[key] = ret
+        return ret
+
+    def is_ignored(self, m_path, m_st, relpath):
+        """
+        Check whether @relpath is ignored by the Manifest at @m_path,
+        with stat result @m_st.
+
+        Raises ManifestSyntaxError if the file is not a valid Manifest.
+        """
+
+        key = (m_st.st_dev, m_st.st_ino)
+        m = self.manifest_cache.get(key)
+        if m is None:
+            m = gemato.manifest.ManifestFile()
+            with (gemato.compression
+                    .open_potentially_compressed_path(m_path, 'r',
+                        encoding='utf8')) as f:
+                m.load(f, verify_openpgp=False)
+            self.manifest_cache[key] = m
+
+        fe = m.find_path_entry(relpath)
+        return fe is not None and fe.tag == 'IGNORE'
+
+    def find(self, path='.'):
+        """
+        Find top-level Manifest file that covers @path (defaults
+        to the current directory). Returns the path to the Manifest
+        or None.
+        """
+
+        cur_path = path
+        last_found = None
+        original_dev = None
+
+        while True:
+            st = os.stat(cur_path)
+
+            # verify that we are not crossing device boundaries
+            if original_dev is None:
+                original_dev = st.st_dev
+            elif original_dev != st.st_dev:
+                break
+
+            found = self.probe_directory(cur_path, st)
+            if found is not None:
+                name, m_st = found
+                if m_st.st_dev != original_dev:
+                    break
+
                 # check if the initial path is ignored
                 relpath = os.path.relpath(path, cur_path)
                 if relpath == '.':
                     relpath = ''
-                fe = m.find_path_entry(relpath)
-                if fe is not None and fe.tag == 'IGNORE':
-                    return last_found
+                m_path = os.path.join(cur_path, name)
+                if self.is_ignored(m_path, m_st, relpath):
+                    break
 
                 last_found = m_path
+
+            # check if we reached root directory
+            if (st.st_dev == self.root_st.st_dev
+                    and st.st_ino == self.root_st.st_ino):
                 break
 
-        # check if we reached root directory
-        if st.st_dev == root_st.st_dev and st.st_ino == root_st.st_ino:
-            break
+            # try the parent directory
+            cur_path = os.path.join(cur_path, '..')
+
+        return last_found
+
 
-        # try the parent directory
-        cur_path = os.path.join(cur_path, '..')
+def find_top_level_manifest(path='.', finder=None):
+    """
+    Find top-level Manifest file that covers @path (defaults
+    to the current directory). Returns the path to the Manifest
+    or None.
+
+    @finder can specify a TopLevelManifestFinder instance to reuse
+    the results of earlier lookups.
+    """
+
+    if finder is None:
+        finder = TopLevelManifestFinder()
+    return finder.find(path)
+
+
+def find_top_level_manifests(paths):
+    """
+    Find top-level Manifest files for every path in @paths, sharing
+    directory lookups between them. Returns a list of Manifest paths
+    (or None) corresponding to @paths.
+    """
 
-    return last_found
+    finder = TopLevelManifestFinder()
+    return [finder.find(p) for p in paths]
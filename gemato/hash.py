@@ -5,11 +5,15 @@
 
 import hashlib
 import io
+import timeit
 
 import gemato.exceptions
 
 
 HASH_BUFFER_SIZE = 65536
+HASH_BENCHMARK_SIZE = 4 * 1024 * 1024
+
+_hash_speeds = {}
 
 
 class SizeHash(object):
@@ -67,15 +71,20 @@ def get_hash_by_name(name):
 	raise gemato.exceptions.UnsupportedHash(name)
 
 
-def hash_file(f, hash_names):
+def hash_file(f, hash_names, rate_limiter=None):
 	"""
 	Hash the contents of file object @f using all hashes specified
 	as @hash_names. Returns a dict of (hash_name -> hex value) mappings.
+
+	If @rate_limiter is not None, it is notified of every block read
+	(see gemato.ratelimit.RateLimiter) and can throttle the reading.
 	"""
 	hashes = {}
 	for h in hash_names:
 		hashes[h] = get_hash_by_name(h)
 	for block in iter(lambda: f.read1(HASH_BUFFER_SIZE), b''):
+		if rate_limiter is not None:
+			rate_limiter.data_read(len(block))
 		for h in hashes.values():
 			h.update(block)
 	return dict((k, h.hexdigest()) for k, h in hashes.items())
@@ -97,3 +106,25 @@ def hash_bytes(buf, hash_name):
 	Returns the hex value.
 	"""
 	return hash_file(io.BytesIO(buf), (hash_name,))[hash_name]
+
+
+def get_hash_speed(hash_name):
+	"""
+	Get the throughput of hash @hash_name on this host, in bytes
+	per second. The value is measured on the first call, and cached
+	afterwards. Raises UnsupportedHash if the hash is not supported.
+	"""
+	try:
+		return _hash_speeds[hash_name]
+	except KeyError:
+		pass
+
+	h = get_hash_by_name(hash_name)
+	block = b'\0' * HASH_BUFFER_SIZE
+	start = timeit.default_timer()
+	for i in range(HASH_BENCHMARK_SIZE // HASH_BUFFER_SIZE):
+		h.update(block)
+	h.hexdigest()
+	elapsed = max(timeit.default_timer() - start, 1e-9)
+	speed = _hash_speeds[hash_name] = HASH_BENCHMARK_SIZE / elapsed
+	return speed
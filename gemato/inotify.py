@@ -0,0 +1,199 @@
+# gemato: inotify-based directory tree watcher
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import struct
+
+import gemato.util
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+        | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+        | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _encode_path(path):
+    try:
+        return os.fsencode(path)
+    except AttributeError:
+        # py2
+        return path
+
+
+def _decode_path(path):
+    try:
+        return os.fsdecode(path)
+    except AttributeError:
+        # py2
+        return path
+
+
+class InotifyWatcher(object):
+    """
+    A watcher for changes in a directory tree, using Linux inotify
+    API. All directories in the tree (except for dotfiles) are watched,
+    including the directories created after the watcher was started.
+    """
+
+    __slots__ = ['root_directory', 'fd', 'libc', 'watches']
+
+    def __init__(self, root_directory):
+        """
+        Start watching the tree at @root_directory. Raises OSError
+        if inotify is not supported or the watches can not be set up.
+        """
+
+        self.root_directory = root_directory
+        self.watches = {}
+        self.fd = None
+
+        libname = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(libname, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS,
+                    'inotify is not supported on this platform')
+
+        fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+        try:
+            self.add_tree('')
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_cb):
+        self.close()
+
+    def close(self):
+        """
+        Stop watching and close the inotify descriptor.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def fileno(self):
+        return self.fd
+
+    def _add_watch(self, relpath):
+        path = os.path.join(self.root_directory, relpath)
+        wd = self.libc.inotify_add_watch(self.fd,
+                ctypes.c_char_p(_encode_path(path)), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # the directory could have been removed in the meantime
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = relpath
+
+    def add_tree(self, relpath):
+        """
+        Start watching the directory @relpath (relative to the root
+        directory) and all its subdirectories.
+        """
+
+        self._add_watch(relpath)
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.root_directory, relpath)):
+            dirrelpath = os.path.relpath(dirpath, self.root_directory)
+            if dirrelpath == '.':
+                dirrelpath = ''
+            # skip dotfiles
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for d in dirnames:
+                self._add_watch(os.path.join(dirrelpath, d))
+
+    def read_events(self):
+        """
+        Read the pending events. Returns a list of changed paths
+        (relative to the root directory), or [''] if the event queue
+        overflowed and the whole tree needs to be rescanned. Returns
+        an empty list if no events are pending.
+        """
+
+        ret = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, namelen = EVENT_HEADER.unpack_from(
+                        buf, pos)
+                pos += EVENT_HEADER.size
+                name = _decode_path(buf[pos:pos+namelen].rstrip(b'\0'))
+                pos += namelen
+
+                if mask & IN_Q_OVERFLOW:
+                    ret.append('')
+                    continue
+                dirpath = self.watches.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # watch removed along with the directory
+                    del self.watches[wd]
+                    continue
+                if mask & IN_MOVE_SELF:
+                    # the watches for the moved tree have stale paths
+                    for owd, opath in list(self.watches.items()):
+                        if gemato.util.path_starts_with(opath, dirpath):
+                            self.libc.inotify_rm_watch(self.fd, owd)
+                            del self.watches[owd]
+                    ret.append(dirpath)
+                    continue
+                if mask & IN_DELETE_SELF:
+                    ret.append(dirpath)
+                    continue
+                # skip dotfiles
+                if name.startswith('.'):
+                    continue
+
+                path = os.path.join(dirpath, name)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                ret.append(path)
+
+        if '' in ret:
+            return ['']
+        return ret
@@ -137,8 +137,8 @@ class ManifestFileEntry(ManifestPathEntry):
 
     def to_list(self, tag):
         ret = [tag, self.path, str(self.size)]
-        for k, v in sorted(self.checksums.items()):
-            ret += [k, v]
+        for kv in sorted(self.checksums.items()):
+            ret.extend(kv)
         return ret
 
     def __eq__(self, other):
@@ -280,6 +280,20 @@ MANIFEST_TAG_MAPPING = {
 }
 
 
+def manifest_entry_sort_key(e):
+    """
+    Get the key for sorting Manifest entry @e, matching the order
+    defined by the entry __lt__() methods.
+    """
+    if e.tag == 'TIMESTAMP':
+        return (e.tag, e.ts)
+    return (e.tag, e.path)
+
+
+# number of lines written at once by ManifestFile.dump()
+DUMP_CHUNK_LINES = 4096
+
+
 def new_manifest_entry(tag, *args):
     """
     Construct a Manifest entry for given @tag. @args are passed
@@ -319,7 +333,8 @@ class ManifestFile(object):
         if f is not None:
             self.load(f)
 
-    def load(self, f, verify_openpgp=True, openpgp_env=None):
+    def load(self, f, verify_openpgp=True, openpgp_env=None,
+            openpgp_cache=None):
         """
         Load data from file @f. The file should be open for reading
         in text mode, and oriented at the beginning.
@@ -333,78 +348,97 @@ class ManifestFile(object):
         an exception will be raised. If the exception is caught,
         the caller can continue using the ManifestFile instance
         -- it will be loaded completely.
+
+        If @openpgp_cache is not None, it specifies a SignatureCache
+        instance (see gemato.state). If the same signed data was
+        verified successfully using the same keys recently, gpg is not
+        called at all. The caller is responsible for saving the cache
+        afterwards. The cache is used only with @openpgp_env that
+        has keys imported.
         """
 
         self.entries = []
         self.openpgp_signed = False
         state = ManifestState.DATA
-        openpgp_data = ''
-
-        for l in f:
-            if state == ManifestState.DATA:
-                if l == '-----BEGIN PGP SIGNED MESSAGE-----\n':
-                    if self.entries:
-                        raise gemato.exceptions.ManifestUnsignedData()
-                    if verify_openpgp:
-                        openpgp_data += l
-                    state = ManifestState.SIGNED_PREAMBLE
+        # the signed data is fed to gpg while parsing, unless it can
+        # be found in the cache
+        verifier = None
+
+        try:
+            for l in f:
+                if state == ManifestState.DATA:
+                    if l == '-----BEGIN PGP SIGNED MESSAGE-----\n':
+                        if self.entries:
+                            raise gemato.exceptions.ManifestUnsignedData()
+                        if verify_openpgp:
+                            if openpgp_cache is not None:
+                                verifier = gemato.openpgp.OpenPGPCachedVerifier(
+                                        openpgp_cache, env=openpgp_env)
+                            else:
+                                verifier = gemato.openpgp.OpenPGPStreamVerifier(
+                                        env=openpgp_env)
+                            verifier.write(l)
+                        state = ManifestState.SIGNED_PREAMBLE
+                        continue
+                elif state == ManifestState.SIGNED_PREAMBLE:
+                    if verifier is not None:
+                        verifier.write(l)
+                    # skip header lines up to the empty line
+                    if l.strip():
+                        continue
+                    state = ManifestState.SIGNED_DATA
+                elif state == ManifestState.SIGNED_DATA:
+                    if verifier is not None:
+                        verifier.write(l)
+                    if l == '-----BEGIN PGP SIGNATURE-----\n':
+                        state = ManifestState.SIGNATURE
+                        continue
+                    # dash-escaping, RFC 4880 says any line can suffer from it
+                    if l.startswith('- '):
+                        l = l[2:]
+                elif state == ManifestState.SIGNATURE:
+                    if verifier is not None:
+                        verifier.write(l)
+                    if l == '-----END PGP SIGNATURE-----\n':
+                        state = ManifestState.POST_SIGNED_DATA
+                        continue
+
+                if l.startswith('-----') and l.rstrip().endswith('-----'):
+                    raise gemato.exceptions.ManifestSyntaxError(
+                            "Unexpected OpenPGP header: {}".format(l))
+                if state in (ManifestState.SIGNED_PREAMBLE, ManifestState.SIGNATURE):
                     continue
-            elif state == ManifestState.SIGNED_PREAMBLE:
-                if verify_openpgp:
-                    openpgp_data += l
-                # skip header lines up to the empty line
-                if l.strip():
+
+                sl = l.strip().split()
+                # skip empty lines
+                if not sl:
                     continue
-                state = ManifestState.SIGNED_DATA
+                if state == ManifestState.POST_SIGNED_DATA:
+                    raise gemato.exceptions.ManifestUnsignedData()
+                tag = sl[0]
+                try:
+                    self.entries.append(MANIFEST_TAG_MAPPING[tag]
+                            .from_list(sl))
+                except KeyError:
+                    raise gemato.exceptions.ManifestSyntaxError(
+                            "Invalid Manifest line: {}".format(l))
+
+            if state == ManifestState.SIGNED_PREAMBLE:
+                raise gemato.exceptions.ManifestSyntaxError(
+                        "Manifest terminated early, in OpenPGP headers")
             elif state == ManifestState.SIGNED_DATA:
-                if verify_openpgp:
-                    openpgp_data += l
-                if l == '-----BEGIN PGP SIGNATURE-----\n':
-                    state = ManifestState.SIGNATURE
-                    continue
-                # dash-escaping, RFC 4880 says any line can suffer from it
-                if l.startswith('- '):
-                    l = l[2:]
-            elif state == ManifestState.SIGNATURE:
-                if verify_openpgp:
-                    openpgp_data += l
-                if l == '-----END PGP SIGNATURE-----\n':
-                    state = ManifestState.POST_SIGNED_DATA
-                    continue
-
-            if l.startswith('-----') and l.rstrip().endswith('-----'):
                 raise gemato.exceptions.ManifestSyntaxError(
-                        "Unexpected OpenPGP header: {}".format(l))
-            if state in (ManifestState.SIGNED_PREAMBLE, ManifestState.SIGNATURE):
-                continue
-
-            sl = l.strip().split()
-            # skip empty lines
-            if not sl:
-                continue
-            if state == ManifestState.POST_SIGNED_DATA:
-                raise gemato.exceptions.ManifestUnsignedData()
-            tag = sl[0]
-            try:
-                self.entries.append(MANIFEST_TAG_MAPPING[tag]
-                        .from_list(sl))
-            except KeyError:
+                        "Manifest terminated early, before signature")
+            elif state == ManifestState.SIGNATURE:
                 raise gemato.exceptions.ManifestSyntaxError(
-                        "Invalid Manifest line: {}".format(l))
-
-        if state == ManifestState.SIGNED_PREAMBLE:
-            raise gemato.exceptions.ManifestSyntaxError(
-                    "Manifest terminated early, in OpenPGP headers")
-        elif state == ManifestState.SIGNED_DATA:
-            raise gemato.exceptions.ManifestSyntaxError(
-                    "Manifest terminated early, before signature")
-        elif state == ManifestState.SIGNATURE:
-            raise gemato.exceptions.ManifestSyntaxError(
-                    "Manifest terminated early, inside signature")
-
-        if verify_openpgp and state == ManifestState.POST_SIGNED_DATA:
-            with io.StringIO(openpgp_data) as f:
-                gemato.openpgp.verify_file(f, env=openpgp_env)
+                        "Manifest terminated early, inside signature")
+        except:
+            if verifier is not None:
+                verifier.abort()
+            raise
+
+        if verifier is not None:
+            verifier.finish()
             self.openpgp_signed = True
 
     def dump(self, f, sign_openpgp=None, openpgp_keyid=None,
@@ -428,7 +462,8 @@ class ManifestFile(object):
             sign_openpgp = self.openpgp_signed
 
         if sort:
-            self.entries = sorted(self.entries)
+            self.entries = sorted(self.entries,
+                    key=manifest_entry_sort_key)
 
         if sign_openpgp:
             with io.StringIO() as data:
@@ -438,8 +473,10 @@ class ManifestFile(object):
                 gemato.openpgp.clear_sign_file(data, f,
                         keyid=openpgp_keyid, env=openpgp_env)
         else:
-            for e in self.entries:
-                f.write(u' '.join(e.to_list()) + '\n')
+            lines = [u' '.join(e.to_list()) + u'\n'
+                     for e in self.entries]
+            for i in range(0, len(lines), DUMP_CHUNK_LINES):
+                f.write(u''.join(lines[i:i+DUMP_CHUNK_LINES]))
 
     def find_timestamp(self):
         """
@@ -4,6 +4,9 @@
 # Licensed under the terms of 2-clause BSD license
 
 import errno
+import hashlib
+import io
+import os.path
 import shutil
 import subprocess
 import tempfile
@@ -11,16 +14,17 @@ import tempfile
 import gemato.exceptions
 
 
-def _spawn_gpg(options, home, stdin):
+def _popen_gpg(options, home, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE):
     env = None
     if home is not None:
         env={'HOME': home}
 
     try:
-        p = subprocess.Popen(['gpg', '--batch'] + options,
+        return subprocess.Popen(['gpg', '--batch'] + options,
                 stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+                stdout=stdout,
+                stderr=stderr,
                 env=env)
     except OSError as e:
         if e.errno == errno.ENOENT:
@@ -28,10 +32,132 @@ def _spawn_gpg(options, home, stdin):
         else:
             raise
 
+
+def _spawn_gpg(options, home, stdin):
+    p = _popen_gpg(options, home)
     out, err = p.communicate(stdin)
     return (p.wait(), out, err)
 
 
+class OpenPGPStreamVerifier(object):
+    """
+    A verifier for OpenPGP signed data that is fed to gpg while it is
+    being read, so that the verification runs in parallel with
+    processing the data. Write the signed text via write(), then call
+    finish() to get the result, or abort() to cancel it.
+
+    Errors starting gpg are deferred to finish(), so that the caller
+    can continue processing the data.
+    """
+
+    __slots__ = ['proc', 'err', 'error']
+
+    def __init__(self, env=None):
+        self.proc = None
+        self.error = None
+        self.err = tempfile.TemporaryFile()
+        try:
+            self.proc = _popen_gpg(['--verify'],
+                    env.home if env is not None else None,
+                    stdout=self.err, stderr=self.err)
+        except gemato.exceptions.OpenPGPNoImplementation as e:
+            self.err.close()
+            self.error = e
+
+    def write(self, data):
+        """
+        Pass text @data to gpg.
+        """
+
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.write(data.encode('utf8'))
+        except (IOError, OSError) as e:
+            # gpg terminated early, the error will be reported
+            # by finish()
+            if e.errno != errno.EPIPE:
+                raise
+
+    def abort(self):
+        """
+        Cancel the verification.
+        """
+
+        if self.proc is not None:
+            self.proc.kill()
+            self._close()
+
+    def _close(self):
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+        exitst = self.proc.wait()
+        self.proc = None
+        self.err.seek(0)
+        err = self.err.read()
+        self.err.close()
+        return exitst, err
+
+    def finish(self):
+        """
+        Finish the verification. Raises an exception if it fails.
+        """
+
+        if self.error is not None:
+            raise self.error
+        exitst, err = self._close()
+        if exitst != 0:
+            raise gemato.exceptions.OpenPGPVerificationFailure(err.decode('utf8'))
+
+
+class OpenPGPCachedVerifier(object):
+    """
+    A verifier with the same API as OpenPGPStreamVerifier, using
+    a SignatureCache (see gemato.state) to skip verifying data that
+    was verified recently. The data is collected and verified
+    in finish(), if necessary.
+    """
+
+    __slots__ = ['cache', 'env', 'data', 'hash']
+
+    def __init__(self, cache, env=None):
+        self.cache = cache
+        self.env = env
+        self.data = []
+        self.hash = hashlib.sha512()
+
+    def write(self, data):
+        """
+        Collect text @data.
+        """
+
+        self.data.append(data)
+        self.hash.update(data.encode('utf8'))
+
+    def abort(self):
+        """
+        Cancel the verification.
+        """
+
+        self.data = []
+
+    def finish(self):
+        """
+        Finish the verification. Raises an exception if it fails.
+        """
+
+        key = self.cache.get_key(self.hash.hexdigest(), self.env)
+        if key is not None and self.cache.is_verified(key):
+            return
+        with io.StringIO(u''.join(self.data)) as f:
+            verify_file(f, env=self.env)
+        if key is not None:
+            self.cache.record(key)
+
+
 class OpenPGPEnvironment(object):
     """
     An isolated environment for OpenPGP routines. Used to get reliable
@@ -41,10 +167,22 @@ class OpenPGPEnvironment(object):
     or use as a context manager (via 'with').
     """
 
-    __slots__ = ['_home']
+    __slots__ = ['_home', '_persistent', 'fingerprints']
+
+    def __init__(self, home=None, fingerprints=()):
+        """
+        Create a new environment. If @home is None, a temporary
+        directory is created and removed on close(). Otherwise,
+        @home is used as a persistent keyring location, and @fingerprints
+        should list the fingerprints of the keys imported there.
+        """
 
-    def __init__(self):
-        self._home = tempfile.mkdtemp()
+        self._persistent = home is not None
+        if home is None:
+            home = tempfile.mkdtemp()
+        self._home = home
+        # fingerprints of the imported keys
+        self.fingerprints = frozenset(fingerprints)
 
     def __enter__(self):
         return self
@@ -55,7 +193,8 @@ class OpenPGPEnvironment(object):
 
     def close(self):
         if self._home is not None:
-            shutil.rmtree(self._home)
+            if not self._persistent:
+                shutil.rmtree(self._home)
             self._home = None
 
     def import_key(self, keyfile):
@@ -65,11 +204,18 @@ class OpenPGPEnvironment(object):
         at the beginning.
         """
 
-        exitst, out, err = _spawn_gpg(['--import'], self.home,
-                keyfile.read())
+        exitst, out, err = _spawn_gpg(['--status-fd', '1', '--import'],
+                self.home, keyfile.read())
         if exitst != 0:
             raise RuntimeError('Unable to import key: {}'.format(err.decode('utf8')))
 
+        fprs = set(self.fingerprints)
+        for l in out.decode('utf8').splitlines():
+            sl = l.split()
+            if sl[:2] == ['[GNUPG:]', 'IMPORT_OK'] and len(sl) > 3:
+                fprs.add(sl[3])
+        self.fingerprints = frozenset(fprs)
+
     def verify_file(self, f):
         """
         A convenience wrapper for verify_file(), using this environment.
@@ -93,6 +239,59 @@ class OpenPGPEnvironment(object):
         return self._home
 
 
+FINGERPRINTS_FILE = 'gemato-fingerprints'
+
+
+def open_cached_environment(keyfile, cache_dir):
+    """
+    Get an OpenPGPEnvironment with the keys from open file @keyfile
+    imported, using a persistent keyring in a subdirectory of @cache_dir
+    named after the hash of the key file contents. If the same key file
+    was imported before, the keyring is reused without calling gpg.
+
+    The file should be open for reading in binary mode, and oriented
+    at the beginning.
+    """
+
+    data = keyfile.read()
+    home = os.path.join(cache_dir, hashlib.sha256(data).hexdigest())
+    try:
+        with io.open(os.path.join(home, FINGERPRINTS_FILE), 'r',
+                encoding='utf8') as f:
+            return OpenPGPEnvironment(home=home,
+                    fingerprints=f.read().split())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    try:
+        os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # import into a temporary directory and move it into place
+    # atomically, to avoid using a partially initialized keyring
+    tmp_home = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        env = OpenPGPEnvironment(home=tmp_home)
+        env.import_key(io.BytesIO(data))
+        with io.open(os.path.join(tmp_home, FINGERPRINTS_FILE), 'w',
+                encoding='utf8') as f:
+            f.write(u'\n'.join(sorted(env.fingerprints)))
+        try:
+            os.rename(tmp_home, home)
+        except OSError as e:
+            # another process created the keyring in the meantime
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(tmp_home)
+    except:
+        shutil.rmtree(tmp_home, ignore_errors=True)
+        raise
+    return OpenPGPEnvironment(home=home, fingerprints=env.fingerprints)
+
+
 def verify_file(f, env=None):
     """
     Perform an OpenPGP verification of Manifest data in open file @f.
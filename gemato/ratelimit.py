@@ -0,0 +1,201 @@
+# gemato: I/O rate limiting and priority support
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import threading
+import time
+import timeit
+
+
+class TokenBucket(object):
+    """
+    A token bucket limiting the rate of some operation. Tokens
+    are refilled at @rate per second, up to @capacity. Consuming
+    more tokens than available puts the bucket into debt, and sleeps
+    until the debt would be repaid.
+
+    The bucket can be shared between multiple threads.
+    """
+
+    __slots__ = ['rate', 'capacity', 'tokens', 'last', 'clock', 'sleep',
+            'lock']
+
+    def __init__(self, rate, capacity=None, clock=timeit.default_timer,
+            sleep=time.sleep):
+        """
+        Create a new bucket for @rate tokens per second. @capacity
+        specifies the maximum burst size, and defaults to @rate.
+        The bucket starts full.
+
+        @clock and @sleep can be used to override the time source
+        and the sleep function respectively.
+        """
+
+        assert rate > 0
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.last = self.clock()
+
+    def consume(self, amount):
+        """
+        Take @amount tokens from the bucket, sleeping if necessary.
+        """
+
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                    self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            debt = -self.tokens
+        # sleep without holding the lock, the debt is already recorded
+        # so other threads will wait for it as well
+        if debt > 0:
+            self.sleep(debt / float(self.rate))
+
+
+class RateLimiter(object):
+    """
+    A combined limit on the number of bytes and files processed
+    per second. Either of the limits can be None to disable it.
+    """
+
+    __slots__ = ['bytes_bucket', 'files_bucket']
+
+    def __init__(self, bytes_per_second=None, files_per_second=None,
+            **kwargs):
+        """
+        Create a new limiter. @kwargs are passed to TokenBucket.
+        """
+
+        self.bytes_bucket = None
+        self.files_bucket = None
+        if bytes_per_second is not None:
+            self.bytes_bucket = TokenBucket(bytes_per_second, **kwargs)
+        if files_per_second is not None:
+            self.files_bucket = TokenBucket(files_per_second, **kwargs)
+
+    def file_opened(self):
+        """
+        Account for opening a new file.
+        """
+        if self.files_bucket is not None:
+            self.files_bucket.consume(1)
+
+    def data_read(self, size):
+        """
+        Account for reading @size bytes of data.
+        """
+        if self.bytes_bucket is not None:
+            self.bytes_bucket.consume(size)
+
+
+SIZE_SUFFIXES = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+}
+
+
+def parse_size(value):
+    """
+    Parse a size specification @value, e.g. '512', '64K', '20M'
+    or '1G' (binary units). Returns an integer. Raises ValueError
+    if the value is invalid or not positive.
+    """
+
+    value = value.strip()
+    mult = 1
+    if value[-1:].upper() in SIZE_SUFFIXES:
+        mult = SIZE_SUFFIXES[value[-1].upper()]
+        value = value[:-1]
+    ret = int(float(value) * mult)
+    if ret <= 0:
+        raise ValueError('Size must be positive: {}'.format(value))
+    return ret
+
+
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set() syscall numbers for Linux
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'amd64': 251,
+    'i386': 289,
+    'i486': 289,
+    'i586': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'arm64': 30,
+    'armv7l': 314,
+    'armv6l': 314,
+    'ppc': 273,
+    'ppc64': 273,
+    'ppc64le': 273,
+    's390x': 282,
+    'riscv64': 30,
+}
+
+
+def parse_ionice(value):
+    """
+    Parse an I/O priority specification @value in the form
+    of 'class' or 'class:level', where class is one of 'idle',
+    'best-effort' or 'realtime' and level is 0..7. Returns a tuple
+    of (class, level), with level being None if not specified.
+    Raises ValueError if the value is invalid.
+    """
+
+    ioclass, sep, level = value.partition(':')
+    if ioclass not in IOPRIO_CLASSES:
+        raise ValueError('Invalid I/O priority class: {}'.format(ioclass))
+    if sep:
+        level = int(level)
+        if level < 0 or level > 7:
+            raise ValueError('I/O priority level must be 0..7: {}'.format(level))
+    else:
+        level = None
+    return (ioclass, level)
+
+
+def set_io_priority(ioclass, level=None):
+    """
+    Set the I/O scheduling class @ioclass ('idle', 'best-effort'
+    or 'realtime') and priority @level for the current process.
+    The level is ignored for the idle class, and defaults to 4
+    otherwise.
+
+    Raises OSError if the operation is not supported on the platform
+    or fails.
+    """
+
+    syscall_no = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if not platform.system() == 'Linux' or syscall_no is None:
+        raise OSError(errno.ENOSYS,
+                'ioprio_set() is not supported on this platform')
+
+    if ioclass == 'idle' or level is None:
+        level = 0 if ioclass == 'idle' else 4
+    prio = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.syscall(syscall_no, IOPRIO_WHO_PROCESS, 0, prio) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
@@ -3,7 +3,12 @@
 # (c) 2017 Michał Górny
 # Licensed under the terms of 2-clause BSD license
 
+import collections
 import errno
+import io
+import multiprocessing
+import multiprocessing.pool
+import os
 import os.path
 
 import gemato.compression
@@ -26,6 +31,7 @@ class ManifestRecursiveLoader(object):
         'root_directory',
         'verify_openpgp',
         'openpgp_env',
+        'openpgp_cache',
         'sign_openpgp',
         'openpgp_keyid',
         'hashes',
@@ -33,6 +39,7 @@ class ManifestRecursiveLoader(object):
         'sort',
         'compress_watermark',
         'compress_format',
+        'compress_level',
         'profile',
         # internal variables
         'top_level_manifest_filename',
@@ -46,7 +53,8 @@ class ManifestRecursiveLoader(object):
             sign_openpgp=None, openpgp_keyid=None,
             hashes=None, allow_create=False, sort=None,
             compress_watermark=None, compress_format=None,
-            profile=gemato.profile.DefaultProfile()):
+            profile=gemato.profile.DefaultProfile(),
+            openpgp_cache=None, compress_level=None):
         """
         Instantiate the loader for a Manifest tree starting at top-level
         Manifest @top_manifest_path.
@@ -55,6 +63,8 @@ class ManifestRecursiveLoader(object):
         to ManifestFile. If the top-level Manifest is OpenPGP-signed
         and the verification succeeds, openpgp_signed property
         is set to True. @verify_openpgp is True by default.
+        @openpgp_cache can specify a SignatureCache (see gemato.state)
+        that is passed down to ManifestFile as well.
 
         @sign_openpgp is passed down to ManifestFile when writing
         the top-level Manifest. If it is True, the top-level Manifest
@@ -85,12 +95,17 @@ class ManifestRecursiveLoader(object):
         If @compress_watermark is None, the compression is left as-is.
         The default @compress_format is 'gz'.
 
+        @compress_level specifies the compression level (or xz preset)
+        used when writing compressed Manifests. If None, the library
+        default is used.
+
         @profile can be used to provide the profile for the repository.
         """
 
         self.root_directory = os.path.dirname(top_manifest_path)
         self.verify_openpgp = verify_openpgp
         self.openpgp_env = openpgp_env
+        self.openpgp_cache = openpgp_cache
         self.sign_openpgp = sign_openpgp
         self.openpgp_keyid = openpgp_keyid
         self.hashes = hashes
@@ -98,6 +113,7 @@ class ManifestRecursiveLoader(object):
         self.sort = sort
         self.compress_watermark = compress_watermark
         self.compress_format = compress_format
+        self.compress_level = compress_level
 
         self.profile.set_loader_options(self)
 
@@ -140,7 +156,8 @@ class ManifestRecursiveLoader(object):
         try:
             with gemato.compression.open_potentially_compressed_path(
                     path, 'r', encoding='utf8') as f:
-                m.load(f, self.verify_openpgp, self.openpgp_env)
+                m.load(f, self.verify_openpgp, self.openpgp_env,
+                        openpgp_cache=self.openpgp_cache)
                 st = os.fstat(f.fileno())
         except IOError as err:
             if err.errno == errno.ENOENT and allow_create:
@@ -154,7 +171,7 @@ class ManifestRecursiveLoader(object):
         self.loaded_manifests[relpath] = m
         return m
 
-    def save_manifest(self, relpath, sort=False):
+    def save_manifest(self, relpath, sort=False, compress_level=None):
         """
         Save a single Manifest file whose relative path within Manifest
         tree is @relpath. The Manifest must already be loaded.
@@ -163,13 +180,30 @@ class ManifestRecursiveLoader(object):
         will be created.
 
         If @sort is True, the Manifest entries will be sorted prior
-        to saving.
+        to saving. @compress_level overrides the compression level
+        specified in the constructor.
 
         Returns the uncompressed size of the Manifest (number
         of characters written).
         """
+        data = self._serialize_manifest(relpath, sort=sort)
+        tmp_path = self._write_manifest_data(relpath, data,
+                compress_level=compress_level)
+        try:
+            os.rename(tmp_path,
+                    os.path.join(self.root_directory, relpath))
+        except:
+            os.unlink(tmp_path)
+            raise
+        return len(data)
+
+    def _serialize_manifest(self, relpath, sort=False):
+        """
+        Serialize the loaded Manifest @relpath, signing it if it
+        is the top-level Manifest and signing is requested. Returns
+        the uncompressed data as a bytestring.
+        """
         m = self.loaded_manifests[relpath]
-        path = os.path.join(self.root_directory, relpath)
 
         # is it top-level Manifest?
         if relpath == self.top_level_manifest_filename:
@@ -177,12 +211,43 @@ class ManifestRecursiveLoader(object):
         else:
             sign = False
 
-        with gemato.compression.open_potentially_compressed_path(
-                path, 'w', encoding='utf8') as f:
+        with io.StringIO() as f:
             m.dump(f, sign_openpgp=sign, sort=sort,
                     openpgp_env=self.openpgp_env,
                     openpgp_keyid=self.openpgp_keyid)
-            return f.buffer.tell()
+            return f.getvalue().encode('utf8')
+
+    def _write_manifest_data(self, relpath, data, compress_level=None,
+            pool=None):
+        """
+        Write serialized Manifest @data for the file @relpath
+        into a new temporary file next to it, compressing it
+        if the name indicates compression. @pool can specify the thread
+        pool used to compress large Manifests in chunks (see
+        gemato.compression.compress_data()).
+
+        Returns the path to the temporary file. The caller is
+        responsible for renaming it to the final path.
+        """
+        if compress_level is None:
+            compress_level = self.compress_level
+        path = os.path.join(self.root_directory, relpath)
+        compr = gemato.compression.get_compressed_suffix_from_filename(
+                relpath)
+        if compr is not None:
+            data = gemato.compression.compress_data(compr, data,
+                    level=compress_level, pool=pool)
+
+        # write the complete file under a temporary name, so that
+        # the Manifest can be replaced atomically
+        fd, tmp_path = gemato.util.create_temporary_file(path)
+        try:
+            with io.open(fd, 'wb') as f:
+                f.write(data)
+        except:
+            os.unlink(tmp_path)
+            raise
+        return tmp_path
 
     def _iter_unordered_manifests_for_path(self, path, recursive=False):
         """
@@ -215,11 +280,18 @@ class ManifestRecursiveLoader(object):
                 key=lambda kdv: len(kdv[1]),
                 reverse=True)
 
-    def load_manifests_for_path(self, path, recursive=False):
+    def load_manifests_for_path(self, path, recursive=False,
+            skip_manifest=None):
         """
         Load all Manifests that may apply to the specified path,
         recursively. If @recursive is True, also loads Manifests
         for all subdirectories of @path.
+
+        If @skip_manifest is not None, it is called for every
+        sub-Manifest before loading it, with the Manifest path
+        and the MANIFEST entry as parameters. If it returns True,
+        the Manifest (and therefore all Manifests below it) is not
+        loaded.
         """
         # TODO: figure out how to avoid confusing uses of 'recursive'
         while True:
@@ -233,9 +305,12 @@ class ManifestRecursiveLoader(object):
                     if curmpath == mpath or mpath in self.loaded_manifests:
                         continue
                     mdir = os.path.dirname(mpath)
-                    if gemato.util.path_starts_with(path, mdir):
-                        to_load.append((mpath, e))
-                    elif recursive and gemato.util.path_starts_with(mdir, path):
+                    if (gemato.util.path_starts_with(path, mdir)
+                            or (recursive
+                                and gemato.util.path_starts_with(mdir, path))):
+                        if (skip_manifest is not None
+                                and skip_manifest(mpath, e)):
+                            continue
                         to_load.append((mpath, e))
             if not to_load:
                 break
@@ -335,7 +410,8 @@ class ManifestRecursiveLoader(object):
                     return e
         return None
 
-    def get_file_entry_dict(self, path='', only_types=None):
+    def get_file_entry_dict(self, path='', only_types=None,
+            skip_manifest=None):
         """
         Find all file entries that apply to paths starting with @path.
         Return a dictionary mapping relative paths to entries. Raises
@@ -344,9 +420,12 @@ class ManifestRecursiveLoader(object):
         If @only_types are specified as a list, only files of specified
         types will be collected. If it is not specified, then all types
         for local files will be processed.
+
+        @skip_manifest is passed to load_manifests_for_path().
         """
 
-        self.load_manifests_for_path(path, recursive=True)
+        self.load_manifests_for_path(path, recursive=True,
+                skip_manifest=skip_manifest)
         out = {}
         for mpath, relpath, m in self._iter_manifests_for_path(path,
                                     recursive=True):
@@ -381,22 +460,43 @@ class ManifestRecursiveLoader(object):
         return out
 
     def _verify_one_file(self, path, relpath, e, fail_handler,
-            last_mtime):
+            last_mtime, rate_limiter=None, state=None, sampler=None,
+            stat_only=False, hash_policy=None):
+        if sampler is not None and e is not None:
+            stat_only = not sampler.should_hash(relpath)
+        ident = None
+        if state is not None and e is not None and e.tag != 'IGNORE':
+            ident = state.get_identity(path)
+            if state.is_verified(relpath, ident):
+                return True
+
         ret, diff = gemato.verify.verify_path(path, e,
                 expected_dev=self.manifest_device,
-                last_mtime=last_mtime)
+                last_mtime=last_mtime,
+                rate_limiter=rate_limiter,
+                stat_only=stat_only,
+                hash_policy=hash_policy)
+        if sampler is not None:
+            sampler.record(relpath, e, not stat_only)
 
         if not ret:
             err = gemato.exceptions.ManifestMismatch(relpath, e, diff)
             ret = fail_handler(err)
             if ret is None:
                 ret = True
+            if state is not None:
+                state.mark_dirty(relpath)
+        elif state is not None and e.tag != 'IGNORE':
+            if not state.record(relpath, ident):
+                state.mark_dirty(relpath)
 
         return ret
 
     def assert_directory_verifies(self, path='',
             fail_handler=gemato.util.throw_exception,
-            last_mtime=None):
+            last_mtime=None, rate_limiter=None, state=None,
+            checkpoint=None, sampler=None, stat_only=False,
+            hash_policy=None):
         """
         Verify the complete directory tree starting at @path (relative
         to top Manifest directory). Includes testing for stray files.
@@ -418,19 +518,93 @@ class ManifestRecursiveLoader(object):
         than that value (in st_mtime format) will be checked. Use this
         option *only* if mtimes can not be manipulated (i.e. do not use
         it with 'rsync --times')!
+
+        If @rate_limiter is not None, it is used to throttle the file
+        I/O (see gemato.ratelimit.RateLimiter). This can be used to run
+        the verification in background without starving other
+        processes.
+
+        If @state is not None, it specifies a VerificationState instance
+        (see gemato.state). Files whose stat identity did not change
+        since their last successful verification with the same
+        Manifests are not hashed again, and newly verified files
+        are recorded in the state. Subtrees whose sub-Manifest,
+        directories and files did not change since they were last
+        verified completely are skipped without loading the Manifests
+        or listing the directories. The caller is responsible for saving
+        the state afterwards.
+
+        If @checkpoint is not None, it specifies a VerificationCheckpoint
+        instance (see gemato.state). The directories are walked in sorted
+        order, and the verification is stopped when the checkpoint's
+        budget runs out. In that case, the position and the results
+        so far are stored in the checkpoint, and checkpoint.complete
+        is False. If the checkpoint matches the tree, the verification
+        resumes from the stored position. The caller is responsible
+        for saving the checkpoint afterwards. It can not be combined
+        with @state.
+
+        If @sampler is not None, it specifies a VerificationSampler
+        instance (see gemato.sampling). Only the files chosen by it
+        are hashed, the remaining files are verified using stat data
+        only. It can not be combined with @state or @checkpoint.
+
+        If @stat_only is True, the files are verified using stat data
+        only (i.e. existence, file type and size), without opening them.
+        The Manifests are still loaded and verified. It can not be
+        combined with @state or @sampler.
+
+        If @hash_policy is not None, it specifies a HashPolicy instance
+        (see gemato.verify) selecting the subset of hashes in every
+        entry that are computed and verified.
         """
 
-        entry_dict = self.get_file_entry_dict(path)
+        assert state is None or checkpoint is None
+        assert sampler is None or (state is None and checkpoint is None)
+        assert not stat_only or (state is None and sampler is None)
+
+        ret = True
+        if checkpoint is not None:
+            if checkpoint.begin(self, path):
+                ret = checkpoint.ret
+
+            orig_fail_handler = fail_handler
+
+            def fail_handler(e):
+                checkpoint.record_failure(e.path)
+                return orig_fail_handler(e)
+
+        if state is not None:
+            state.begin(self, path)
+            entry_dict = self.get_file_entry_dict(path,
+                    skip_manifest=state.skip_manifest)
+            state.update_digests()
+            # the MANIFEST entries for the skipped subtrees
+            for k in list(entry_dict):
+                if state.is_pruned(k):
+                    del entry_dict[k]
+            if state.is_pruned(path):
+                state.finish()
+                return True
+        else:
+            entry_dict = self.get_file_entry_dict(path)
+            if checkpoint is not None:
+                checkpoint.filter_entries(entry_dict)
+        if sampler is not None:
+            sampler.begin(self, entry_dict)
         it = os.walk(os.path.join(self.root_directory, path),
                 onerror=gemato.util.throw_exception,
                 followlinks=True)
-        ret = True
 
         for dirpath, dirnames, filenames in it:
             relpath = os.path.relpath(dirpath, self.root_directory)
             # strip dot to avoid matching problems
             if relpath == '.':
                 relpath = ''
+            if checkpoint is not None:
+                # checkpoints rely on the walk order being stable
+                dirnames.sort()
+                filenames.sort()
 
             skip_dirs = []
             for d in dirnames:
@@ -440,8 +614,15 @@ class ManifestRecursiveLoader(object):
                     continue
 
                 dpath = os.path.join(relpath, d)
+                if checkpoint is not None and checkpoint.is_subtree_done(dpath):
+                    skip_dirs.append(d)
+                    continue
                 de = entry_dict.pop(dpath, None)
                 if de is None:
+                    # skip unchanged subtrees
+                    if state is not None and state.is_pruned(dpath):
+                        skip_dirs.append(d)
+                        continue
                     syspath = os.path.join(dirpath, d)
                     st = os.stat(syspath)
                     if st.st_dev != self.manifest_device:
@@ -452,7 +633,9 @@ class ManifestRecursiveLoader(object):
                     skip_dirs.append(d)
                 else:
                     ret &= self._verify_one_file(os.path.join(dirpath, d),
-                            dpath, de, fail_handler, last_mtime)
+                            dpath, de, fail_handler, last_mtime,
+                            rate_limiter, state, sampler, stat_only,
+                            hash_policy)
 
             # skip scanning ignored directories
             for d in skip_dirs:
@@ -468,28 +651,146 @@ class ManifestRecursiveLoader(object):
                 # an entry for it
                 if fpath == self.top_level_manifest_filename:
                     continue
+                if checkpoint is not None:
+                    if checkpoint.is_file_done(fpath):
+                        continue
+                    if checkpoint.exhausted():
+                        checkpoint.interrupt(entry_dict, ret)
+                        return ret
                 fe = entry_dict.pop(fpath, None)
                 ret &= self._verify_one_file(os.path.join(dirpath, f),
-                        fpath, fe, fail_handler, last_mtime)
+                        fpath, fe, fail_handler, last_mtime,
+                        rate_limiter, state, sampler, stat_only,
+                        hash_policy)
+                if checkpoint is not None:
+                    checkpoint.record(fpath, fe)
+
+            if state is not None:
+                state.record_directory(relpath)
 
         # check for missing files
         for relpath, e in entry_dict.items():
             syspath = os.path.join(self.root_directory, relpath)
             ret &= self._verify_one_file(syspath, relpath, e,
-                            fail_handler, last_mtime)
+                            fail_handler, last_mtime, rate_limiter, state,
+                            sampler, stat_only, hash_policy)
+
+        if state is not None:
+            state.finish()
+        if checkpoint is not None:
+            checkpoint.finish()
+        return ret
+
+    def verify_distfiles(self, distdir,
+            fail_handler=gemato.util.throw_exception,
+            jobs=None, check_missing=True, check_unknown=True,
+            rate_limiter=None, state=None, hash_policy=None):
+        """
+        Verify the distfiles in directory @distdir against the DIST
+        entries in the complete Manifest tree. All Manifests are loaded
+        and the entries are indexed by filename once, then the files
+        present in @distdir are hashed in parallel.
+
+        @fail_handler is called for every failing distfile, with
+        a ManifestMismatch exception object, like
+        in assert_directory_verifies(). The failures are reported
+        in filename order. Returns False if any of the handler calls
+        returned explicit False; True otherwise.
+
+        @jobs specifies the number of files hashed in parallel. If None,
+        the number of CPUs is used.
+
+        If @check_missing is True, distfiles that have DIST entries
+        but are not present in @distdir are reported. If @check_unknown
+        is True, files in @distdir that have no DIST entries are
+        reported. Dotfiles and subdirectories are always skipped.
+
+        @rate_limiter, @state and @hash_policy work like
+        in assert_directory_verifies().
+        The distfiles whose stat identity did not change since they were
+        last verified against the same DIST entry are not hashed again.
+        """
+
+        entry_dict = self.get_file_entry_dict('', only_types=['DIST'])
+        if state is not None:
+            state.begin_distfiles(distdir, entry_dict)
+
+        todo = []
+        for f in os.listdir(distdir):
+            # skip dotfiles
+            if f.startswith('.'):
+                continue
+            e = entry_dict.get(f)
+            if e is None:
+                if not check_unknown:
+                    continue
+                if os.path.isdir(os.path.join(distdir, f)):
+                    continue
+            todo.append((f, e))
+        if check_missing:
+            present = frozenset(f for f, e in todo)
+            for f, e in entry_dict.items():
+                if f not in present:
+                    todo.append((f, e))
+        todo.sort(key=lambda x: x[0])
+
+        def verify_one(item):
+            f, e = item
+            path = os.path.join(distdir, f)
+            ident = None
+            if state is not None and e is not None:
+                ident = state.get_identity(path)
+                if state.is_distfile_verified(f, ident):
+                    return (f, e, True, [], None)
+            ret, diff = gemato.verify.verify_path(path, e,
+                    rate_limiter=rate_limiter,
+                    hash_policy=hash_policy)
+            return (f, e, ret, diff, ident)
+
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        if jobs > 1:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+            results = pool.imap(verify_one, todo)
+        else:
+            pool = None
+            results = (verify_one(x) for x in todo)
 
+        ret = True
+        try:
+            for f, e, fret, diff, ident in results:
+                if not fret:
+                    err = gemato.exceptions.ManifestMismatch(f, e, diff)
+                    fret = fail_handler(err)
+                    if fret is None:
+                        fret = True
+                    ret &= fret
+                elif ident is not None:
+                    state.record_distfile(f, ident)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
         return ret
 
     def save_manifests(self, hashes=None, force=False, sort=None,
-            compress_watermark=None, compress_format=None):
+            compress_watermark=None, compress_format=None,
+            compress_level=None, jobs=None, sync=True):
         """
         Save the Manifests modified since the last save_manifests()
         call.
 
-        @hashes, @sort, @compress_watermark and @compress_format
-        override the value specified in the constructor. If None,
-        the values from the constructor are used. If those were None
-        as well, the defaults are used.
+        The Manifests are committed as a single transaction. All
+        of them are written to temporary files first. The files are
+        synced to disk together (if @sync is True), and then renamed
+        into place, deepest first. Therefore, the top-level Manifest
+        is replaced last, and a crash never leaves it referencing
+        sub-Manifests that were not written completely.
+
+        @hashes, @sort, @compress_watermark, @compress_format
+        and @compress_level override the value specified
+        in the constructor. If None, the values from the constructor
+        are used. If those were None as well, the defaults are used.
 
         @hashes specifies the requested hash set. The effective value
         must be non-null since new entries can be created.
@@ -507,6 +808,11 @@ class ManifestRecursiveLoader(object):
         Manifest files, pass a size of 0.
         
         If @compress_watermark is None, the compression is left as-is.
+
+        @jobs specifies the number of threads used to compress
+        the Manifests. The Manifests in directories of the same depth
+        are compressed concurrently, and large Manifests are
+        compressed in parallel chunks. If None, the CPU count is used.
         """
 
         if hashes is None:
@@ -517,64 +823,130 @@ class ManifestRecursiveLoader(object):
             compress_watermark = self.compress_watermark
         if compress_format is None:
             compress_format = self.compress_format
+        if compress_level is None:
+            compress_level = self.compress_level
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
         if force:
             self.load_manifests_for_path('', recursive=True)
 
-        fixed_manifests = set()
-        renamed_manifests = {}
+        # group Manifests by directory depth, deepest first; Manifests
+        # of the same depth do not reference one another, so they
+        # can be written concurrently
+        waves = {}
         for mpath, relpath, m in self._iter_manifests_for_path('',
                                     recursive=True):
-            for e in m.entries:
-                if e.tag != 'MANIFEST':
-                    continue
+            depth = relpath.count('/') + 1 if relpath else 0
+            waves.setdefault(depth, []).append((mpath, relpath, m))
 
-                fullpath = os.path.join(relpath, e.path)
-                if not force and fullpath not in self.updated_manifests:
-                    assert fullpath not in renamed_manifests
-                    continue
-                if fullpath in renamed_manifests:
-                    fullpath = renamed_manifests[fullpath]
-                    e.path = os.path.relpath(fullpath, relpath)
+        if jobs > 1:
+            pool = multiprocessing.pool.ThreadPool(jobs)
+        else:
+            pool = None
 
-                gemato.verify.update_entry_for_path(
-                    os.path.join(self.root_directory, fullpath),
-                    e,
-                    hashes=hashes,
-                    expected_dev=self.manifest_device)
+        fixed_manifests = set()
+        renamed_manifests = {}
+        # relpath -> temporary file, in commit order
+        pending = collections.OrderedDict()
+        to_unlink = []
+        try:
+            for depth in sorted(waves, reverse=True):
+                to_save = []
+                for mpath, relpath, m in waves[depth]:
+                    for e in m.entries:
+                        if e.tag != 'MANIFEST':
+                            continue
 
-                # do not remove it from self.updated_manifests
-                # immediately as we may have to deal with multiple
-                # entries
-                fixed_manifests.add(fullpath)
-                self.updated_manifests.add(mpath)
+                        fullpath = os.path.join(relpath, e.path)
+                        if (not force
+                                and fullpath not in self.updated_manifests):
+                            assert fullpath not in renamed_manifests
+                            continue
+                        if fullpath in renamed_manifests:
+                            fullpath = renamed_manifests[fullpath]
+                            e.path = os.path.relpath(fullpath, relpath)
 
-            # we've apparently modified this Manifest, so store it now
-            if force or mpath in self.updated_manifests:
-                unc_size = self.save_manifest(mpath, sort=sort)
-                # let's see if we want to recompress it
-                if compress_watermark is not None:
-                    compr = (gemato.compression
-                            .get_compressed_suffix_from_filename(mpath))
-                    is_compr = compr is not None
-                    want_compr = self.profile.want_compressed_manifest(
-                            mpath, m, unc_size, compress_watermark)
-                    if want_compr is not None and is_compr != want_compr:
-                        if want_compr:
-                            # compress it!
-                            new_mpath = mpath + '.' + compress_format
+                        # the new Manifest is not committed yet
+                        if fullpath in pending:
+                            path = pending[fullpath]
                         else:
-                            new_mpath = mpath[:-len(compr)-1]
+                            path = os.path.join(self.root_directory,
+                                    fullpath)
+                        gemato.verify.update_entry_for_path(
+                            path,
+                            e,
+                            hashes=hashes,
+                            expected_dev=self.manifest_device)
 
-                        # do the rename!
-                        self.loaded_manifests[new_mpath] = m
-                        self.save_manifest(new_mpath)
-                        del self.loaded_manifests[mpath]
-                        os.unlink(os.path.join(self.root_directory,
-                            mpath))
-                        renamed_manifests[mpath] = new_mpath
+                        # do not remove it from self.updated_manifests
+                        # immediately as we may have to deal with
+                        # multiple entries
+                        fixed_manifests.add(fullpath)
+                        self.updated_manifests.add(mpath)
 
-                        if mpath == self.top_level_manifest_filename:
-                            self.top_level_manifest_filename = new_mpath
+                    # we've apparently modified this Manifest, so store
+                    # it now
+                    if not force and mpath not in self.updated_manifests:
+                        continue
+                    data = self._serialize_manifest(mpath, sort=sort)
+
+                    # let's see if we want to recompress it; decide
+                    # before writing, so that it is written only once
+                    if compress_watermark is not None:
+                        compr = (gemato.compression
+                                .get_compressed_suffix_from_filename(mpath))
+                        is_compr = compr is not None
+                        want_compr = self.profile.want_compressed_manifest(
+                                mpath, m, len(data), compress_watermark)
+                        if want_compr is not None and is_compr != want_compr:
+                            if want_compr:
+                                # compress it!
+                                new_mpath = mpath + '.' + compress_format
+                            else:
+                                new_mpath = mpath[:-len(compr)-1]
+
+                            # do the rename!
+                            self.loaded_manifests[new_mpath] = m
+                            del self.loaded_manifests[mpath]
+                            renamed_manifests[mpath] = new_mpath
+                            to_unlink.append(mpath)
+
+                            if mpath == self.top_level_manifest_filename:
+                                self.top_level_manifest_filename = new_mpath
+                            mpath = new_mpath
+
+                    to_save.append((mpath, m, data))
+
+                pending.update(self._write_manifests(to_save,
+                    compress_level, pool))
+
+            if sync:
+                gemato.util.sync_files(pending.values(), pool=pool)
+        except:
+            for tmp_path in pending.values():
+                os.unlink(tmp_path)
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # commit the Manifests bottom-up
+        dirs = set()
+        for mpath, tmp_path in pending.items():
+            path = os.path.join(self.root_directory, mpath)
+            os.rename(tmp_path, path)
+            dirs.add(os.path.dirname(path))
+        # remove the old files only after the new ones
+        # are in place (new Manifests may not exist at all)
+        for mpath in to_unlink:
+            try:
+                os.unlink(os.path.join(self.root_directory, mpath))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        if sync:
+            gemato.util.sync_directories(dirs)
 
         # now, discard all the Manifests whose entries we've updated
         self.updated_manifests -= fixed_manifests
@@ -587,6 +959,43 @@ class ManifestRecursiveLoader(object):
                 "Unlinked but updated Manifests: {}".format(
                     self.updated_manifests))
 
+    def _write_manifests(self, manifests, compress_level, pool):
+        """
+        Write a batch of serialized Manifests @manifests, a list
+        of (relpath, manifest, data) tuples, into temporary files.
+        If @pool is not None, the large Manifests are compressed
+        in parallel chunks, and the remaining Manifests are written
+        concurrently.
+
+        Returns a list of (relpath, temporary path) tuples.
+        """
+
+        ret = []
+        small = []
+        try:
+            for mpath, m, data in manifests:
+                if pool is not None and len(data) <= (gemato.compression
+                        .GZIP_CHUNK_SIZE):
+                    small.append((mpath, data))
+                else:
+                    ret.append((mpath, self._write_manifest_data(mpath,
+                        data, compress_level=compress_level, pool=pool)))
+
+            def write_one(mpath_data):
+                return (mpath_data[0],
+                        self._write_manifest_data(mpath_data[0],
+                            mpath_data[1], compress_level=compress_level))
+
+            if len(small) > 1:
+                ret.extend(pool.map(write_one, small))
+            elif small:
+                ret.append(write_one(small[0]))
+        except:
+            for mpath, tmp_path in ret:
+                os.unlink(tmp_path)
+            raise
+        return ret
+
     def update_entry_for_path(self, path, new_entry_type='DATA',
             hashes=None):
         """
@@ -752,7 +1161,7 @@ class ManifestRecursiveLoader(object):
 
         return out
 
-    def load_unregistered_manifests(self, path=''):
+    def load_unregistered_manifests(self, path='', dir_state=None):
         """
         Scan the directory @path (relative to top directory)
         for unregistered (not listed in MANIFEST entries) Manifest
@@ -763,6 +1172,10 @@ class ManifestRecursiveLoader(object):
         integrity. Note that the list may contain files that are
         referenced within added Manifests, so the list should
         be verified with regards to existing entries.
+
+        If @dir_state is not None, it specifies a started
+        DirectoryMtimeState instance (see gemato.state). Directories
+        that are clean according to it are not scanned.
         """
 
         manifest_filenames = (gemato.compression
@@ -791,6 +1204,10 @@ class ManifestRecursiveLoader(object):
                 dpath = os.path.join(relpath, d)
                 de = entry_dict.pop(dpath, None)
                 if de is None:
+                    # skip unchanged subtrees
+                    if dir_state is not None and dir_state.is_clean(dpath):
+                        skip_dirs.append(d)
+                        continue
                     syspath = os.path.join(dirpath, d)
                     st = os.stat(syspath)
                     if st.st_dev != self.manifest_device:
@@ -825,7 +1242,7 @@ class ManifestRecursiveLoader(object):
 
 
     def update_entries_for_directory(self, path='', hashes=None,
-            last_mtime=None):
+            last_mtime=None, dir_state=None):
         """
         Update the Manifest entries for the contents of directory
         @path (top directory by default), recursively. Includes adding
@@ -848,6 +1265,14 @@ class ManifestRecursiveLoader(object):
         option *only* if you can rely on mtimes being bumped
         monotonically on modified files. Afterwards, the value
         of @last_mtime should be put into the TIMESTAMP entry.
+
+        If @dir_state is not None, it specifies a DirectoryMtimeState
+        instance (see gemato.state). Together with @last_mtime, it is
+        used to skip scanning the subtrees whose directory and Manifest
+        mtimes are not newer than @last_mtime. The list of directories
+        in the state is updated. Use this option *only* if files are
+        always replaced rather than modified in place. The caller
+        is responsible for saving the state afterwards.
         """
 
         if hashes is None:
@@ -857,7 +1282,10 @@ class ManifestRecursiveLoader(object):
         manifest_filenames = (gemato.compression
                 .get_potential_compressed_names('Manifest'))
 
-        new_manifests = self.load_unregistered_manifests(path)
+        if dir_state is not None:
+            dir_state.begin(self.root_directory, path, last_mtime)
+        new_manifests = self.load_unregistered_manifests(path,
+                dir_state=dir_state)
         entry_dict = self.get_deduplicated_file_entry_dict_for_update(
                 path)
         manifest_stack = []
@@ -869,6 +1297,7 @@ class ManifestRecursiveLoader(object):
         it = os.walk(os.path.join(self.root_directory, path),
                 onerror=gemato.util.throw_exception,
                 followlinks=True)
+        pruned_dirs = set()
 
         for dirpath, dirnames, filenames in it:
             relpath = os.path.relpath(dirpath, self.root_directory)
@@ -881,6 +1310,9 @@ class ManifestRecursiveLoader(object):
                     manifest_stack[-1][1]):
                 manifest_stack.pop()
 
+            if dir_state is not None:
+                dir_state.record(relpath, filenames)
+
             want_manifest = self.profile.want_manifest_in_directory(
                     relpath, dirnames, filenames)
 
@@ -894,6 +1326,11 @@ class ManifestRecursiveLoader(object):
                 dpath = os.path.join(relpath, d)
                 mpath, de = entry_dict.pop(dpath, (None, None))
                 if de is None:
+                    # skip unchanged subtrees
+                    if dir_state is not None and dir_state.is_clean(dpath):
+                        skip_dirs.append(d)
+                        pruned_dirs.add(dpath)
+                        continue
                     syspath = os.path.join(dirpath, d)
                     st = os.stat(syspath)
                     if st.st_dev != self.manifest_device:
@@ -1010,10 +1447,217 @@ class ManifestRecursiveLoader(object):
             mpath, fe = me
             if fe.tag == 'IGNORE':
                 continue
+            if pruned_dirs:
+                # files in skipped subtrees are still there
+                d = os.path.dirname(relpath)
+                while d != '' and d not in pruned_dirs:
+                    d = os.path.dirname(d)
+                if d in pruned_dirs:
+                    continue
 
             self.loaded_manifests[mpath].entries.remove(fe)
             self.updated_manifests.add(mpath)
 
+        if dir_state is not None:
+            dir_state.finish()
+
+    def _is_path_ignored(self, path):
+        """
+        Check whether @path is covered by an IGNORE entry in one
+        of the loaded Manifests.
+        """
+
+        for mpath, relpath, m in self._iter_manifests_for_path(path):
+            for e in m.entries:
+                if e.tag != 'IGNORE':
+                    continue
+                if gemato.util.path_starts_with(path,
+                        os.path.join(relpath, e.path)):
+                    return True
+        return False
+
+    def _remove_entries_for_removed_path(self, path):
+        """
+        Remove all entries for the files at @path and underneath it,
+        and discard the Manifests that were located there. IGNORE
+        entries are preserved.
+        """
+
+        for mpath in list(self.loaded_manifests):
+            if gemato.util.path_starts_with(mpath, path):
+                del self.loaded_manifests[mpath]
+                self.updated_manifests.discard(mpath)
+
+        for mpath, relpath, m in self._iter_manifests_for_path(
+                                    os.path.dirname(path)):
+            entries_to_remove = []
+            for e in m.entries:
+                if e.tag in ('DIST', 'TIMESTAMP', 'IGNORE'):
+                    continue
+                if gemato.util.path_starts_with(
+                        os.path.join(relpath, e.path), path):
+                    entries_to_remove.append(e)
+
+            if entries_to_remove:
+                for e in entries_to_remove:
+                    m.entries.remove(e)
+                self.updated_manifests.add(mpath)
+
+    def update_entries_for_paths(self, paths, hashes=None):
+        """
+        Update the Manifest entries for the specified list of changed
+        @paths (relative to the top directory), e.g. obtained from VCS
+        or rsync. This is equivalent to update_entries_for_directory()
+        on the whole tree as long as all changed paths are listed,
+        but only the Manifests relevant to the listed paths are loaded
+        and only the listed files are hashed. You need to invoke
+        save_manifests() to store the Manifest updates afterwards.
+
+        Paths that do not exist anymore have their entries removed,
+        along with the entries for all files underneath them (if they
+        were directories). New files are added using the entry type
+        determined by the profile, new (or modified) sub-Manifests
+        are loaded without verifying them against the old entries,
+        and new directories get new Manifests if the profile requires
+        them. Existing directories listed are updated recursively
+        via update_entries_for_directory().
+
+        Dotfiles and paths covered by IGNORE entries are skipped.
+
+        @hashes override the value specified in the constructor.
+        If None, the values from the constructor are used. If those were
+        None as well, the defaults are used.
+
+        @hashes specifies the requested hash set. The effective value
+        must be non-null since new entries can be created.
+        """
+
+        if hashes is None:
+            hashes = self.hashes
+        assert hashes is not None
+
+        manifest_filenames = (gemato.compression
+                .get_potential_compressed_names('Manifest'))
+
+        norm_paths = set()
+        for path in paths:
+            path = os.path.normpath(path)
+            if path == '.':
+                path = ''
+            # skip dotfiles
+            if any(x.startswith('.') for x in path.split('/')):
+                continue
+            if path == self.top_level_manifest_filename:
+                continue
+            norm_paths.add(path)
+
+        # load the changed sub-Manifests first, so that they are not
+        # verified against their old entries; start with the top-most
+        # ones since the entries for deeper ones can be inside them
+        for path in sorted(norm_paths, key=lambda x: x.count('/')):
+            if (os.path.basename(path) not in manifest_filenames
+                    or path in self.loaded_manifests
+                    or not os.path.isfile(os.path.join(
+                        self.root_directory, path))):
+                continue
+            self.load_manifests_for_path(
+                    os.path.dirname(os.path.dirname(path)))
+            if self._is_path_ignored(path):
+                continue
+            try:
+                self.load_manifest(path)
+            except gemato.exceptions.ManifestSyntaxError:
+                # syntax error? probably not a Manifest then.
+                pass
+
+        # directories that were updated or removed completely
+        done_dirs = set()
+        # directories that were checked for missing Manifests
+        checked_dirs = set()
+        for path in sorted(norm_paths):
+            d = path
+            while d != '' and d not in done_dirs:
+                d = os.path.dirname(d)
+            if d in done_dirs:
+                continue
+
+            syspath = os.path.join(self.root_directory, path)
+            if not os.path.exists(syspath):
+                # find the top-most removed directory
+                while path != '':
+                    parent = os.path.dirname(path)
+                    if parent == '' or os.path.exists(
+                            os.path.join(self.root_directory, parent)):
+                        break
+                    path = parent
+                if path in done_dirs:
+                    continue
+                self.load_manifests_for_path(os.path.dirname(path))
+                if not self._is_path_ignored(path):
+                    self._remove_entries_for_removed_path(path)
+                done_dirs.add(path)
+                continue
+
+            self.load_manifests_for_path(path)
+            if self._is_path_ignored(path):
+                continue
+
+            if os.path.isdir(syspath):
+                self.update_entries_for_directory(path, hashes=hashes)
+                done_dirs.add(path)
+                continue
+
+            # check whether the file is in a new directory that needs
+            # to have its own Manifest
+            for mpath, mdirpath, m in self._iter_manifests_for_path(path):
+                break
+            new_dir = None
+            dirs = []
+            d = os.path.dirname(path)
+            while d != mdirpath:
+                dirs.insert(0, d)
+                d = os.path.dirname(d)
+            for d in dirs:
+                if d in checked_dirs:
+                    continue
+                checked_dirs.add(d)
+                dirnames = []
+                filenames = []
+                for f in os.listdir(os.path.join(self.root_directory, d)):
+                    if os.path.isdir(os.path.join(self.root_directory,
+                                                  d, f)):
+                        dirnames.append(f)
+                    else:
+                        filenames.append(f)
+                if self.profile.want_manifest_in_directory(d, dirnames,
+                        filenames):
+                    new_dir = d
+                    break
+            if new_dir is not None:
+                self.update_entries_for_directory(new_dir, hashes=hashes)
+                done_dirs.add(new_dir)
+                continue
+
+            if path in self.loaded_manifests:
+                parents = [(relpath, m) for mpath, relpath, m
+                        in self._iter_manifests_for_path(path)
+                        if mpath != path]
+                for relpath, m in parents:
+                    if any(e.tag == 'MANIFEST'
+                            and os.path.join(relpath, e.path) == path
+                            for e in m.entries):
+                        break
+                else:
+                    # new Manifest, add the entry to the parent Manifest
+                    relpath, m = parents[0]
+                    m.entries.append(gemato.manifest.ManifestEntryMANIFEST(
+                            os.path.relpath(path, relpath), 0, {}))
+                self.update_entry_for_path(path, hashes=hashes)
+            else:
+                self.update_entry_for_path(path,
+                        self.profile.get_entry_type_for_path(path),
+                        hashes=hashes)
+
     def create_manifest(self, path):
         """
         Create a new empty sub-Manifest instance at relative path @path.
@@ -0,0 +1,111 @@
+# gemato: Statistical sampling verification
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import math
+import os.path
+import random
+
+import gemato.util
+
+
+class VerificationSampler(object):
+    """
+    Sampler for quick verification of Manifest trees. The Manifests
+    are verified completely, and the existence, type and size
+    of every file is verified, but only a random sample of the files
+    is hashed.
+
+    The sample is stratified by Manifest, i.e. the same fraction
+    of files is sampled from the files covered by every Manifest
+    (and at least one file from each of them). The sub-Manifests
+    are always hashed.
+
+    The statistics of the verification are collected
+    in files_total, files_hashed, bytes_total and bytes_hashed.
+    """
+
+    __slots__ = [
+        'rate',
+        'random',
+        'sampled',
+        'files_total',
+        'files_hashed',
+        'bytes_total',
+        'bytes_hashed',
+    ]
+
+    def __init__(self, rate, seed=None):
+        """
+        Create a new sampler hashing @rate (0 < rate <= 1) of the files.
+        If @seed is not None, it is used to seed the random number
+        generator, to obtain reproducible samples.
+        """
+
+        assert 0 < rate <= 1
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.sampled = frozenset()
+        self.files_total = 0
+        self.files_hashed = 0
+        self.bytes_total = 0
+        self.bytes_hashed = 0
+
+    def begin(self, loader, entry_dict):
+        """
+        Choose the sample of files to hash from @entry_dict, the dict
+        of entries to verify, according to the Manifests loaded
+        in @loader.
+        """
+
+        mdirs = sorted((os.path.dirname(p) for p in loader.loaded_manifests),
+                key=len, reverse=True)
+        strata = {}
+        sampled = set()
+        for relpath, e in entry_dict.items():
+            if e.tag == 'IGNORE':
+                continue
+            if e.tag == 'MANIFEST':
+                sampled.add(relpath)
+                continue
+            for d in mdirs:
+                if gemato.util.path_starts_with(relpath, d):
+                    break
+            strata.setdefault(d, []).append(relpath)
+
+        for d, paths in sorted(strata.items()):
+            paths.sort()
+            k = int(math.ceil(self.rate * len(paths)))
+            sampled.update(self.random.sample(paths, k))
+        self.sampled = frozenset(sampled)
+
+    def should_hash(self, relpath):
+        """
+        Check whether the file at @relpath should be hashed.
+        """
+        return relpath in self.sampled
+
+    def record(self, relpath, e, hashed):
+        """
+        Record the verification of file @relpath against entry @e.
+        @hashed indicates whether the file was hashed.
+        """
+
+        if e is None or e.tag == 'IGNORE':
+            return
+        self.files_total += 1
+        self.bytes_total += e.size
+        if hashed:
+            self.files_hashed += 1
+            self.bytes_hashed += e.size
+
+    @property
+    def coverage(self):
+        """
+        The fraction of data (by size) that was hashed.
+        """
+
+        if self.bytes_total == 0:
+            return 1.0
+        return float(self.bytes_hashed) / self.bytes_total
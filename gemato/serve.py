@@ -0,0 +1,421 @@
+# gemato: Verification daemon
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import errno
+import logging
+import os
+import os.path
+import select
+import socket
+import stat
+import threading
+
+import gemato.compression
+import gemato.exceptions
+import gemato.inotify
+import gemato.recursiveloader
+import gemato.util
+import gemato.verify
+
+
+# exceptions that indicate that a subtree fails to verify
+VERIFICATION_ERRORS = (
+    gemato.exceptions.GematoException,
+    IOError,
+    OSError,
+)
+
+# time to wait for more events before verifying the changed files
+DEFAULT_SETTLE_TIME = 0.2
+
+
+class TreeMonitor(object):
+    """
+    A resident verification state of a Manifest tree. The Manifests
+    are kept loaded, and the paths that were reported to change
+    are verified again in the background.
+
+    The public methods are thread-safe.
+    """
+
+    __slots__ = ['top_manifest_path', 'loader_kwargs', 'loader',
+            'root_directory', 'manifest_filenames', 'cond', 'dirty',
+            'failures', 'busy', 'complete', 'stopped']
+
+    def __init__(self, top_manifest_path, **loader_kwargs):
+        """
+        Create a monitor for the tree with top-level Manifest
+        at @top_manifest_path. @loader_kwargs are passed
+        to ManifestRecursiveLoader. The tree is considered unverified
+        until run() (or process_pending()) verifies it.
+        """
+
+        self.top_manifest_path = top_manifest_path
+        self.loader_kwargs = loader_kwargs
+        self.loader = None
+        self.root_directory = os.path.dirname(top_manifest_path)
+        self.manifest_filenames = (gemato.compression
+                .get_potential_compressed_names('Manifest'))
+        self.cond = threading.Condition()
+        # paths (relative to top directory) that need verification
+        self.dirty = set([''])
+        # paths currently being verified
+        self.busy = set()
+        # mapping of failed paths to error messages
+        self.failures = {}
+        self.complete = False
+        self.stopped = False
+
+    def mark_dirty(self, paths):
+        """
+        Queue the specified @paths (relative to the top directory)
+        for verification.
+        """
+
+        with self.cond:
+            for p in paths:
+                # skip dotfiles
+                if any(x.startswith('.') for x in p.split('/')):
+                    continue
+                self.dirty.add(p)
+            self.cond.notify_all()
+
+    def _drop_manifests(self, path):
+        """
+        Drop the loaded Manifests in the directory @path and below,
+        so that they are reloaded when needed.
+        """
+
+        if path == '':
+            self.loader = None
+            return
+        for k in list(self.loader.loaded_manifests):
+            if gemato.util.path_starts_with(k, path):
+                del self.loader.loaded_manifests[k]
+
+    def _verify_path(self, path):
+        """
+        Verify @path. Returns a dict mapping failed paths to error
+        messages.
+        """
+
+        failures = {}
+
+        def fail_handler(e):
+            failures[e.path] = str(e)
+
+        try:
+            if self.loader is None:
+                self.loader = gemato.recursiveloader.ManifestRecursiveLoader(
+                        self.top_manifest_path, **self.loader_kwargs)
+
+            syspath = os.path.join(self.root_directory, path)
+            if os.path.isdir(syspath):
+                self.loader.assert_directory_verifies(path,
+                        fail_handler=fail_handler)
+                return failures
+
+            e = self.loader.find_path_entry(path)
+            if e is not None and e.tag == 'IGNORE':
+                return failures
+            entries = self.loader.get_file_entry_dict(path)
+            # check for stray file
+            if path not in entries and os.path.lexists(syspath):
+                entries[path] = None
+            for p, e in entries.items():
+                ret, diff = gemato.verify.verify_path(
+                        os.path.join(self.root_directory, p), e,
+                        expected_dev=self.loader.manifest_device)
+                if not ret:
+                    fail_handler(
+                            gemato.exceptions.ManifestMismatch(p, e, diff))
+        except gemato.exceptions.ManifestMismatch as e:
+            # sub-Manifest failed to load
+            failures[e.path] = str(e)
+        except VERIFICATION_ERRORS as e:
+            failures[path] = str(e)
+        return failures
+
+    def process_pending(self):
+        """
+        Verify all the paths queued for verification. Returns True
+        if any paths were processed.
+        """
+
+        with self.cond:
+            if not self.dirty:
+                return False
+            paths = self.dirty
+            self.dirty = set()
+            # Manifest changes require verifying the whole directory
+            # covered by them
+            for p in list(paths):
+                if os.path.basename(p) in self.manifest_filenames:
+                    paths.add(os.path.dirname(p))
+            self.busy = paths
+
+        try:
+            for p in sorted(paths):
+                if (os.path.basename(p) in self.manifest_filenames
+                        and self.loader is not None):
+                    self._drop_manifests(os.path.dirname(p))
+
+            for p in sorted(paths):
+                # skip paths inside other queued directories
+                d = p
+                covered = False
+                while d != '' and not covered:
+                    d = os.path.dirname(d)
+                    covered = d in paths
+                if covered:
+                    continue
+
+                logging.debug('Verifying {}'.format(p or '.'))
+                failures = self._verify_path(p)
+                with self.cond:
+                    for k in list(self.failures):
+                        if gemato.util.path_starts_with(k, p):
+                            del self.failures[k]
+                    self.failures.update(failures)
+        finally:
+            with self.cond:
+                self.busy = set()
+                if '' in paths:
+                    self.complete = True
+                self.cond.notify_all()
+        return True
+
+    def _is_pending(self, path):
+        if not self.complete:
+            return True
+        for p in self.dirty | self.busy:
+            if (gemato.util.path_starts_with(p, path)
+                    or gemato.util.path_starts_with(path, p)):
+                return True
+        return False
+
+    def _get_result(self, path):
+        fails = sorted(k for k in self.failures
+                if gemato.util.path_starts_with(k, path))
+        return ('FAIL' if fails else 'OK', fails)
+
+    def query(self, path):
+        """
+        Get the verification status of @path (relative to the top
+        directory). Returns a tuple of (status, failed_paths), where
+        status is one of 'OK', 'FAIL' and 'PENDING' (if the path
+        is not verified yet).
+        """
+
+        with self.cond:
+            if self._is_pending(path):
+                return ('PENDING', [])
+            return self._get_result(path)
+
+    def verify(self, path, timeout=None):
+        """
+        Wait for @path to be verified, and return the result
+        like query(). If @timeout is not None, 'PENDING' status
+        can be returned if it expires.
+        """
+
+        with self.cond:
+            while self._is_pending(path) and not self.stopped:
+                self.cond.wait(timeout)
+                if timeout is not None and self._is_pending(path):
+                    return ('PENDING', [])
+            if self._is_pending(path):
+                # verification loop stopped before reaching the path
+                return ('PENDING', [])
+            return self._get_result(path)
+
+    def run(self, settle_time=DEFAULT_SETTLE_TIME):
+        """
+        Run the background verification loop until stop() is called.
+        @settle_time specifies the time to wait for further changes
+        before verifying the paths.
+        """
+
+        try:
+            while True:
+                with self.cond:
+                    while not self.dirty and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                    self.cond.wait(settle_time)
+                self.process_pending()
+        finally:
+            # wake up the waiters even if verification crashed
+            with self.cond:
+                self.stopped = True
+                self.cond.notify_all()
+
+    def stop(self):
+        """
+        Stop the background verification loop.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+def handle_request(monitor, request):
+    """
+    Handle a single @request line for @monitor. The request has form
+    of '<command> <path>', where command is 'status' (return
+    the current state) or 'verify' (wait for verification), and path
+    is an absolute path inside the tree. Returns the response text.
+
+    The first line of the response is 'OK', 'FAIL', 'PENDING'
+    or 'ERROR <message>'. 'FAIL' is followed by the failed paths
+    (relative to the top directory), one per line.
+    """
+
+    command, sep, path = request.rstrip('\n').partition(' ')
+    if command not in ('status', 'verify') or not path:
+        return 'ERROR Invalid request\n'
+
+    relpath = os.path.relpath(os.path.realpath(path),
+            os.path.realpath(monitor.root_directory))
+    if relpath == '.':
+        relpath = ''
+    if relpath == '..' or relpath.startswith('../'):
+        return 'ERROR Path outside the tree: {}\n'.format(path)
+
+    if command == 'status':
+        status, fails = monitor.query(relpath)
+    else:
+        status, fails = monitor.verify(relpath)
+    return ''.join(l + '\n' for l in [status] + fails)
+
+
+def remove_socket(path):
+    """
+    Remove the stale UNIX socket at @path, if present. Raises OSError
+    if @path exists and is not a socket.
+    """
+
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError(errno.EEXIST,
+                'Refusing to remove non-socket file', path)
+    os.unlink(path)
+
+
+class VerificationServer(object):
+    """
+    A server watching a Manifest tree for changes, and answering
+    verification queries on a UNIX socket.
+    """
+
+    __slots__ = ['monitor', 'socket_path', 'sock', 'watcher',
+            'threads', 'stop_r', 'stop_w']
+
+    def __init__(self, top_manifest_path, socket_path, **loader_kwargs):
+        """
+        Create a server for the tree with top-level Manifest
+        at @top_manifest_path, listening on UNIX socket @socket_path.
+        @loader_kwargs are passed to ManifestRecursiveLoader.
+        """
+
+        self.monitor = TreeMonitor(top_manifest_path, **loader_kwargs)
+        self.socket_path = socket_path
+        self.sock = None
+        self.watcher = None
+        self.threads = []
+        self.stop_r, self.stop_w = os.pipe()
+
+    def _handle_client(self, conn):
+        try:
+            f = conn.makefile('rb')
+            try:
+                request = f.readline().decode('utf8')
+            finally:
+                f.close()
+            conn.sendall(handle_request(self.monitor,
+                request).encode('utf8'))
+        except socket.error as e:
+            logging.warning('Client error: {}'.format(e))
+        finally:
+            conn.close()
+
+    def _start_thread(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        return t
+
+    def serve_forever(self):
+        """
+        Start watching the tree and serving requests until stop()
+        is called. Raises OSError if inotify is not supported.
+        """
+
+        self.watcher = gemato.inotify.InotifyWatcher(
+                self.monitor.root_directory)
+        try:
+            remove_socket(self.socket_path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.socket_path)
+            self.sock.listen(16)
+
+            worker = self._start_thread(self.monitor.run)
+            while True:
+                rl, wl, xl = select.select(
+                        [self.watcher, self.sock, self.stop_r], [], [])
+                if self.stop_r in rl:
+                    break
+                if self.watcher in rl:
+                    self.monitor.mark_dirty(self.watcher.read_events())
+                if self.sock in rl:
+                    conn, addr = self.sock.accept()
+                    self._start_thread(self._handle_client, conn)
+            self.monitor.stop()
+            worker.join()
+        finally:
+            self.watcher.close()
+            if self.sock is not None:
+                self.sock.close()
+                remove_socket(self.socket_path)
+
+    def stop(self):
+        """
+        Stop the server. Can be called from another thread or a signal
+        handler.
+        """
+        os.write(self.stop_w, b'x')
+
+
+def query(socket_path, command, path):
+    """
+    Query the verification server at UNIX socket @socket_path.
+    @command is 'status' or 'verify', and @path is the path to query
+    (it will be made absolute). Returns a tuple of (status,
+    failed_paths).
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall('{} {}\n'.format(command,
+            os.path.abspath(path)).encode('utf8'))
+        sock.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            buf = sock.recv(4096)
+            if not buf:
+                break
+            data.append(buf)
+    finally:
+        sock.close()
+
+    lines = b''.join(data).decode('utf8').splitlines()
+    return (lines[0], lines[1:])
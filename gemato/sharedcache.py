@@ -0,0 +1,253 @@
+# gemato: Shared (mmap-backed) Manifest cache
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+import gemato.exceptions
+import gemato.hash
+import gemato.manifest
+
+
+CACHE_MAGIC = b'GEMATOC\0'
+CACHE_VERSION = 1
+FLAG_OPENPGP_SIGNED = 1
+
+# magic, version, flags, top-level Manifest SHA512 (hex),
+# top-level Manifest filename (offset, length),
+# (record count, index offset) for paths, IGNOREs and DISTs
+HEADER = struct.Struct('<8sII128sIIIIIIII')
+# key offset, key length, value offset, value length, order
+INDEX_RECORD = struct.Struct('<IIIII')
+
+SECTION_PATHS = 0
+SECTION_IGNORES = 1
+SECTION_DISTS = 2
+
+
+def _get_top_manifest_digest(path):
+    return gemato.hash.hash_path(path, ['sha512'])['sha512']
+
+
+class SharedManifestCache(object):
+    """
+    A read-only, compact encoding of a complete Manifest tree that
+    is stored in a file and mapped into memory. The file can be written
+    once (e.g. to /dev/shm) using publish() and then used by multiple
+    processes concurrently, without loading and parsing the Manifests.
+    The memory is shared between all the processes using it.
+
+    The entries are stored in sorted tables, and looked up using
+    binary search. The entry objects are created on lookup.
+    """
+
+    __slots__ = ['path', 'f', 'buf', 'openpgp_signed',
+            'top_level_manifest_filename', 'sections']
+
+    @staticmethod
+    def publish(loader, path):
+        """
+        Load all Manifests in ManifestRecursiveLoader @loader,
+        and write the cache to file @path. The file is replaced
+        atomically, so processes that are using the old version
+        can continue doing so.
+        """
+
+        loader.load_manifests_for_path('', recursive=True)
+
+        tables = ({}, {}, {})
+        order = 0
+        # process the Manifests in the same order
+        # as ManifestRecursiveLoader, so that the same entries win
+        for mpath, m in sorted(loader.loaded_manifests.items(),
+                key=lambda kv: len(os.path.dirname(kv[0])),
+                reverse=True):
+            relpath = os.path.dirname(mpath)
+            for e in m.entries:
+                order += 1
+                if e.tag == 'TIMESTAMP':
+                    continue
+                if e.tag == 'DIST':
+                    section = SECTION_DISTS
+                    key = relpath + '\0' + e.path
+                else:
+                    if e.tag == 'IGNORE':
+                        section = SECTION_IGNORES
+                    else:
+                        section = SECTION_PATHS
+                    key = os.path.join(relpath, e.path)
+                tables[section].setdefault(key.encode('utf8'),
+                        (order, ' '.join(e.to_list()).encode('utf8')))
+
+        blob = io.BytesIO()
+        index = io.BytesIO()
+        index_start = HEADER.size
+        index_size = INDEX_RECORD.size * sum(len(t) for t in tables)
+        blob_start = index_start + index_size
+
+        def add_blob(data):
+            off = blob_start + blob.tell()
+            blob.write(data)
+            return off
+
+        section_data = []
+        for t in tables:
+            section_data.append((len(t), index_start + index.tell()))
+            for k in sorted(t):
+                order, v = t[k]
+                index.write(INDEX_RECORD.pack(add_blob(k), len(k),
+                    add_blob(v), len(v), order))
+
+        tlm = loader.top_level_manifest_filename.encode('utf8')
+        tlm_off = add_blob(tlm)
+        header = HEADER.pack(CACHE_MAGIC, CACHE_VERSION,
+                FLAG_OPENPGP_SIGNED if loader.openpgp_signed else 0,
+                _get_top_manifest_digest(os.path.join(
+                    loader.root_directory,
+                    loader.top_level_manifest_filename)).encode('ascii'),
+                tlm_off, len(tlm),
+                *[x for s in section_data for x in s])
+
+        fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)),
+                prefix='.' + os.path.basename(path) + '.')
+        try:
+            with io.open(fd, 'wb') as f:
+                f.write(header)
+                f.write(index.getvalue())
+                f.write(blob.getvalue())
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def __init__(self, path, top_manifest_path=None):
+        """
+        Attach to the cache stored in file @path. If @top_manifest_path
+        is not None, the cache is verified to match the top-level
+        Manifest at that path.
+
+        Raises ManifestCacheInvalid if the file is not a valid cache,
+        or if it does not match the Manifest.
+        """
+
+        self.path = path
+        self.f = io.open(path, 'rb')
+        try:
+            try:
+                self.buf = mmap.mmap(self.f.fileno(), 0,
+                        access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise gemato.exceptions.ManifestCacheInvalid(path,
+                        'not a Manifest cache')
+            if (len(self.buf) < HEADER.size
+                    or self.buf[:len(CACHE_MAGIC)] != CACHE_MAGIC):
+                raise gemato.exceptions.ManifestCacheInvalid(path,
+                        'not a Manifest cache')
+
+            header = HEADER.unpack_from(self.buf, 0)
+            if header[1] != CACHE_VERSION:
+                raise gemato.exceptions.ManifestCacheInvalid(path,
+                        'unsupported version {}'.format(header[1]))
+            self.openpgp_signed = bool(header[2] & FLAG_OPENPGP_SIGNED)
+            self.top_level_manifest_filename = (
+                    self.buf[header[4]:header[4]+header[5]].decode('utf8'))
+            self.sections = (header[6:8], header[8:10], header[10:12])
+
+            if top_manifest_path is not None:
+                digest = _get_top_manifest_digest(top_manifest_path)
+                if digest.encode('ascii') != header[3]:
+                    raise gemato.exceptions.ManifestCacheInvalid(path,
+                            'top-level Manifest has changed')
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_cb):
+        self.close()
+
+    def close(self):
+        """
+        Detach from the cache.
+        """
+        if getattr(self, 'buf', None) is not None:
+            self.buf.close()
+            self.buf = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def _lookup(self, section, key):
+        """
+        Find @key in table @section. Returns a tuple of (order, value)
+        or None if not found.
+        """
+
+        count, index_off = self.sections[section]
+        key = key.encode('utf8')
+        buf = self.buf
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            koff, klen, voff, vlen, order = INDEX_RECORD.unpack_from(
+                    buf, index_off + mid * INDEX_RECORD.size)
+            k = buf[koff:koff+klen]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return (order, buf[voff:voff+vlen])
+        return None
+
+    @staticmethod
+    def _make_entry(value):
+        l = value.decode('utf8').split()
+        return gemato.manifest.MANIFEST_TAG_MAPPING[l[0]].from_list(l)
+
+    def find_path_entry(self, path):
+        """
+        Find a matching entry for path @path and return it. Returns
+        None when no path matches. DIST entries are not included.
+        Works like ManifestRecursiveLoader.find_path_entry().
+        """
+
+        best = self._lookup(SECTION_PATHS, path)
+        # IGNORE entries match recursively
+        while path != '':
+            ign = self._lookup(SECTION_IGNORES, path)
+            if ign is not None and (best is None or ign[0] < best[0]):
+                best = ign
+            path = os.path.dirname(path)
+
+        if best is None:
+            return None
+        return self._make_entry(best[1])
+
+    def find_dist_entry(self, filename, relpath=''):
+        """
+        Find a matching entry for distfile @filename and return it.
+        If @relpath is provided, the Manifests up to @relpath are
+        searched. Returns None when no DIST entry matches.
+        Works like ManifestRecursiveLoader.find_dist_entry().
+        """
+
+        while True:
+            ret = self._lookup(SECTION_DISTS, relpath + '\0' + filename)
+            if ret is not None:
+                return self._make_entry(ret[1])
+            if relpath == '':
+                return None
+            relpath = os.path.dirname(relpath)
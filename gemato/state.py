@@ -0,0 +1,999 @@
+# gemato: Persistent verification state
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import errno
+import io
+import json
+import os
+import os.path
+import stat
+import time
+import timeit
+
+import gemato.compression
+import gemato.hash
+import gemato.util
+
+
+# filesystems where inode numbers or ctimes can not be trusted
+# to identify file contents
+UNRELIABLE_FILESYSTEMS = frozenset([
+    '9p',
+    'cifs',
+    'exfat',
+    'fuse',
+    'fuseblk',
+    'msdos',
+    'ncpfs',
+    'ntfs',
+    'smb3',
+    'smbfs',
+    'vfat',
+])
+
+# files changed that recently are not cached, to account for coarse
+# timestamp granularity and modifications racing with verification
+RACY_WINDOW_NS = 2 * 1000000000
+
+
+def get_filesystem_type(path):
+    """
+    Get the type of filesystem @path resides on. Returns the type
+    as a string (e.g. 'ext4'), or None if it can not be determined.
+    """
+
+    try:
+        st = os.stat(path)
+        with io.open('/proc/self/mountinfo', 'r', encoding='utf8') as f:
+            mountinfo = f.readlines()
+    except (IOError, OSError):
+        return None
+
+    devno = '{}:{}'.format(os.major(st.st_dev), os.minor(st.st_dev))
+    for l in mountinfo:
+        fields, sep, rest = l.partition(' - ')
+        fields = fields.split()
+        if len(fields) >= 3 and fields[2] == devno and rest:
+            return rest.split()[0]
+    return None
+
+
+def is_filesystem_reliable(path):
+    """
+    Check whether the filesystem @path resides on provides inode
+    numbers and ctimes that can be trusted to identify file contents.
+    Subtypes (e.g. 'fuse.sshfs') are matched by their main type.
+    If the filesystem type can not be determined, it is considered
+    unreliable.
+    """
+
+    fstype = get_filesystem_type(path)
+    if fstype is None:
+        return False
+    return fstype.split('.', 1)[0] not in UNRELIABLE_FILESYSTEMS
+
+
+def get_stat_identity(st):
+    """
+    Get the identity tuple of (dev, ino, size, mtime_ns, ctime_ns)
+    for stat result @st. Returns None if the path is not a regular
+    file or a directory, or if the stat data is not reliable enough
+    to identify it.
+
+    For directories, the identity changes whenever entries are added,
+    removed or renamed.
+    """
+
+    if not stat.S_ISREG(st.st_mode) and not stat.S_ISDIR(st.st_mode):
+        return None
+    try:
+        mtime_ns = st.st_mtime_ns
+        ctime_ns = st.st_ctime_ns
+    except AttributeError:
+        # py<3.3
+        mtime_ns = int(st.st_mtime * 1000000000)
+        ctime_ns = int(st.st_ctime * 1000000000)
+    # zero values indicate that the filesystem does not provide
+    # the relevant data
+    if st.st_ino == 0 or mtime_ns == 0 or ctime_ns == 0:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns)
+
+
+class StateFile(object):
+    """
+    Base class for state stored in a JSON file. The state is kept
+    separately for every tree (by real path of the top directory)
+    in the 'trees' dict, stored under STATE_KEY in the file.
+    """
+
+    __slots__ = ['path', 'trees']
+
+    FORMAT_VERSION = 1
+    STATE_KEY = 'trees'
+
+    def __init__(self, path=None):
+        """
+        Create a new state instance. If @path is not None, the state
+        is loaded from the specified file (if it exists), and saved
+        to it afterwards.
+        """
+
+        self.path = path
+        self.trees = {}
+
+        if path is not None:
+            try:
+                with io.open(path, 'r', encoding='utf8') as f:
+                    data = json.load(f)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            except ValueError:
+                # corrupted state, start anew
+                pass
+            else:
+                if (isinstance(data, dict)
+                        and data.get('version') == self.FORMAT_VERSION
+                        and isinstance(data.get(self.STATE_KEY), dict)):
+                    self.trees = data[self.STATE_KEY]
+
+    def save(self):
+        """
+        Write the state back to the file, atomically.
+        """
+
+        assert self.path is not None
+        data = {
+            'version': self.FORMAT_VERSION,
+            self.STATE_KEY: self.trees,
+        }
+        fd, tmp_path = gemato.util.create_temporary_file(
+                os.path.abspath(self.path))
+        try:
+            with io.open(fd, 'wb') as f:
+                f.write(json.dumps(data,
+                    separators=(',', ':')).encode('utf8'))
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+
+class SignatureCache(StateFile):
+    """
+    Cache of successful OpenPGP signature verifications. The entries
+    are keyed by the hash of the signed data and the set of key
+    fingerprints in the OpenPGPEnvironment used to verify it,
+    and expire after @ttl seconds, so that key revocations
+    and expirations are honoured after that time.
+
+    The entries are kept in the 'trees' dict (stored under
+    'signatures' in the file), mapping keys to expiration timestamps.
+    Use save() to write the updated cache.
+    """
+
+    __slots__ = ['ttl', 'clock']
+
+    STATE_KEY = 'signatures'
+
+    def __init__(self, path=None, ttl=3600, clock=time.time):
+        super(SignatureCache, self).__init__(path)
+        self.ttl = ttl
+        self.clock = clock
+
+    @staticmethod
+    def get_key(data_hash, env):
+        """
+        Get the cache key for signed data with SHA512 hash @data_hash,
+        verified using OpenPGPEnvironment @env. Returns None if the data
+        can not be cached (i.e. no keys were imported into @env).
+        """
+
+        if env is None or not env.fingerprints:
+            return None
+        return '{}:{}'.format(data_hash,
+                gemato.hash.hash_bytes(
+                    ' '.join(sorted(env.fingerprints)).encode('utf8'),
+                    'sha512'))
+
+    def is_verified(self, key):
+        """
+        Check whether the data with @key was verified successfully
+        and the entry did not expire yet.
+        """
+
+        return self.trees.get(key, 0) > self.clock()
+
+    def record(self, key):
+        """
+        Record the successful verification of data with @key.
+        """
+
+        now = self.clock()
+        # prune expired entries
+        for k, expires in list(self.trees.items()):
+            if expires <= now:
+                del self.trees[k]
+        self.trees[key] = now + self.ttl
+
+
+class VerificationState(StateFile):
+    """
+    Persistent state of successful file verifications. For every
+    Manifest directory, it records the digest of the Manifest file(s)
+    there and the stat identity (dev, ino, size, mtime_ns, ctime_ns)
+    of every file and directory that verified successfully while
+    the Manifests had that digest. Files whose identity did not change
+    since do not need to be hashed again, and whole subtrees whose
+    Manifests, directories and files did not change do not need to be
+    scanned at all.
+
+    Since the ctime of a file can not be set arbitrarily, the identity
+    changes whenever the file is modified, even if mtime is restored
+    afterwards. The state is not used (i.e. all files are hashed)
+    when the filesystem does not provide reliable inode numbers
+    and ctimes.
+
+    The data is stored as JSON in the file passed to the constructor.
+    Use save() to write the updated state.
+    """
+
+    __slots__ = [
+        # state for the current verification
+        'loader',
+        'verify_path',
+        'tree',
+        'reliable',
+        'start_ns',
+        'old_groups',
+        'old_subgroups',
+        'valid_groups',
+        'group_cache',
+        'pruned_dirs',
+        'foreign_dirs',
+        'scanned_manifests',
+        'loaded_dirs',
+        'pending_dirs',
+        'dirty_paths',
+    ]
+
+    def __init__(self, path=None):
+        super(VerificationState, self).__init__(path)
+        self.tree = None
+
+    @staticmethod
+    def get_entry_digest(e):
+        """
+        Get the digest string for MANIFEST entry @e.
+        """
+        return ' '.join(e.to_list()[2:])
+
+    @classmethod
+    def get_manifest_digests(cls, loader):
+        """
+        Get the digests of all Manifests loaded by @loader. Returns
+        a dict mapping Manifest directories to digest strings.
+
+        The digest of a Manifest directory covers all entries that
+        can apply to the files in it (but not in the subdirectories
+        having their own Manifests). Sub-Manifests are identified
+        by their (verified) MANIFEST entries, the top-level Manifest
+        by its contents. Entries in the parent Manifests that apply
+        to the files in the directory are included explicitly.
+        """
+
+        entry_digests = {}
+        for mpath, m in loader.loaded_manifests.items():
+            mdir = os.path.dirname(mpath)
+            for e in m.entries:
+                if e.tag != 'MANIFEST':
+                    continue
+                entry_digests[os.path.join(mdir, e.path)] = (
+                        cls.get_entry_digest(e))
+
+        top_path = loader.top_level_manifest_filename
+        entry_digests[top_path] = 'SHA512 ' + gemato.hash.hash_path(
+                os.path.join(loader.root_directory, top_path),
+                ['sha512'])['sha512']
+
+        parts = {}
+        for mpath in loader.loaded_manifests:
+            parts.setdefault(os.path.dirname(mpath), []).append(
+                    entry_digests.get(mpath, ''))
+
+        # include entries from parent Manifests
+        group_cache = {}
+        for mpath, m in loader.loaded_manifests.items():
+            mdir = os.path.dirname(mpath)
+            for e in m.entries:
+                if e.tag in ('MANIFEST', 'DIST', 'TIMESTAMP'):
+                    continue
+                dirpath = os.path.dirname(os.path.join(mdir, e.path))
+                g = group_cache.get(dirpath)
+                if g is None:
+                    g = cls._find_group(dirpath, parts)
+                    group_cache[dirpath] = g
+                if g != mdir:
+                    parts[g].append(mpath + ': ' + ' '.join(e.to_list()))
+
+        return dict((k, ' '.join(sorted(v))) for k, v in parts.items())
+
+    def begin(self, loader, path=''):
+        """
+        Start verifying the directory @path of the Manifest tree
+        in @loader. This needs to be called before loading
+        the Manifests for @path, using skip_manifest() to prune
+        unchanged subtrees. Afterwards, update_digests() needs
+        to be called.
+        """
+
+        root = os.path.realpath(loader.root_directory)
+        self.loader = loader
+        self.verify_path = path
+        self.start_ns = int(time.time() * 1000000000)
+        self.reliable = is_filesystem_reliable(loader.root_directory)
+        self.group_cache = {}
+        self.pruned_dirs = set()
+        self.foreign_dirs = set()
+        self.scanned_manifests = set()
+        self.loaded_dirs = set()
+        self.pending_dirs = {}
+        self.dirty_paths = set()
+        self.valid_groups = set()
+        self.tree = {}
+
+        self.old_groups = self.trees.get(root, {})
+        self.old_subgroups = {}
+        for mdir in self.old_groups:
+            d = mdir
+            while d != '':
+                d = os.path.dirname(d)
+                if d in self.old_groups:
+                    self.old_subgroups.setdefault(d, []).append(mdir)
+
+    def _scan_foreign_entries(self):
+        """
+        Find all directories that are affected by entries
+        in the Manifests of their parent directories.
+        """
+
+        for mpath, m in self.loader.loaded_manifests.items():
+            if mpath in self.scanned_manifests:
+                continue
+            self.scanned_manifests.add(mpath)
+            mdir = os.path.dirname(mpath)
+            self.loaded_dirs.add(mdir)
+            for e in m.entries:
+                if e.tag in ('DIST', 'TIMESTAMP'):
+                    continue
+                d = os.path.dirname(os.path.join(mdir, e.path))
+                if e.tag == 'MANIFEST':
+                    d = os.path.dirname(d)
+                while gemato.util.path_inside_dir(d, mdir):
+                    self.foreign_dirs.add(d)
+                    d = os.path.dirname(d)
+
+    def _identity_matches(self, path, ident):
+        try:
+            st = os.stat(os.path.join(self.loader.root_directory, path))
+        except OSError:
+            return False
+        return get_stat_identity(st) == tuple(ident)
+
+    def skip_manifest(self, mpath, e):
+        """
+        Check whether the sub-Manifest @mpath (with parent entry @e)
+        and the whole subtree covered by it can be skipped. This
+        is the case if the MANIFEST entry did not change since the last
+        verification, no parent Manifest entries apply to the subtree,
+        and all the directories and files in it have the same identity.
+
+        Returns True if the subtree can be skipped.
+        """
+
+        mdir = os.path.dirname(mpath)
+        if not self.reliable or mdir == '':
+            return False
+        if mdir in self.pruned_dirs:
+            return True
+
+        old = self.old_groups.get(mdir)
+        if old is None or old['digest'] != self.get_entry_digest(e):
+            return False
+        # the directory must have been verified completely
+        if mdir not in old.get('dirs', {}):
+            return False
+        self._scan_foreign_entries()
+        if mdir in self.foreign_dirs:
+            return False
+        # all Manifests that could have entries for the subtree need
+        # to be loaded already
+        d = os.path.dirname(mdir)
+        while d != '':
+            if d in self.old_groups and d not in self.loaded_dirs:
+                return False
+            d = os.path.dirname(d)
+
+        for g in [mdir] + self.old_subgroups.get(mdir, []):
+            gdata = self.old_groups[g]
+            for d, ident in gdata.get('dirs', {}).items():
+                if not self._identity_matches(d, ident):
+                    return False
+            for f, ident in gdata['files'].items():
+                if not self._identity_matches(f, ident):
+                    return False
+
+        self.pruned_dirs.add(mdir)
+        return True
+
+    def is_pruned(self, relpath):
+        """
+        Check whether @relpath is inside a subtree that was skipped.
+        """
+
+        if not self.pruned_dirs:
+            return False
+        while relpath != '':
+            if relpath in self.pruned_dirs:
+                return True
+            relpath = os.path.dirname(relpath)
+        return False
+
+    def update_digests(self):
+        """
+        Update the Manifest digests after loading the Manifests
+        and prepare the new state.
+        """
+
+        digests = self.get_manifest_digests(self.loader)
+        for mdir, digest in digests.items():
+            old = self.old_groups.get(mdir)
+            if old is not None and old['digest'] == digest:
+                self.valid_groups.add(mdir)
+
+        # build the new groups, preserving the records outside @path
+        path = self.verify_path
+        for mdir, digest in digests.items():
+            g = {
+                'digest': digest,
+                'files': {},
+                'dirs': {},
+            }
+            if mdir in self.valid_groups:
+                old = self.old_groups[mdir]
+                for p, v in old['files'].items():
+                    if not gemato.util.path_starts_with(p, path):
+                        g['files'][p] = v
+                # the parent directories of @path need to be verified
+                # again as well
+                for p, v in old.get('dirs', {}).items():
+                    if (not gemato.util.path_starts_with(p, path)
+                            and not gemato.util.path_starts_with(path, p)):
+                        g['dirs'][p] = v
+            self.tree[mdir] = g
+        # ...and the groups for Manifests that were not loaded
+        # (all the Manifests relevant to @path need to be loaded,
+        # except for the skipped subtrees)
+        for mdir, g in self.old_groups.items():
+            if mdir in self.tree:
+                continue
+            if not self.is_pruned(mdir):
+                if (gemato.util.path_starts_with(mdir, path)
+                        or gemato.util.path_starts_with(path, mdir)):
+                    continue
+            self.tree[mdir] = g
+
+        root = os.path.realpath(self.loader.root_directory)
+        self.trees[root] = self.tree
+
+    @staticmethod
+    def _find_group(dirpath, groups):
+        """
+        Find the closest Manifest directory in @groups for directory
+        @dirpath.
+        """
+
+        while dirpath not in groups:
+            assert dirpath != ''
+            dirpath = os.path.dirname(dirpath)
+        return dirpath
+
+    def _group_for_dir(self, dirpath):
+        ret = self.group_cache.get(dirpath)
+        if ret is None:
+            ret = self._find_group(dirpath, self.tree)
+            self.group_cache[dirpath] = ret
+        return ret
+
+    def get_identity(self, path):
+        """
+        Get the stat identity of the file at system path @path,
+        or None if the file can not be reliably identified
+        (or does not exist).
+        """
+
+        if not self.reliable:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return get_stat_identity(st)
+
+    def is_verified(self, relpath, ident):
+        """
+        Check whether the file at @relpath with identity @ident
+        has been verified successfully in the past. If it was,
+        the record is carried over to the new state.
+        """
+
+        if ident is None:
+            return False
+        mdir = self._group_for_dir(os.path.dirname(relpath))
+        if mdir not in self.valid_groups:
+            return False
+        old = self.old_groups[mdir]['files'].get(relpath)
+        if old is None or tuple(old) != ident:
+            return False
+        self.tree[mdir]['files'][relpath] = old
+        return True
+
+    def record(self, relpath, ident):
+        """
+        Record that the file at @relpath with identity @ident
+        (obtained before hashing) has been verified successfully.
+        Returns True if the file was recorded, False if it could
+        not be.
+        """
+
+        if ident is None:
+            return False
+        # file could have been modified while being verified
+        if ident[4] >= self.start_ns - RACY_WINDOW_NS:
+            return False
+        mdir = self._group_for_dir(os.path.dirname(relpath))
+        self.tree[mdir]['files'][relpath] = list(ident)
+        return True
+
+    def mark_dirty(self, relpath):
+        """
+        Mark that the verification of @relpath failed, or its result
+        could not be recorded. The parent directories will not
+        be recorded as complete.
+        """
+
+        self.dirty_paths.add(relpath)
+
+    def record_directory(self, relpath):
+        """
+        Queue recording the identity of directory @relpath after
+        all files in it were processed. The directory is recorded
+        in finish() if neither it nor any of its subdirectories
+        were marked dirty.
+        """
+
+        ident = self.get_identity(os.path.join(
+            self.loader.root_directory, relpath))
+        if ident is None or ident[4] >= self.start_ns - RACY_WINDOW_NS:
+            self.mark_dirty(os.path.join(relpath, ''))
+        else:
+            self.pending_dirs[relpath] = ident
+
+    def finish(self):
+        """
+        Finish the verification, recording complete directories.
+        """
+
+        dirty_dirs = set()
+        for p in self.dirty_paths:
+            d = os.path.dirname(p)
+            while d not in dirty_dirs:
+                dirty_dirs.add(d)
+                if d == '':
+                    break
+                d = os.path.dirname(d)
+
+        for d, ident in self.pending_dirs.items():
+            if d not in dirty_dirs:
+                mdir = self._group_for_dir(d)
+                self.tree[mdir]['dirs'][d] = list(ident)
+        self.pending_dirs = {}
+        self.dirty_paths = set()
+
+    def begin_distfiles(self, distdir, entries):
+        """
+        Start verifying the distfiles in directory @distdir against
+        DIST entries in @entries (a dict mapping filenames to entries).
+        Every distfile is recorded separately, along with the digest
+        of its entry, so that changing one DIST entry does not
+        invalidate the remaining records.
+        """
+
+        root = os.path.realpath(distdir)
+        self.start_ns = int(time.time() * 1000000000)
+        self.reliable = is_filesystem_reliable(distdir)
+        self.old_groups = self.trees.get(root, {})
+        self.valid_groups = set()
+        self.tree = {}
+        for filename, e in entries.items():
+            digest = self.get_entry_digest(e)
+            old = self.old_groups.get(filename)
+            if old is not None and old['digest'] == digest:
+                self.valid_groups.add(filename)
+            self.tree[filename] = {
+                'digest': digest,
+                'files': {},
+            }
+        self.trees[root] = self.tree
+
+    def is_distfile_verified(self, filename, ident):
+        """
+        Check whether distfile @filename with identity @ident has been
+        verified successfully against the same entry in the past.
+        If it was, the record is carried over to the new state.
+        """
+
+        if ident is None or filename not in self.valid_groups:
+            return False
+        old = self.old_groups[filename]['files'].get(filename)
+        if old is None or tuple(old) != ident:
+            return False
+        self.tree[filename]['files'][filename] = old
+        return True
+
+    def record_distfile(self, filename, ident):
+        """
+        Record that distfile @filename with identity @ident (obtained
+        before hashing) has been verified successfully. Returns True
+        if the file was recorded, False if it could not be.
+        """
+
+        if ident is None:
+            return False
+        if ident[4] >= self.start_ns - RACY_WINDOW_NS:
+            return False
+        self.tree[filename]['files'][filename] = list(ident)
+        return True
+
+
+class DirectoryMtimeState(StateFile):
+    """
+    Persistent list of directories in the Manifest tree, used to prune
+    unchanged subtrees in incremental updates. Adding, removing
+    or renaming a file updates the mtime of the containing directory,
+    so a directory whose mtime (and the mtime of its Manifest, if any)
+    is not newer than the last update, and whose all recorded
+    subdirectories are unchanged likewise, does not need to be scanned.
+    New subdirectories can appear only in directories whose mtime
+    changed.
+
+    Note that files modified in place do not update the directory
+    mtime. Use this *only* if files are always replaced atomically
+    (e.g. by rsync or git).
+
+    The data is stored as JSON in the file passed to the constructor.
+    Use save() to write the updated state.
+    """
+
+    __slots__ = [
+        # state for the current update
+        'root',
+        'update_path',
+        'start_time',
+        'old_dirs',
+        'old_timestamp',
+        'clean_dirs',
+        'new_dirs',
+    ]
+
+    def begin(self, root_directory, path='', last_mtime=None):
+        """
+        Start updating the directory @path of the tree
+        at @root_directory. @last_mtime is the timestamp of the last
+        update (in st_mtime format). If it is None, no directories
+        are considered clean but the directories are recorded
+        for the next run.
+        """
+
+        self.root = root_directory
+        self.update_path = path
+        self.start_time = time.time()
+        self.clean_dirs = set()
+        self.new_dirs = {}
+
+        tree = self.trees.get(os.path.realpath(root_directory), {})
+        self.old_dirs = tree.get('dirs', {})
+        self.old_timestamp = tree.get('timestamp')
+        if last_mtime is None or self.old_timestamp is None:
+            return
+        # directories created after the old list was taken would
+        # be missing in it
+        threshold = min(last_mtime, self.old_timestamp)
+
+        dirty_dirs = set()
+        for d, mname in self.old_dirs.items():
+            try:
+                st = os.stat(os.path.join(root_directory, d))
+                dirty = st.st_mtime > threshold
+                if not dirty and mname is not None:
+                    st = os.stat(os.path.join(root_directory, d, mname))
+                    dirty = st.st_mtime > threshold
+            except OSError:
+                dirty = True
+            if dirty:
+                while d not in dirty_dirs:
+                    dirty_dirs.add(d)
+                    if d == '':
+                        break
+                    d = os.path.dirname(d)
+        self.clean_dirs = set(self.old_dirs) - dirty_dirs
+
+    def is_clean(self, relpath):
+        """
+        Check whether the subtree at @relpath is unchanged since
+        the last update.
+        """
+        return relpath in self.clean_dirs
+
+    def record(self, relpath, filenames):
+        """
+        Record the directory @relpath as present in the tree. @filenames
+        list the files in it, and are used to find the Manifest.
+        """
+
+        mname = None
+        for f in (gemato.compression
+                .get_potential_compressed_names('Manifest')):
+            if f in filenames:
+                mname = f
+                break
+        self.new_dirs[relpath] = mname
+
+    def finish(self):
+        """
+        Finish the update, storing the new list of directories.
+        """
+
+        path = self.update_path
+        dirs = self.new_dirs
+        for d, mname in self.old_dirs.items():
+            if d in dirs:
+                continue
+            # unchanged subtrees are not scanned, and the remaining
+            # directories outside @path are kept as-is
+            if (d in self.clean_dirs
+                    or not gemato.util.path_starts_with(d, path)):
+                dirs[d] = mname
+
+        timestamp = self.start_time
+        if path != '' and self.old_timestamp is not None:
+            timestamp = min(timestamp, self.old_timestamp)
+        self.trees[os.path.realpath(self.root)] = {
+            'timestamp': timestamp,
+            'dirs': dirs,
+        }
+
+
+def _walk_key(relpath):
+    """
+    Get the sort key corresponding to the order in which a sorted,
+    top-down walk reaches directory @relpath.
+    """
+    return relpath.split('/')
+
+
+class VerificationCheckpoint(StateFile):
+    """
+    Checkpoint for resumable verification of Manifest trees, within
+    a time and/or byte budget. When the budget runs out, the position
+    of the (sorted) directory walk, the entries for missing files found
+    so far and the failures are stored, and the next verification
+    of the same tree continues from that position. The checkpoint
+    is discarded when the top-level Manifest changes.
+
+    The data is stored as JSON in the file passed to the constructor.
+    Use save() to write the updated state.
+    """
+
+    __slots__ = [
+        'time_budget',
+        'byte_budget',
+        'clock',
+        # state for the current verification
+        'root',
+        'tree',
+        'start_time',
+        'bytes_read',
+        'files_verified',
+        'position',
+        'complete',
+    ]
+
+    def __init__(self, path=None, time_budget=None, byte_budget=None,
+            clock=timeit.default_timer):
+        """
+        Create a new checkpoint instance, loading the data from @path
+        (if it exists). @time_budget specifies the maximum time
+        of a single verification (in seconds), @byte_budget
+        the maximum number of bytes to hash. Both budgets are checked
+        before verifying every file, so they can be exceeded by the time
+        needed to verify a single file.
+        """
+
+        super(VerificationCheckpoint, self).__init__(path)
+        self.time_budget = time_budget
+        self.byte_budget = byte_budget
+        self.clock = clock
+        self.tree = None
+        self.complete = False
+
+    def begin(self, loader, path=''):
+        """
+        Start verifying the directory @path of the Manifest tree
+        in @loader, resuming from the stored position if it applies.
+        Returns True if the verification is resumed.
+        """
+
+        self.root = os.path.realpath(loader.root_directory)
+        self.start_time = self.clock()
+        self.bytes_read = 0
+        self.files_verified = 0
+        self.complete = False
+
+        top_path = loader.top_level_manifest_filename
+        digest = gemato.hash.hash_path(
+                os.path.join(loader.root_directory, top_path),
+                ['sha512'])['sha512']
+        old = self.trees.get(self.root)
+        if (old is not None and old['path'] == path
+                and old['manifest'] == digest):
+            self.tree = old
+            self.position = tuple(old['position'])
+            return True
+
+        self.tree = {
+            'path': path,
+            'manifest': digest,
+            'position': None,
+            'pending': [],
+            'failures': [],
+            'ret': True,
+        }
+        self.position = None
+        return False
+
+    @property
+    def ret(self):
+        """
+        The result of the verification so far.
+        """
+        return self.tree['ret']
+
+    @property
+    def failures(self):
+        """
+        The list of paths that failed to verify so far.
+        """
+        return self.tree['failures']
+
+    def is_dir_done(self, relpath):
+        """
+        Check whether the files in directory @relpath were verified
+        completely already.
+        """
+
+        if self.position is None:
+            return False
+        return _walk_key(relpath) < _walk_key(self.position[0])
+
+    def is_subtree_done(self, relpath):
+        """
+        Check whether the whole subtree at directory @relpath
+        was verified already.
+        """
+
+        return (self.is_dir_done(relpath)
+                and not gemato.util.path_starts_with(self.position[0],
+                    relpath))
+
+    def is_file_done(self, relpath):
+        """
+        Check whether the file @relpath was verified already.
+        """
+
+        if self.position is None:
+            return False
+        dirpath, filename = os.path.split(relpath)
+        if dirpath == self.position[0]:
+            return filename <= self.position[1]
+        return self.is_dir_done(dirpath)
+
+    def filter_entries(self, entry_dict):
+        """
+        Remove the entries for files that were verified already
+        from @entry_dict, except for the entries for missing files
+        that were found so far. IGNORE entries are preserved.
+        """
+
+        if self.position is None:
+            return
+        pending = frozenset(self.tree['pending'])
+        for k, e in list(entry_dict.items()):
+            if e.tag != 'IGNORE' and k not in pending and self.is_file_done(k):
+                del entry_dict[k]
+
+    def record(self, relpath, e):
+        """
+        Record that the file @relpath (with entry @e) was verified.
+        """
+
+        self.position = os.path.split(relpath)
+        self.files_verified += 1
+        if e is not None and e.tag != 'IGNORE':
+            self.bytes_read += e.size
+
+    def exhausted(self):
+        """
+        Check whether the budget was exhausted, and the verification
+        needs to be stopped before verifying the next file. At least
+        one file is verified in every run, to guarantee progress.
+        """
+
+        if self.files_verified == 0:
+            return False
+        if (self.byte_budget is not None
+                and self.bytes_read >= self.byte_budget):
+            return True
+        if (self.time_budget is not None
+                and self.clock() - self.start_time >= self.time_budget):
+            return True
+        return False
+
+    def record_failure(self, relpath):
+        """
+        Record that @relpath failed to verify.
+        """
+        if relpath not in self.tree['failures']:
+            self.tree['failures'].append(relpath)
+
+    def interrupt(self, entry_dict, ret):
+        """
+        Store the checkpoint for the current position. @entry_dict
+        is the dict of remaining entries, used to store the entries
+        for missing files. @ret is the result of the verification
+        so far.
+        """
+
+        self.tree['ret'] = ret
+        self.tree['position'] = list(self.position)
+        self.tree['pending'] = sorted(k for k, e in entry_dict.items()
+                if e.tag != 'IGNORE' and self.is_file_done(k))
+        self.trees[self.root] = self.tree
+
+    def save(self):
+        """
+        Write the checkpoint back to the file, or remove the file
+        if there are no interrupted verifications left.
+        """
+
+        if self.trees:
+            super(VerificationCheckpoint, self).save()
+            return
+        assert self.path is not None
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def finish(self):
+        """
+        Finish the verification of the whole tree, discarding
+        the checkpoint.
+        """
+
+        self.trees.pop(self.root, None)
+        self.complete = True
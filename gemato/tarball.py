@@ -0,0 +1,849 @@
+# gemato: Tarball (snapshot) support
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import copy
+import io
+import os.path
+import tarfile
+
+import gemato.compression
+import gemato.exceptions
+import gemato.hash
+import gemato.manifest
+import gemato.recursiveloader
+import gemato.util
+
+
+MANIFEST_NAMES = frozenset(
+        gemato.compression.get_potential_compressed_names('Manifest'))
+
+
+def get_supported_hashes():
+    """
+    Get the list of all Manifest hash names supported by the system.
+    """
+
+    ret = []
+    for h, hl in gemato.manifest.MANIFEST_HASH_MAPPING.items():
+        try:
+            gemato.hash.get_hash_by_name(hl)
+        except gemato.exceptions.UnsupportedHash:
+            continue
+        ret.append(h)
+    return sorted(ret)
+
+
+def normalize_member_name(name):
+    """
+    Normalize the tarball member name @name into a relative path
+    with no './' components or trailing slashes.
+    """
+
+    name = os.path.normpath(name.lstrip('/'))
+    if name == '.':
+        return ''
+    return name
+
+
+def get_member_type(member):
+    """
+    Get the human-readable description of the type of tarball
+    @member (matching the ones used by gemato.verify).
+    """
+
+    if member.isreg():
+        return 'regular file'
+    elif member.isdir():
+        return 'directory'
+    elif member.issym():
+        return 'symbolic link'
+    elif member.ischr():
+        return 'character device'
+    elif member.isblk():
+        return 'block device'
+    elif member.isfifo():
+        return 'named pipe'
+    return 'unknown'
+
+
+def load_manifest_data(name, data, verify_openpgp=False, openpgp_env=None):
+    """
+    Load a ManifestFile from bytestring @data, decompressing it
+    if necessary according to @name. @verify_openpgp
+    and @openpgp_env are passed to ManifestFile.load().
+    """
+
+    m = gemato.manifest.ManifestFile()
+    f = io.BytesIO(data)
+    suffix = gemato.compression.get_compressed_suffix_from_filename(name)
+    if suffix is not None:
+        f = gemato.compression.open_compressed_file(suffix, f)
+    with io.TextIOWrapper(f, encoding='utf8') as tf:
+        m.load(tf, verify_openpgp=verify_openpgp, openpgp_env=openpgp_env)
+    return m
+
+
+class _HashingReader(object):
+    """
+    A file object wrapper hashing the data as it is read.
+    """
+
+    __slots__ = ['f', 'hashes']
+
+    def __init__(self, f, hash_names):
+        self.f = f
+        self.hashes = dict((h, gemato.hash.get_hash_by_name(h))
+                for h in hash_names)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        for h in self.hashes.values():
+            h.update(data)
+        return data
+
+    def read_all(self):
+        while self.read(gemato.hash.HASH_BUFFER_SIZE):
+            pass
+
+    def hexdigests(self):
+        return dict((k, h.hexdigest()) for k, h in self.hashes.items())
+
+
+def hash_member(f, hashes, out=None, member=None):
+    """
+    Hash the contents of file object @f using Manifest hashes @hashes.
+    Returns a dict of checksums, including '__size__'.
+
+    If @out is not None, it specifies a TarFile open for writing,
+    and @member is added to it with the data being hashed.
+    """
+
+    hashes = list(hashes)
+    hl = list(gemato.manifest.manifest_hashes_to_hashlib(hashes))
+    hl.append('__size__')
+    reader = _HashingReader(f, hl)
+    if out is not None:
+        out.addfile(member, reader)
+    reader.read_all()
+    checksums = reader.hexdigests()
+    return dict((ek, checksums[k]) for ek, k in zip(hashes + ['__size__'], hl))
+
+
+def verify_member(ftype, checksums, e):
+    """
+    Verify a tarball member of type @ftype (None if it does not
+    exist) against the data in entry @e. @checksums is the dict
+    of member checksums, as returned by hash_member(). Returns
+    the result in the same format as gemato.verify.verify_path().
+
+    Raises UnsupportedHash if a hash used by the entry has not been
+    computed.
+    """
+
+    if e is not None and e.tag == 'IGNORE':
+        return (True, [])
+
+    exists = ftype is not None
+    if exists != (e is not None):
+        return (False, [('__exists__', e is not None, exists)])
+    elif not exists:
+        return (True, [])
+
+    if ftype != 'regular file':
+        return (False, [('__type__', 'regular file', ftype)])
+
+    diff = []
+    size = checksums['__size__']
+    if size != e.size:
+        diff.append(('__size__', e.size, size))
+    for h in sorted(e.checksums):
+        exp = e.checksums[h]
+        got = checksums.get(h)
+        if got is None:
+            raise gemato.exceptions.UnsupportedHash(h)
+        if got != exp:
+            diff.append((h, exp, got))
+    if diff:
+        return (False, diff)
+    return (True, [])
+
+
+def _common_path(a, b):
+    """
+    Return the longest common directory of member names @a and @b.
+    """
+
+    ret = []
+    for x, y in zip(a.split('/'), b.split('/')):
+        if x != y:
+            break
+        ret.append(x)
+    return '/'.join(ret)
+
+
+class TarballMembers(object):
+    """
+    The data of all members of a tarball, collected in a single
+    sequential pass for creating Manifests. The regular files
+    are hashed while they are being read, so memory use does not
+    depend on the size of the files.
+
+    The files are hashed using @hashes (list of Manifest hash names),
+    or all hashes supported by the system if it is None.
+
+    If @out is not None, it specifies a TarFile open for writing.
+    All members except for the Manifests are copied into it while
+    they are being read. The Manifests that are not replaced can be
+    copied afterwards using add_manifests_to_tarball().
+    """
+
+    __slots__ = ['hashes', 'types', 'checksums', 'manifests',
+            'manifest_members']
+
+    def __init__(self, f, hashes=None, out=None):
+        """
+        Read the tarball from @f, that can either be a path or an open
+        binary file object. The compression is detected automatically.
+        """
+
+        if hashes is None:
+            hashes = get_supported_hashes()
+        self.hashes = sorted(hashes)
+        # member name -> file type
+        self.types = {}
+        # member name -> dict of checksums (including __size__)
+        self.checksums = {}
+        # member name -> Manifest file contents
+        self.manifests = {}
+        # member name -> TarInfo of Manifest files
+        self.manifest_members = {}
+
+        if isinstance(f, tarfile.TarFile):
+            self._read(f, out)
+        elif hasattr(f, 'read'):
+            with tarfile.open(fileobj=f, mode='r|*') as tf:
+                self._read(tf, out)
+        else:
+            with tarfile.open(f, mode='r|*') as tf:
+                self._read(tf, out)
+
+    def _read(self, tf, out):
+        for member in tf:
+            name = normalize_member_name(member.name)
+            if member.islnk():
+                # hard link to a member that was read already
+                target = normalize_member_name(member.linkname)
+                self.types[name] = self.types.get(target, 'unknown')
+                if target in self.checksums:
+                    self.checksums[name] = self.checksums[target]
+                if target in self.manifests:
+                    self.manifests[name] = self.manifests[target]
+                    self.manifest_members[name] = member
+                elif out is not None:
+                    out.addfile(member)
+                continue
+
+            self.types[name] = get_member_type(member)
+            if not member.isreg():
+                if out is not None:
+                    out.addfile(member)
+                continue
+
+            f = tf.extractfile(member)
+            try:
+                if os.path.basename(name) in MANIFEST_NAMES:
+                    data = f.read()
+                    self.manifests[name] = data
+                    self.manifest_members[name] = member
+                    self.checksums[name] = hash_member(
+                            io.BytesIO(data), self.hashes)
+                else:
+                    self.checksums[name] = hash_member(f, self.hashes,
+                            out, member)
+            finally:
+                f.close()
+
+    def find_common_prefix(self):
+        """
+        Find the directory containing all the other members
+        of the tarball (e.g. 'gentoo-20171101' in a snapshot). Returns
+        the member name, or '' if the members are not contained
+        in a single directory.
+        """
+
+        prefix = None
+        for name in self.types:
+            top = name.split('/', 1)[0]
+            if prefix is None:
+                prefix = top
+            elif top != prefix:
+                return ''
+        if not prefix or self.types.get(prefix, 'directory') != 'directory':
+            return ''
+        return prefix
+
+
+class TarballManifestLoader(gemato.recursiveloader.ManifestRecursiveLoader):
+    """
+    A ManifestRecursiveLoader for a Manifest tree inside a tarball
+    (e.g. a repository snapshot). The tarball is read sequentially
+    in a single pass, without extracting it, and the Manifests
+    are loaded from the archive itself.
+
+    Every member is verified as soon as all the Manifests that
+    can cover it have been read, and only the results of failed
+    verifications are kept. The members preceding their Manifests
+    are hashed using all supported hashes, and held until
+    the Manifests are read.
+    """
+
+    __slots__ = ['loader_kwargs', 'all_hashes', 'requested_top_manifest',
+            'top_manifest_name', 'common_prefix', 'seen_dirs',
+            'manifest_data', 'pending', 'failures', 'seen']
+
+    def __init__(self, f, top_manifest_path=None, **kwargs):
+        """
+        Read the tarball from @f (a path or an open binary file
+        object), and verify the members against the Manifests in it.
+        @top_manifest_path specifies the member name of the top-level
+        Manifest. If it is None, it is found automatically -- that is,
+        the first Manifest in a directory containing all the members
+        preceding it, or the Manifest at the lowest directory depth.
+
+        @kwargs are passed to ManifestRecursiveLoader.
+
+        Raises ManifestMismatch if the top-level Manifest or one
+        of the sub-Manifests is not present in the tarball (or does not
+        match its entry), ValueError if the top-level Manifest could
+        not be determined unambiguously, and UnsupportedTarballMember
+        if a member can not be verified (e.g. is a symbolic link).
+        """
+
+        self.loader_kwargs = kwargs
+        self.all_hashes = get_supported_hashes()
+        self.requested_top_manifest = None
+        if top_manifest_path is not None:
+            self.requested_top_manifest = normalize_member_name(
+                    top_manifest_path)
+        # set when the top-level Manifest is loaded
+        self.top_manifest_name = None
+        # common directory and the directories of the members
+        # seen before the top-level Manifest was found
+        self.common_prefix = None
+        self.seen_dirs = set()
+        # member name -> data of Manifests that were not loaded yet
+        self.manifest_data = {}
+        # member directory -> {member name: (file type, checksums)}
+        # of members whose Manifests were not read yet
+        self.pending = {}
+        # (relpath, entry, diff) of failed members
+        self.failures = []
+        # relative paths of verified members
+        self.seen = set()
+
+        if isinstance(f, tarfile.TarFile):
+            self._read(f)
+        elif hasattr(f, 'read'):
+            with tarfile.open(fileobj=f, mode='r|*') as tf:
+                self._read(tf)
+        else:
+            with tarfile.open(f, mode='r|*') as tf:
+                self._read(tf)
+
+    def _read(self, tf):
+        for member in tf:
+            # do not keep the headers of all members in memory
+            tf.members = []
+            name = normalize_member_name(member.name)
+            started = self.top_manifest_name is not None
+            if started:
+                if not gemato.util.path_starts_with(name,
+                        self.root_directory):
+                    self._check_top_level_manifest(name)
+                    continue
+            else:
+                if self.common_prefix is None:
+                    self.common_prefix = name
+                else:
+                    self.common_prefix = _common_path(
+                            self.common_prefix, name)
+                if member.isdir():
+                    self.seen_dirs.add(name)
+
+            if member.islnk():
+                target = normalize_member_name(member.linkname)
+                ftype, checksums = self._get_link_target(target)
+                if target in self.manifest_data:
+                    self.manifest_data[name] = self.manifest_data[target]
+                self._add_member(name, ftype, checksums=checksums)
+                continue
+
+            ftype = get_member_type(member)
+            if not member.isreg():
+                self._add_member(name, ftype)
+                continue
+
+            f = tf.extractfile(member)
+            try:
+                if os.path.basename(name) in MANIFEST_NAMES:
+                    data = f.read()
+                    self.manifest_data[name] = data
+                    if not started and self._is_top_level_manifest(name):
+                        self._start(name)
+                        started = True
+                    self._add_member(name, ftype, io.BytesIO(data))
+                    if started:
+                        self._resolve_pending(os.path.dirname(name))
+                else:
+                    self._add_member(name, ftype, f)
+            finally:
+                f.close()
+
+        if self.top_manifest_name is None:
+            self._start(self._find_top_level_manifest())
+        # all available Manifests are loaded at this point, so any
+        # remaining members are covered by missing sub-Manifests;
+        # find_path_entry() raises for them
+        for members in list(self.pending.values()):
+            for name, (ftype, checksums) in list(members.items()):
+                relpath = self._get_relpath(name)
+                self._verify_member(relpath, ftype,
+                        self.find_path_entry(relpath), checksums=checksums)
+        self.pending = {}
+        # the remaining Manifests are not referenced
+        self.manifest_data = {}
+
+    def _is_top_level_manifest(self, name):
+        """
+        Check whether the Manifest @name should be used
+        as the top-level Manifest before the whole tarball is read.
+        """
+
+        if self.requested_top_manifest is not None:
+            return name == self.requested_top_manifest
+        # all members read so far need to be inside its directory,
+        # and the directory itself must be present in the tarball
+        d = os.path.dirname(name)
+        return (gemato.util.path_starts_with(self.common_prefix, d)
+                and (d == '' or d in self.seen_dirs))
+
+    def _check_top_level_manifest(self, name):
+        """
+        Verify that the Manifest @name outside the top-level Manifest
+        directory does not compete with it for being the top-level
+        Manifest. Raises ValueError if it does.
+        """
+
+        if self.requested_top_manifest is not None:
+            return
+        if os.path.basename(name) not in MANIFEST_NAMES:
+            return
+        if name.count('/') <= self.top_manifest_name.count('/'):
+            raise ValueError('Multiple top-level Manifests in tarball: {} {}'
+                    .format(self.top_manifest_name, name))
+
+    def _find_top_level_manifest(self):
+        """
+        Find the top-level Manifest after reading the whole tarball,
+        that is the Manifest at the lowest directory depth. Returns its
+        member name.
+
+        Raises ManifestMismatch if the tarball contains no Manifests,
+        and ValueError if there are multiple candidates.
+        """
+
+        if self.requested_top_manifest is not None:
+            raise gemato.exceptions.ManifestMismatch(
+                    self.requested_top_manifest, None,
+                    [('__exists__', True, False)])
+
+        best = None
+        for name in self.manifest_data:
+            depth = name.count('/')
+            if best is None or depth < best[0]:
+                best = (depth, [name])
+            elif depth == best[0]:
+                best[1].append(name)
+        if best is None:
+            raise gemato.exceptions.ManifestMismatch('Manifest',
+                    None, [('__exists__', True, False)])
+        # prefer uncompressed Manifest if there are multiple variants
+        dirs = set(os.path.dirname(x) for x in best[1])
+        if len(dirs) > 1:
+            raise ValueError('Multiple top-level Manifests in tarball: {}'
+                    .format(' '.join(sorted(best[1]))))
+        return sorted(best[1], key=len)[0]
+
+    def _start(self, top_manifest_name):
+        """
+        Load the top-level Manifest @top_manifest_name, and verify
+        the members read before it.
+        """
+
+        self.top_manifest_name = top_manifest_name
+        self.seen_dirs = None
+        super(TarballManifestLoader, self).__init__(top_manifest_name,
+                **self.loader_kwargs)
+        for name in list(self.manifest_data):
+            if not gemato.util.path_starts_with(name, self.root_directory):
+                self._check_top_level_manifest(name)
+                del self.manifest_data[name]
+        for d in list(self.pending):
+            if not gemato.util.path_starts_with(d, self.root_directory):
+                del self.pending[d]
+        self._resolve_pending(self.root_directory)
+
+    def _get_relpath(self, name):
+        """
+        Get the path of member @name relative to the top-level Manifest
+        directory.
+        """
+
+        if self.root_directory == '':
+            return name
+        return name[len(self.root_directory)+1:]
+
+    def _get_link_target(self, target):
+        """
+        Get the file type and checksums of hard link @target.
+        """
+
+        members = self.pending.get(os.path.dirname(target), {})
+        if target in members:
+            return members[target]
+        if (self.top_manifest_name is not None
+                and gemato.util.path_starts_with(target,
+                    self.root_directory)):
+            relpath = self._get_relpath(target)
+            if relpath in self.seen and not any(
+                    x[0] == relpath for x in self.failures):
+                e = self.find_path_entry(relpath)
+                if e is not None and e.tag != 'IGNORE':
+                    checksums = dict(e.checksums)
+                    checksums['__size__'] = e.size
+                    return ('regular file', checksums)
+        raise gemato.exceptions.UnsupportedTarballMember(target,
+                'hard link target was not verified')
+
+    def _find_entry(self, relpath):
+        """
+        Find the entry for @relpath, loading the Manifests that
+        were read already. Returns a tuple of a boolean indicating
+        whether all the Manifests that can cover the path were read,
+        and the entry.
+        """
+
+        while True:
+            to_load = []
+            for mpath, mdir, m in self._iter_manifests_for_path(relpath):
+                for e in m.entries:
+                    if e.tag != 'MANIFEST':
+                        continue
+                    subpath = os.path.join(mdir, e.path)
+                    if subpath in self.loaded_manifests:
+                        continue
+                    if gemato.util.path_starts_with(relpath,
+                            os.path.dirname(subpath)):
+                        to_load.append((subpath, e))
+            if not to_load:
+                break
+            for subpath, e in to_load:
+                if (os.path.join(self.root_directory, subpath)
+                        not in self.manifest_data):
+                    return (False, None)
+                self.load_manifest(subpath, e)
+        return (True, self.find_path_entry(relpath))
+
+    def _add_member(self, name, ftype, f=None, checksums=None):
+        """
+        Verify the member @name of type @ftype, with contents readable
+        from @f or already hashed into @checksums. If its Manifests
+        were not read yet, hash it and queue it for verification.
+        """
+
+        if self.top_manifest_name is not None:
+            relpath = self._get_relpath(name)
+            if relpath in ('', self.top_level_manifest_filename):
+                return
+            # skip dotfiles
+            if any(x.startswith('.') for x in relpath.split('/')):
+                return
+            final, e = self._find_entry(relpath)
+            if final:
+                self._verify_member(relpath, ftype, e, f, checksums)
+                return
+
+        if checksums is None and f is not None:
+            checksums = hash_member(f, self.all_hashes)
+        self.pending.setdefault(os.path.dirname(name), {})[name] = (
+                ftype, checksums)
+
+    def _resolve_pending(self, path):
+        """
+        Verify the queued members in member directory @path
+        and its subdirectories whose Manifests were read.
+        """
+
+        for d in list(self.pending):
+            if not gemato.util.path_starts_with(d, path):
+                continue
+            members = self.pending[d]
+            for name, (ftype, checksums) in list(members.items()):
+                relpath = self._get_relpath(name)
+                final, e = self._find_entry(relpath)
+                if final:
+                    del members[name]
+                    self._verify_member(relpath, ftype, e,
+                            checksums=checksums)
+            if not members:
+                del self.pending[d]
+
+    def _verify_member(self, relpath, ftype, e, f=None, checksums=None):
+        """
+        Verify the member at @relpath against entry @e, and record
+        the result.
+        """
+
+        if relpath in ('', self.top_level_manifest_filename):
+            return
+        if any(x.startswith('.') for x in relpath.split('/')):
+            return
+        if e is not None and e.tag == 'IGNORE':
+            return
+        self.seen.add(relpath)
+        if e is None and ftype == 'directory':
+            return
+        if e is not None and ftype == 'symbolic link':
+            raise gemato.exceptions.UnsupportedTarballMember(
+                    os.path.join(self.root_directory, relpath),
+                    'symbolic links are not supported')
+        if (checksums is None and f is not None and e is not None
+                and ftype == 'regular file'):
+            checksums = hash_member(f, e.checksums)
+        ret, diff = verify_member(ftype, checksums, e)
+        if not ret:
+            self.failures.append((relpath, e, diff))
+
+    def load_manifest(self, relpath, verify_entry=None,
+            allow_create=False):
+        """
+        Load a single Manifest file whose relative path within Manifest
+        tree is @relpath from the tarball. If @verify_entry is not
+        null, the Manifest file is verified against the entry.
+        """
+
+        name = os.path.join(self.root_directory, relpath)
+        data = self.manifest_data.get(name)
+        if data is None:
+            raise gemato.exceptions.ManifestMismatch(relpath,
+                    verify_entry, [('__exists__', True, False)])
+        if verify_entry is not None:
+            checksums = hash_member(io.BytesIO(data),
+                    verify_entry.checksums)
+            ret, diff = verify_member('regular file', checksums,
+                    verify_entry)
+            if not ret:
+                raise gemato.exceptions.ManifestMismatch(
+                        relpath, verify_entry, diff)
+
+        m = load_manifest_data(name, data, self.verify_openpgp,
+                self.openpgp_env)
+        del self.manifest_data[name]
+        self.manifest_device = None
+        self.loaded_manifests[relpath] = m
+        return m
+
+    def assert_directory_verifies(self, path='',
+            fail_handler=gemato.util.throw_exception):
+        """
+        Report the results of verifying the directory tree starting
+        at @path (relative to top Manifest directory) in the tarball.
+        Includes testing for stray and missing files. Members outside
+        the directory of the top-level Manifest are ignored.
+
+        @fail_handler is used and the value is returned like
+        in ManifestRecursiveLoader.assert_directory_verifies().
+        """
+
+        ret = True
+
+        def handle_failure(relpath, e, diff):
+            err = gemato.exceptions.ManifestMismatch(relpath, e, diff)
+            fret = fail_handler(err)
+            if fret is None:
+                fret = True
+            return fret
+
+        for relpath, e, diff in sorted(self.failures, key=lambda x: x[0]):
+            if gemato.util.path_starts_with(relpath, path):
+                ret &= handle_failure(relpath, e, diff)
+
+        entry_dict = self.get_file_entry_dict(path)
+
+        def is_ignored(relpath):
+            while relpath != '':
+                e = entry_dict.get(relpath)
+                if e is not None and e.tag == 'IGNORE':
+                    return True
+                relpath = os.path.dirname(relpath)
+            return False
+
+        # check for missing files
+        for relpath, e in sorted(entry_dict.items()):
+            if relpath in self.seen:
+                continue
+            if e.tag == 'IGNORE' or is_ignored(relpath):
+                continue
+            ret &= handle_failure(relpath, e, [('__exists__', True, False)])
+
+        return ret
+
+
+def get_tarball_write_mode(path):
+    """
+    Get the tarfile mode for writing a tarball stream at @path,
+    with compression matching the filename suffix.
+    """
+
+    base, ext = os.path.splitext(path)
+    if ext in ('.gz', '.tgz'):
+        return 'w|gz'
+    elif ext in ('.bz2', '.tbz', '.tbz2'):
+        return 'w|bz2'
+    elif ext in ('.xz', '.txz'):
+        return 'w|xz'
+    return 'w|'
+
+
+def update_entries_from_members(loader, members, prefix=''):
+    """
+    Create the Manifest entries in @loader for all regular files
+    in TarballMembers @members, inside the member directory @prefix.
+    The sub-Manifests are created where the loader profile wants them,
+    and the entry types are determined by the profile as well.
+
+    The loader needs to be created (with allow_create) in the directory
+    where the Manifests are going to be written. The members need
+    to be read using the loader hashes. Manifest files present
+    in the tarball are replaced in the directories where new Manifests
+    are created, and are treated like regular files otherwise.
+    You need to invoke save_manifests() afterwards.
+
+    Raises ManifestInvalidPath if a file in the tarball is not
+    a regular file or a directory.
+    """
+
+    hashes = loader.hashes
+    assert hashes is not None
+    # relpath -> (dirnames, filenames, Manifest filenames)
+    dirs = {'': (set(), [], [])}
+
+    def add_dir(relpath):
+        if relpath in dirs:
+            return
+        parent = os.path.dirname(relpath)
+        add_dir(parent)
+        dirs[parent][0].add(os.path.basename(relpath))
+        dirs[relpath] = (set(), [], [])
+
+    mprefix = os.path.join(prefix, '')
+    for name, ftype in members.types.items():
+        if not name.startswith(mprefix) or name == prefix:
+            continue
+        relpath = name[len(mprefix):]
+        # skip dotfiles
+        if any(x.startswith('.') for x in relpath.split('/')):
+            continue
+        if ftype == 'directory':
+            add_dir(relpath)
+            continue
+        dirpath, filename = os.path.split(relpath)
+        add_dir(dirpath)
+        if name not in members.checksums:
+            raise gemato.exceptions.ManifestInvalidPath(relpath,
+                    ('__type__', ftype))
+        if filename in MANIFEST_NAMES:
+            dirs[dirpath][2].append(filename)
+        else:
+            dirs[dirpath][1].append(filename)
+
+    manifest_stack = [(loader.top_level_manifest_filename, '',
+        loader.loaded_manifests[loader.top_level_manifest_filename])]
+    # process parent directories first, and subdirectories
+    # of a single directory together
+    for relpath in sorted(dirs, key=lambda x: x.split('/')):
+        dirnames, filenames, manifests = dirs[relpath]
+        while not gemato.util.path_starts_with(relpath,
+                manifest_stack[-1][1]):
+            manifest_stack.pop()
+
+        if relpath != '' and loader.profile.want_manifest_in_directory(
+                relpath, sorted(dirnames), sorted(filenames)):
+            mpath = os.path.join(relpath, 'Manifest')
+            syspath = os.path.join(loader.root_directory, relpath)
+            if not os.path.isdir(syspath):
+                os.makedirs(syspath)
+            m = loader.create_manifest(mpath)
+            pmpath, pmdir, pm = manifest_stack[-1]
+            pm.entries.append(gemato.manifest.ManifestEntryMANIFEST(
+                os.path.relpath(mpath, pmdir or '.'), 0, {}))
+            loader.updated_manifests.add(pmpath)
+            manifest_stack.append((mpath, relpath, m))
+
+        mpath, mdir, m = manifest_stack[-1]
+        if mdir != relpath:
+            # the original Manifests are kept if not replaced
+            filenames = filenames + manifests
+        for f in sorted(filenames):
+            fpath = os.path.join(relpath, f)
+            ftype = loader.profile.get_entry_type_for_path(fpath)
+            path = os.path.relpath(fpath, mdir or '.')
+            if ftype == 'AUX':
+                # AUX has implicit files/ prefix
+                assert gemato.util.path_inside_dir(path, 'files')
+                path = os.path.relpath(path, 'files')
+            checksums = members.checksums[os.path.join(prefix, fpath)]
+            m.entries.append(gemato.manifest.new_manifest_entry(ftype,
+                path, checksums['__size__'],
+                dict((h, checksums[h]) for h in hashes)))
+        if filenames:
+            loader.updated_manifests.add(mpath)
+
+
+def add_manifests_to_tarball(loader, out, prefix='', members=None):
+    """
+    Add all the Manifests saved by @loader to TarFile @out (open
+    for writing), inside the member directory @prefix.
+
+    If @members is not None, it specifies the TarballMembers
+    the Manifests were created for. The original Manifests from it
+    that were not replaced by update_entries_from_members() are
+    copied as well.
+    """
+
+    for mpath in sorted(loader.loaded_manifests):
+        out.add(os.path.join(loader.root_directory, mpath),
+                arcname=os.path.join(prefix, mpath), recursive=False)
+
+    if members is None:
+        return
+    mprefix = os.path.join(prefix, '')
+    for name in sorted(members.manifests):
+        if not name.startswith(mprefix):
+            continue
+        relpath = name[len(mprefix):]
+        # skip dotfiles
+        if any(x.startswith('.') for x in relpath.split('/')):
+            continue
+        mpath = os.path.join(os.path.dirname(relpath), 'Manifest')
+        if mpath in loader.loaded_manifests:
+            continue
+        data = members.manifests[name]
+        # hard links are stored as regular files
+        ti = copy.copy(members.manifest_members[name])
+        ti.type = tarfile.REGTYPE
+        ti.linkname = ''
+        ti.size = len(data)
+        out.addfile(ti, io.BytesIO(data))
@@ -3,6 +3,11 @@
 # (c) 2017 Michał Górny
 # Licensed under the terms of 2-clause BSD license
 
+import binascii
+import errno
+import os
+import os.path
+
 
 def path_starts_with(path, prefix):
     """
@@ -27,3 +32,81 @@ def throw_exception(e):
     to os.walk(). Useful for other callbacks.
     """
     raise e
+
+
+def create_temporary_file(path):
+    """
+    Create a new temporary file in the directory of @path, suitable
+    for replacing @path atomically via os.rename(). Unlike
+    tempfile.mkstemp(), the file is created with the permissions
+    of the existing @path, or the umask-default permissions if it
+    does not exist. Returns a tuple of file descriptor and path.
+    """
+
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        mode = None
+
+    prefix = os.path.join(os.path.dirname(path),
+            '.' + os.path.basename(path) + '.')
+    while True:
+        tmp_path = prefix + binascii.hexlify(os.urandom(6)).decode('ascii')
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY|os.O_CREAT|os.O_EXCL,
+                    0o666 if mode is None else mode)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            break
+
+    if mode is not None:
+        # override umask
+        try:
+            os.fchmod(fd, mode)
+        except:
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+    return (fd, tmp_path)
+
+
+def sync_files(paths, pool=None):
+    """
+    Sync the contents of files at @paths to disk. The files are synced
+    concurrently via @pool if it is not None, so that the filesystem
+    can group them into fewer journal commits.
+    """
+
+    fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+    def sync_one(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fdatasync(fd)
+        finally:
+            os.close(fd)
+
+    paths = list(paths)
+    if pool is not None and len(paths) > 1:
+        pool.map(sync_one, paths)
+    else:
+        for path in paths:
+            sync_one(path)
+
+
+def sync_directories(paths):
+    """
+    Sync the directories at @paths to disk, in order to make renames
+    inside them durable.
+    """
+
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
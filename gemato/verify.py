@@ -15,7 +15,29 @@ import gemato.hash
 import gemato.manifest
 
 
-def get_file_metadata(path, hashes):
+def get_file_type(st):
+    """
+    Get the human-readable description of file type for stat result
+    @st.
+    """
+
+    if stat.S_ISREG(st.st_mode):
+        return 'regular file'
+    elif stat.S_ISDIR(st.st_mode):
+        return 'directory'
+    elif stat.S_ISCHR(st.st_mode):
+        return 'character device'
+    elif stat.S_ISBLK(st.st_mode):
+        return 'block device'
+    elif stat.S_ISFIFO(st.st_mode):
+        return 'named pipe'
+    elif stat.S_ISSOCK(st.st_mode):
+        return 'UNIX socket'
+    else:
+        return 'unknown'
+
+
+def get_file_metadata(path, hashes, rate_limiter=None, stat_only=False):
     """
     Get a generator for the metadata of the file at system path @path.
 
@@ -30,11 +52,37 @@ def get_file_metadata(path, hashes):
     6. A dict of @hashes and their values, if the file exists and is
        a regular file. Special __size__ member is added unconditionally.
 
+    If @rate_limiter is not None, it is used to throttle opening
+    and reading the file (see gemato.ratelimit.RateLimiter).
+
+    If @stat_only is True, the file is not opened and the generator
+    terminates after yielding st_mtime.
+
     Note that the generator acquires resources, and does not release
     them until terminated. Always make sure to pull it until
     StopIteration, or close it explicitly.
     """
 
+    if stat_only:
+        try:
+            st = os.stat(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            yield False
+            return
+
+        yield True
+        yield st.st_dev
+        yield (stat.S_IFMT(st.st_mode), get_file_type(st))
+        if stat.S_ISREG(st.st_mode):
+            yield st.st_size
+            yield st.st_mtime
+        return
+
+    if rate_limiter is not None:
+        rate_limiter.file_opened()
+
     try:
         # we want O_NONBLOCK to avoid blocking when opening pipes
         fd = os.open(path, os.O_RDONLY|os.O_NONBLOCK)
@@ -69,21 +117,7 @@ def get_file_metadata(path, hashes):
         yield st.st_dev
 
         # 3. file type tuple
-        if stat.S_ISREG(st.st_mode):
-            ftype = 'regular file'
-        elif stat.S_ISDIR(st.st_mode):
-            ftype = 'directory'
-        elif stat.S_ISCHR(st.st_mode):
-            ftype = 'character device'
-        elif stat.S_ISBLK(st.st_mode):
-            ftype = 'block device'
-        elif stat.S_ISFIFO(st.st_mode):
-            ftype = 'named pipe'
-        elif stat.S_ISSOCK(st.st_mode):
-            ftype = 'UNIX socket'
-        else:
-            ftype = 'unknown'
-        yield (stat.S_IFMT(st.st_mode), ftype)
+        yield (stat.S_IFMT(st.st_mode), get_file_type(st))
 
         if not stat.S_ISREG(st.st_mode):
             if opened:
@@ -112,7 +146,8 @@ def get_file_metadata(path, hashes):
         hashes = list(gemato.manifest.manifest_hashes_to_hashlib(e_hashes))
         e_hashes.append('__size__')
         hashes.append('__size__')
-        checksums = gemato.hash.hash_file(f, hashes)
+        checksums = gemato.hash.hash_file(f, hashes,
+                rate_limiter=rate_limiter)
 
         ret = {}
         for ek, k in zip(e_hashes, hashes):
@@ -120,7 +155,68 @@ def get_file_metadata(path, hashes):
         yield ret
 
 
-def verify_path(path, e, expected_dev=None, last_mtime=None):
+class HashPolicy(object):
+    """
+    Policy selecting the subset of hashes in a Manifest entry that
+    are computed when verifying files. This can be used to avoid
+    computing multiple (or slow) hashes during verification, while
+    still storing all of them in the Manifests.
+    """
+
+    __slots__ = ['allowed', 'fastest', 'cache']
+
+    def __init__(self, allowed=None, fastest=False):
+        """
+        Create a new policy. If @allowed is not None, only the hashes
+        listed in it (using Manifest names) are used if the entry
+        contains any of them. If @fastest is True, only the single
+        hash with the highest throughput measured on this host
+        is used.
+
+        If the entry does not contain any of the allowed hashes,
+        all the hashes in the entry are used.
+        """
+
+        self.allowed = (frozenset(allowed) if allowed is not None
+                        else None)
+        self.fastest = fastest
+        self.cache = {}
+
+    def get_hash_speed(self, h):
+        """
+        Get the throughput of Manifest hash @h, or 0 if it is not
+        supported.
+        """
+
+        try:
+            return gemato.hash.get_hash_speed(
+                    gemato.manifest.MANIFEST_HASH_MAPPING[h])
+        except (KeyError, gemato.exceptions.UnsupportedHash):
+            return 0
+
+    def select(self, hashes):
+        """
+        Select the hashes to verify from @hashes, the Manifest names
+        of hashes in an entry. Returns a sorted tuple.
+        """
+
+        key = frozenset(hashes)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        ret = key
+        if self.allowed is not None:
+            ret = key & self.allowed or key
+        if self.fastest and ret:
+            ret = [max(sorted(ret), key=self.get_hash_speed)]
+        ret = self.cache[key] = tuple(sorted(ret))
+        return ret
+
+
+def verify_path(path, e, expected_dev=None, last_mtime=None,
+        rate_limiter=None, stat_only=False, hash_policy=None):
     """
     Verify the file at system path @path against the data in entry @e.
     The path/filename is not matched against the entry -- the correct
@@ -140,6 +236,18 @@ def verify_path(path, e, expected_dev=None, last_mtime=None):
     to the previous file verification. If the file is not newer
     than that, the checksum verification is skipped.
 
+    If @rate_limiter is not None, it is used to throttle the I/O
+    (see gemato.ratelimit.RateLimiter).
+
+    If @stat_only is True, only the data obtained from stat() (i.e.
+    existence, file type and size) is verified, without opening
+    the file. Note that the size can not be verified if the filesystem
+    reports st_size == 0.
+
+    If @hash_policy is not None, it is a HashPolicy instance selecting
+    the hashes that are computed and verified. Otherwise, all hashes
+    in the entry are verified.
+
     Each name can be:
     - __exists__ (boolean) to indicate whether the file existed,
     - __type__ (string) as a human-readable description of file type,
@@ -161,8 +269,11 @@ def verify_path(path, e, expected_dev=None, last_mtime=None):
     else:
         expect_exist = True
         checksums = e.checksums
+        if hash_policy is not None:
+            checksums = hash_policy.select(checksums)
 
-    with contextlib.closing(get_file_metadata(path, checksums)) as g:
+    with contextlib.closing(get_file_metadata(path, checksums,
+            rate_limiter=rate_limiter, stat_only=stat_only)) as g:
         # 1. verify whether the file existed in the first place
         exists = next(g)
         if exists != expect_exist:
@@ -185,6 +296,8 @@ def verify_path(path, e, expected_dev=None, last_mtime=None):
         st_size = next(g)
         if st_size != 0 and st_size != e.size:
             return (False, [('__size__', e.size, st_size)])
+        if stat_only:
+            return (True, [])
 
         # 5. skip checksums if file has not changed since the last time
         #    (and st_size != 0 since we can't trust weird filesystems)
@@ -201,7 +314,7 @@ def verify_path(path, e, expected_dev=None, last_mtime=None):
             diff.append(('__size__', e.size, size))
 
         # 7. verify the checksums
-        for h in sorted(e.checksums):
+        for h in sorted(checksums):
             exp = e.checksums[h]
             got = checksums[h]
             if got != exp:
@@ -213,6 +326,95 @@ def verify_path(path, e, expected_dev=None, last_mtime=None):
     return (True, [])
 
 
+class VerifyingSink(object):
+    """
+    A writable file-like object verifying the data written to it
+    against entry @e, as it is being received. The data is hashed
+    while it is written, so it does not need to be read again.
+
+    If @f is not None, the data is passed through to file object @f
+    (that is not closed by the sink). The data exceeding the size
+    in the entry is never written to @f.
+    """
+
+    __slots__ = ['entry', 'f', 'hashes', 'size', 'result']
+
+    def __init__(self, e, f=None):
+        assert e.tag not in ('IGNORE', 'TIMESTAMP')
+
+        self.entry = e
+        self.f = f
+        self.size = 0
+        self.result = None
+        self.hashes = {}
+        e_hashes = sorted(e.checksums)
+        for ek, k in zip(e_hashes,
+                gemato.manifest.manifest_hashes_to_hashlib(e_hashes)):
+            self.hashes[ek] = gemato.hash.get_hash_by_name(k)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_cb):
+        if not self.closed:
+            self.close()
+
+    @property
+    def closed(self):
+        return self.result is not None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """
+        Hash and write @data. Raises ManifestMismatch as soon
+        as the data exceeds the expected size. Returns the number
+        of bytes written.
+        """
+
+        if self.closed:
+            raise ValueError('I/O operation on closed sink')
+        size = self.size + len(data)
+        if size > self.entry.size:
+            self.result = (False, [('__size__', self.entry.size, size)])
+            raise gemato.exceptions.ManifestMismatch(self.entry.path,
+                    self.entry, self.result[1])
+        if self.f is not None:
+            self.f.write(data)
+        for h in self.hashes.values():
+            h.update(data)
+        self.size = size
+        return len(data)
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        """
+        Finish writing and verify the data. Returns (True, [])
+        if the data matches the entry, (False, diff) otherwise,
+        like verify_path(). The result is also stored in the result
+        property.
+        """
+
+        if self.result is not None:
+            return self.result
+
+        diff = []
+        if self.size != self.entry.size:
+            diff.append(('__size__', self.entry.size, self.size))
+        for h in sorted(self.entry.checksums):
+            exp = self.entry.checksums[h]
+            got = self.hashes[h].hexdigest()
+            if got != exp:
+                diff.append((h, exp, got))
+
+        self.result = (not diff, diff)
+        return self.result
+
+
 def update_entry_for_path(path, e, hashes=None, expected_dev=None,
         last_mtime=None):
     """
@@ -0,0 +1,79 @@
+# gemato: Changed file list parsing tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import unittest
+
+import gemato.changelist
+
+
+class GitNameStatusTest(unittest.TestCase):
+    def test_basic(self):
+        self.assertListEqual(
+            gemato.changelist.parse_git_name_status([
+                'M\tfoo/bar\n',
+                'A\tnew\n',
+                'D\told\n',
+                '\n',
+            ]),
+            ['foo/bar', 'new', 'old'])
+
+    def test_rename(self):
+        self.assertListEqual(
+            gemato.changelist.parse_git_name_status([
+                'R100\tfoo\tbar\n',
+                'C75\tbaz\tqux\n',
+            ]),
+            ['foo', 'bar', 'qux'])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError,
+            gemato.changelist.parse_git_name_status, ['foo bar\n'])
+        self.assertRaises(ValueError,
+            gemato.changelist.parse_git_name_status, ['M\tfoo\tbar\n'])
+
+
+class RsyncItemizeChangesTest(unittest.TestCase):
+    def test_basic(self):
+        self.assertListEqual(
+            gemato.changelist.parse_rsync_itemize_changes([
+                '>f.st...... foo/bar\n',
+                '>f+++++++++ new\n',
+                '.f..t...... attr-only\n',
+                '.d..t...... foo/\n',
+                'cd+++++++++ newdir/\n',
+                '*deleting   old\n',
+                '*deleting   olddir/\n',
+                'cL+++++++++ link -> target\n',
+                'sent 1234 bytes  received 56 bytes\n',
+            ]),
+            ['foo/bar', 'new', 'newdir', 'old', 'olddir', 'link'])
+
+    def test_old_format(self):
+        self.assertListEqual(
+            gemato.changelist.parse_rsync_itemize_changes([
+                '>f.st.... foo\n',
+            ]),
+            ['foo'])
+
+
+class ParseChangedFilesTest(unittest.TestCase):
+    def test_git(self):
+        self.assertListEqual(
+            gemato.changelist.parse_changed_files(
+                io.StringIO(u'M\tfoo\nD\tbar\n')),
+            ['foo', 'bar'])
+
+    def test_rsync(self):
+        self.assertListEqual(
+            gemato.changelist.parse_changed_files(
+                io.StringIO(u'\n>f.st...... foo\n*deleting   bar\n')),
+            ['foo', 'bar'])
+
+    def test_plain(self):
+        self.assertListEqual(
+            gemato.changelist.parse_changed_files(
+                io.StringIO(u'foo\nbar/baz\n\n')),
+            ['foo', 'bar/baz'])
@@ -5,10 +5,12 @@
 
 import base64
 import io
+import multiprocessing.pool
 import tempfile
 import unittest
 
 import gemato.compression
+import gemato.exceptions
 
 
 TEST_STRING = b'The quick brown fox jumps over the lazy dog'
@@ -647,6 +649,83 @@ class NoCompressionTest(unittest.TestCase):
                         [TEST_STRING.decode('utf8')])
 
 
+class CompressDataTests(unittest.TestCase):
+    """
+    Tests for compress_data().
+    """
+
+    # incompressible data followed by repetitive data, spanning
+    # multiple chunks
+    DATA = (b''.join(bytes(bytearray([(i * 7919) % 251 for i in range(251)]))
+                     for x in range(600))
+            + TEST_STRING * 10000)
+
+    def decompress(self, suffix, data):
+        with io.BytesIO(data) as f:
+            with gemato.compression.open_compressed_file(suffix, f,
+                    'rb') as cf:
+                return cf.read()
+
+    def test_gzip(self):
+        out = gemato.compression.compress_data('gz', self.DATA)
+        self.assertEqual(self.decompress('gz', out), self.DATA)
+
+    def test_gzip_level(self):
+        out1 = gemato.compression.compress_data('gz', self.DATA, level=1)
+        out9 = gemato.compression.compress_data('gz', self.DATA, level=9)
+        self.assertEqual(self.decompress('gz', out1), self.DATA)
+        self.assertEqual(self.decompress('gz', out9), self.DATA)
+        self.assertGreater(len(out1), len(out9))
+
+    def test_gzip_parallel(self):
+        pool = multiprocessing.pool.ThreadPool(4)
+        try:
+            out = gemato.compression.compress_data('gz', self.DATA,
+                    pool=pool)
+            empty = gemato.compression.compress_data('gz', b'', pool=pool)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(self.decompress('gz', out), self.DATA)
+        self.assertEqual(self.decompress('gz', empty), b'')
+        # the chunks must share a single gzip member
+        self.assertEqual(out.count(b'\x1f\x8b\x08'), 1)
+
+    def test_bzip2_level(self):
+        try:
+            out = gemato.compression.compress_data('bz2', self.DATA,
+                    level=1)
+        except gemato.exceptions.UnsupportedCompression:
+            raise unittest.SkipTest('bz2 compression unsupported')
+        self.assertEqual(self.decompress('bz2', out), self.DATA)
+
+    def test_bzip2_level_clamped(self):
+        try:
+            out = gemato.compression.compress_data('bz2', self.DATA,
+                    level=0)
+        except gemato.exceptions.UnsupportedCompression:
+            raise unittest.SkipTest('bz2 compression unsupported')
+        self.assertEqual(self.decompress('bz2', out), self.DATA)
+
+    def test_get_compression_level_range(self):
+        self.assertEqual(
+                gemato.compression.get_compression_level_range('gz'),
+                (0, 9))
+        self.assertEqual(
+                gemato.compression.get_compression_level_range('bz2'),
+                (1, 9))
+        self.assertRaises(gemato.exceptions.UnsupportedCompression,
+                gemato.compression.get_compression_level_range, 'foo')
+
+    def test_xz_level(self):
+        try:
+            out = gemato.compression.compress_data('xz', self.DATA,
+                    level=0)
+        except gemato.exceptions.UnsupportedCompression:
+            raise unittest.SkipTest('xz compression unsupported')
+        self.assertEqual(self.decompress('xz', out), self.DATA)
+
+
 class OtherUtilityTests(unittest.TestCase):
     def test_get_potential_compressed_names(self):
         self.assertSetEqual(frozenset(gemato.compression
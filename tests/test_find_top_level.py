@@ -8,7 +8,9 @@ import os
 import os.path
 import unittest
 
+import gemato.exceptions
 import gemato.find_top_level
+import gemato.manifest
 
 from tests.testutil import TempDirTestCase
 
@@ -280,3 +282,134 @@ class TestCompressedManifestWithIgnore(TempDirTestCase):
                         os.path.join(self.dir, 'subc', 'sub')),
                     self.dir),
                 'subc/sub/Manifest.gz')
+
+
+class TestSignedManifestWithIgnore(TempDirTestCase):
+    """
+    Test for finding top-level Manifest when IGNORE entries are
+    inside an OpenPGP-signed Manifest.
+    """
+
+    DIRS = ['suba', 'subb']
+    FILES = {
+        'Manifest': u'''
+-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA256
+
+IGNORE suba
+-----BEGIN PGP SIGNATURE-----
+
+iQEzBAEBCAAdFiEEDJhRPAtB0CEWqoSvDeVgQuIL7rMFAll0WDAACgkQDeVgQuIL
+7rOLGwgAkIfEVvgVTW2Pbz4RH4sIUDSGdT+jjzRVNvLu7ud6bJv0qAlDQ6/pDyhx
+-----END PGP SIGNATURE-----
+''',
+        'subb/Manifest': u'',
+    }
+
+    def test_find_top_level_manifest_from_ignored_subdir(self):
+        self.assertIsNone(
+                gemato.find_top_level.find_top_level_manifest(
+                    os.path.join(self.dir, 'suba')))
+
+    def test_find_top_level_manifest_from_manifest_subdir(self):
+        self.assertEqual(
+                os.path.relpath(
+                    gemato.find_top_level.find_top_level_manifest(
+                        os.path.join(self.dir, 'subb')),
+                    self.dir),
+                'Manifest')
+
+
+class TestAuxEntryWithIgnore(TempDirTestCase):
+    """
+    Test for finding top-level Manifest when an AUX entry with
+    the same name precedes the IGNORE entry.
+    """
+
+    DIRS = ['ignored']
+    FILES = {
+        'Manifest': u'''
+AUX ignored 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+IGNORE ignored
+''',
+        'ignored/Manifest': u'',
+    }
+
+    def test_find_top_level_manifest_from_ignored_subdir(self):
+        self.assertEqual(
+                os.path.relpath(
+                    gemato.find_top_level.find_top_level_manifest(
+                        os.path.join(self.dir, 'ignored')),
+                    self.dir),
+                'ignored/Manifest')
+
+
+class TestInvalidManifest(TempDirTestCase):
+    """
+    Test for finding top-level Manifest when a file called Manifest
+    is not a valid Manifest.
+    """
+
+    FILES = {
+        'Manifest': u'''
+This is not a Manifest.
+''',
+    }
+
+    def test_find_top_level_manifest(self):
+        self.assertRaises(gemato.exceptions.ManifestSyntaxError,
+                gemato.find_top_level.find_top_level_manifest, self.dir)
+
+
+class TestFinderReuse(TempDirTestCase):
+    """
+    Test for finding top-level Manifests for multiple paths using
+    a shared finder.
+    """
+
+    DIRS = ['suba', 'subb', 'subc', 'subc/sub']
+    FILES = {
+        'Manifest': u'IGNORE suba\n',
+        'subb/Manifest': u'',
+        'subc/sub/Manifest': u'',
+    }
+
+    def test_find_top_level_manifests(self):
+        paths = [os.path.join(self.dir, x)
+                 for x in ('', 'suba', 'subb', 'subc/sub')]
+        tlms = gemato.find_top_level.find_top_level_manifests(paths)
+        self.assertEqual(
+                [os.path.relpath(x, self.dir) if x is not None else None
+                 for x in tlms],
+                ['Manifest', None, 'Manifest', 'Manifest'])
+
+    def test_directory_cache(self):
+        finder = gemato.find_top_level.TopLevelManifestFinder()
+        finder.find(os.path.join(self.dir, 'subc/sub'))
+        cached = len(finder.dir_cache)
+        self.assertEqual(
+                os.path.relpath(
+                    finder.find(os.path.join(self.dir, 'subc')),
+                    self.dir),
+                'Manifest')
+        # subc and all its parents were listed already
+        self.assertEqual(len(finder.dir_cache), cached)
+
+    def test_manifest_cache(self):
+        loads = []
+        orig_load = gemato.manifest.ManifestFile.load
+
+        def counting_load(self, *args, **kwargs):
+            loads.append(True)
+            return orig_load(self, *args, **kwargs)
+
+        gemato.manifest.ManifestFile.load = counting_load
+        try:
+            tlms = gemato.find_top_level.find_top_level_manifests(
+                    [os.path.join(self.dir, x)
+                     for x in ('', 'suba', 'subb', 'subc', 'subc/sub')])
+        finally:
+            gemato.manifest.ManifestFile.load = orig_load
+        self.assertEqual(len([x for x in tlms if x is not None]), 4)
+        # every Manifest is parsed once
+        self.assertEqual(len(loads), 3)
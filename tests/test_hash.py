@@ -276,3 +276,15 @@ class SizeHashTest(unittest.TestCase):
 
     def test_size_empty(self):
         self.assertEqual(gemato.hash.hash_bytes(b'', '__size__'), 0)
+
+
+class HashSpeedTest(unittest.TestCase):
+    def test_speed(self):
+        speed = gemato.hash.get_hash_speed('md5')
+        self.assertGreater(speed, 0)
+        # the value is cached
+        self.assertEqual(gemato.hash.get_hash_speed('md5'), speed)
+
+    def test_unsupported(self):
+        self.assertRaises(gemato.exceptions.UnsupportedHash,
+                gemato.hash.get_hash_speed, 'unknown-hash')
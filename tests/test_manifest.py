@@ -360,6 +360,24 @@ class ManifestEntryTest(unittest.TestCase):
 
 
 class ManifestUtilityTest(unittest.TestCase):
+    def test_manifest_entry_sort_key(self):
+        m = gemato.manifest.ManifestFile()
+        m.load(io.StringIO(TEST_MANIFEST + TEST_DEPRECATED_MANIFEST))
+        self.assertListEqual(
+                sorted(m.entries, key=gemato.manifest.manifest_entry_sort_key),
+                sorted(m.entries))
+
+    def test_dump_chunks(self):
+        m = gemato.manifest.ManifestFile()
+        m.entries = [gemato.manifest.ManifestEntryDATA(
+                        'test{}'.format(i), i, {})
+                     for i in range(gemato.manifest.DUMP_CHUNK_LINES + 1)]
+        with io.StringIO() as f:
+            m.dump(f)
+            self.assertEqual(f.getvalue(),
+                    u''.join(u'DATA test{0} {0}\n'.format(i)
+                             for i in range(len(m.entries))))
+
     def test_manifest_hashes_to_hashlib(self):
         self.assertListEqual(list(
                 gemato.manifest.manifest_hashes_to_hashlib(['MD5', 'SHA1'])),
@@ -15,6 +15,7 @@ import gemato.compression
 import gemato.manifest
 import gemato.openpgp
 import gemato.recursiveloader
+import gemato.state
 
 
 PUBLIC_KEY = b'''
@@ -319,6 +320,24 @@ class OpenPGPCorrectKeyTest(unittest.TestCase):
             self.assertRaises(gemato.exceptions.OpenPGPVerificationFailure,
                     self.env.verify_file, f)
 
+    def test_stream_verifier(self):
+        v = gemato.openpgp.OpenPGPStreamVerifier(env=self.env)
+        for l in io.StringIO(SIGNED_MANIFEST):
+            v.write(l)
+        v.finish()
+
+    def test_stream_verifier_modified(self):
+        v = gemato.openpgp.OpenPGPStreamVerifier(env=self.env)
+        for l in io.StringIO(MODIFIED_SIGNED_MANIFEST):
+            v.write(l)
+        self.assertRaises(gemato.exceptions.OpenPGPVerificationFailure,
+                v.finish)
+
+    def test_stream_verifier_abort(self):
+        v = gemato.openpgp.OpenPGPStreamVerifier(env=self.env)
+        v.write(SIGNED_MANIFEST[:100])
+        v.abort()
+
     def test_manifest_load(self):
         m = gemato.manifest.ManifestFile()
         with io.StringIO(SIGNED_MANIFEST) as f:
@@ -395,6 +414,199 @@ class OpenPGPCorrectKeyTest(unittest.TestCase):
             shutil.rmtree(d)
 
 
+class SignatureCacheTest(unittest.TestCase):
+    """
+    Tests for caching OpenPGP verification results.
+    """
+
+    def setUp(self):
+        self.env = gemato.openpgp.OpenPGPEnvironment()
+        try:
+            self.env.import_key(io.BytesIO(PUBLIC_KEY))
+        except gemato.exceptions.OpenPGPNoImplementation as e:
+            self.env.close()
+            raise unittest.SkipTest(str(e))
+        except RuntimeError:
+            self.env.close()
+            raise unittest.SkipTest('Unable to import OpenPGP key')
+        self.now = 1000
+        self.cache = gemato.state.SignatureCache(ttl=60,
+                clock=lambda: self.now)
+        self.calls = 0
+        self.orig_verify_file = gemato.openpgp.verify_file
+
+        def counting_verify_file(*args, **kwargs):
+            self.calls += 1
+            return self.orig_verify_file(*args, **kwargs)
+
+        gemato.openpgp.verify_file = counting_verify_file
+
+    def tearDown(self):
+        gemato.openpgp.verify_file = self.orig_verify_file
+        self.env.close()
+
+    def load(self, data, env=None):
+        m = gemato.manifest.ManifestFile()
+        with io.StringIO(data) as f:
+            m.load(f, openpgp_env=env or self.env,
+                    openpgp_cache=self.cache)
+        self.assertTrue(m.openpgp_signed)
+        self.assertIsNotNone(m.find_path_entry('myebuild-0.ebuild'))
+
+    def test_fingerprints(self):
+        self.assertEqual(len(self.env.fingerprints), 1)
+
+    def test_cached(self):
+        self.load(SIGNED_MANIFEST)
+        self.assertEqual(self.calls, 1)
+        self.load(SIGNED_MANIFEST)
+        self.assertEqual(self.calls, 1)
+        # different data is verified again
+        self.load(DASH_ESCAPED_SIGNED_MANIFEST)
+        self.assertEqual(self.calls, 2)
+
+    def test_expired(self):
+        self.load(SIGNED_MANIFEST)
+        self.now += 60
+        self.load(SIGNED_MANIFEST)
+        self.assertEqual(self.calls, 2)
+
+    def test_modified(self):
+        for i in range(2):
+            self.assertRaises(gemato.exceptions.OpenPGPVerificationFailure,
+                    self.load, MODIFIED_SIGNED_MANIFEST)
+        self.assertEqual(self.calls, 2)
+
+    def test_different_keyring(self):
+        self.load(SIGNED_MANIFEST)
+        with gemato.openpgp.OpenPGPEnvironment() as env:
+            self.assertRaises(gemato.exceptions.OpenPGPVerificationFailure,
+                    self.load, SIGNED_MANIFEST, env)
+        self.assertEqual(self.calls, 2)
+
+    def test_persistent(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'cache')
+            self.cache = gemato.state.SignatureCache(path)
+            self.load(SIGNED_MANIFEST)
+            self.cache.save()
+            self.cache = gemato.state.SignatureCache(path)
+            self.load(SIGNED_MANIFEST)
+            self.assertEqual(self.calls, 1)
+        finally:
+            shutil.rmtree(d)
+
+    def test_cli(self):
+        d = tempfile.mkdtemp()
+        try:
+            with io.open(os.path.join(d, '.key.asc'), 'wb') as f:
+                f.write(PUBLIC_KEY)
+            with io.open(os.path.join(d, 'Manifest'), 'w') as f:
+                f.write(SIGNED_MANIFEST)
+            os.mkdir(os.path.join(d, 'eclass'))
+            with io.open(os.path.join(d, 'eclass/Manifest'), 'w'):
+                pass
+            for fn in ('myebuild-0.ebuild', 'metadata.xml'):
+                with io.open(os.path.join(d, fn), 'w'):
+                    pass
+
+            args = ['gemato', 'verify',
+                    '--openpgp-key', os.path.join(d, '.key.asc'),
+                    '--openpgp-cache', os.path.join(d, '.cache'),
+                    '--require-signed-manifest', d]
+            self.assertEqual(gemato.cli.main(args), 0)
+            self.assertEqual(gemato.cli.main(args), 0)
+            self.assertEqual(self.calls, 1)
+        finally:
+            shutil.rmtree(d)
+
+
+class KeyringCacheTest(unittest.TestCase):
+    """
+    Tests for persistent keyring cache.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = 0
+        self.orig_spawn_gpg = gemato.openpgp._spawn_gpg
+
+        def counting_spawn_gpg(options, *args, **kwargs):
+            if '--import' in options:
+                self.calls += 1
+            return self.orig_spawn_gpg(options, *args, **kwargs)
+
+        gemato.openpgp._spawn_gpg = counting_spawn_gpg
+
+    def tearDown(self):
+        gemato.openpgp._spawn_gpg = self.orig_spawn_gpg
+        shutil.rmtree(self.dir)
+
+    def open_env(self, key=PUBLIC_KEY):
+        try:
+            return gemato.openpgp.open_cached_environment(
+                    io.BytesIO(key), os.path.join(self.dir, 'cache'))
+        except gemato.exceptions.OpenPGPNoImplementation as e:
+            raise unittest.SkipTest(str(e))
+
+    def test_reuse(self):
+        with self.open_env() as env:
+            fingerprints = env.fingerprints
+            with io.StringIO(SIGNED_MANIFEST) as f:
+                env.verify_file(f)
+        self.assertEqual(len(fingerprints), 1)
+        with self.open_env() as env:
+            self.assertEqual(env.fingerprints, fingerprints)
+            with io.StringIO(SIGNED_MANIFEST) as f:
+                env.verify_file(f)
+            home = env.home
+        self.assertEqual(self.calls, 1)
+        # persistent keyring is not removed
+        self.assertTrue(os.path.isdir(home))
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'cache')),
+                [os.path.basename(home)])
+
+    def test_different_key(self):
+        with self.open_env():
+            pass
+        with self.open_env(PUBLIC_KEY + b'\n'):
+            pass
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'cache'))),
+                2)
+
+    def test_malformed_key(self):
+        self.assertRaises(RuntimeError, self.open_env,
+                b'-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmalformed\n')
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'cache')), [])
+
+    def test_cli(self):
+        d = os.path.join(self.dir, 'repo')
+        os.mkdir(d)
+        with io.open(os.path.join(d, '.key.asc'), 'wb') as f:
+            f.write(PUBLIC_KEY)
+        with io.open(os.path.join(d, 'Manifest'), 'w') as f:
+            f.write(SIGNED_MANIFEST)
+        os.mkdir(os.path.join(d, 'eclass'))
+        with io.open(os.path.join(d, 'eclass/Manifest'), 'w'):
+            pass
+        for fn in ('myebuild-0.ebuild', 'metadata.xml'):
+            with io.open(os.path.join(d, fn), 'w'):
+                pass
+
+        args = ['gemato', 'verify',
+                '--openpgp-key', os.path.join(d, '.key.asc'),
+                '--openpgp-keyring-cache', os.path.join(self.dir, 'cache'),
+                '--require-signed-manifest', d, os.path.join(d, 'eclass')]
+        try:
+            self.assertEqual(gemato.cli.main(args), 0)
+        except gemato.exceptions.OpenPGPNoImplementation as e:
+            raise unittest.SkipTest(str(e))
+        self.assertEqual(gemato.cli.main(args), 0)
+        self.assertEqual(self.calls, 1)
+
+
 class OpenPGPNoKeyTest(unittest.TestCase):
     """
     Tests performed without correct OpenPGP key set.
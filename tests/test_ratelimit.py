@@ -0,0 +1,174 @@
+# gemato: Rate limiting tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import os
+import sys
+import threading
+import unittest
+
+import gemato.cli
+import gemato.hash
+import gemato.ratelimit
+import gemato.recursiveloader
+
+from tests.testutil import TempDirTestCase
+
+
+class FakeClock(object):
+    """
+    A fake time source whose sleep() advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, t):
+        self.sleeps.append(t)
+        self.now += t
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_bucket(self, rate, capacity=None):
+        return gemato.ratelimit.TokenBucket(rate, capacity,
+                clock=self.clock.clock, sleep=self.clock.sleep)
+
+    def test_within_capacity(self):
+        b = self.make_bucket(100)
+        b.consume(50)
+        b.consume(50)
+        self.assertListEqual(self.clock.sleeps, [])
+
+    def test_over_capacity(self):
+        b = self.make_bucket(100)
+        b.consume(100)
+        b.consume(50)
+        self.assertListEqual(self.clock.sleeps, [0.5])
+
+    def test_refill(self):
+        b = self.make_bucket(100)
+        b.consume(100)
+        self.clock.now += 1
+        b.consume(100)
+        self.assertListEqual(self.clock.sleeps, [])
+
+    def test_refill_capped(self):
+        b = self.make_bucket(100)
+        self.clock.now += 10
+        b.consume(300)
+        self.assertListEqual(self.clock.sleeps, [2.0])
+
+    def test_sustained_rate(self):
+        b = self.make_bucket(100, capacity=1)
+        for i in range(10):
+            b.consume(100)
+        self.assertAlmostEqual(self.clock.now, 9.99, places=5)
+
+    def test_threads(self):
+        b = gemato.ratelimit.TokenBucket(100000, clock=lambda: 0.0,
+                sleep=lambda t: None)
+
+        def worker():
+            for i in range(10000):
+                b.consume(1)
+
+        # switch threads as often as possible to expose races
+        # (py3 only)
+        orig_interval = None
+        if hasattr(sys, 'setswitchinterval'):
+            orig_interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=worker) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            if orig_interval is not None:
+                sys.setswitchinterval(orig_interval)
+        self.assertEqual(b.tokens, 20000)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_bytes(self):
+        l = gemato.ratelimit.RateLimiter(bytes_per_second=16,
+                clock=self.clock.clock, sleep=self.clock.sleep)
+        f = io.BytesIO(b'x' * 64)
+        gemato.hash.hash_file(f, ('md5',), rate_limiter=l)
+        self.assertAlmostEqual(self.clock.now, 3, places=5)
+
+    def test_files(self):
+        l = gemato.ratelimit.RateLimiter(files_per_second=2,
+                clock=self.clock.clock, sleep=self.clock.sleep)
+        for i in range(6):
+            l.file_opened()
+            l.data_read(4096)
+        self.assertAlmostEqual(self.clock.now, 2, places=5)
+
+    def test_unlimited(self):
+        l = gemato.ratelimit.RateLimiter()
+        l.file_opened()
+        l.data_read(4096)
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(gemato.ratelimit.parse_size('512'), 512)
+        self.assertEqual(gemato.ratelimit.parse_size('64K'), 65536)
+        self.assertEqual(gemato.ratelimit.parse_size('20m'), 20971520)
+        self.assertEqual(gemato.ratelimit.parse_size('1.5G'), 1610612736)
+
+    def test_parse_size_invalid(self):
+        self.assertRaises(ValueError, gemato.ratelimit.parse_size, 'foo')
+        self.assertRaises(ValueError, gemato.ratelimit.parse_size, '0')
+        self.assertRaises(ValueError, gemato.ratelimit.parse_size, '-5M')
+
+    def test_parse_ionice(self):
+        self.assertEqual(gemato.ratelimit.parse_ionice('idle'),
+                ('idle', None))
+        self.assertEqual(gemato.ratelimit.parse_ionice('best-effort:7'),
+                ('best-effort', 7))
+
+    def test_parse_ionice_invalid(self):
+        self.assertRaises(ValueError, gemato.ratelimit.parse_ionice,
+                'foo')
+        self.assertRaises(ValueError, gemato.ratelimit.parse_ionice,
+                'best-effort:8')
+
+
+class RateLimitedVerificationTest(TempDirTestCase):
+    FILES = {
+        'Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'test': u'test string',
+    }
+
+    def test_assert_directory_verifies(self):
+        clock = FakeClock()
+        l = gemato.ratelimit.RateLimiter(bytes_per_second=1,
+                files_per_second=1,
+                clock=clock.clock, sleep=clock.sleep)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        self.assertTrue(m.assert_directory_verifies(rate_limiter=l))
+        self.assertGreater(clock.now, 9)
+
+    def test_cli(self):
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', '--max-rate=1M',
+                '--max-file-rate=1000', '--nice=0', self.dir]),
+            0)
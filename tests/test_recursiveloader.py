@@ -12,7 +12,9 @@ import unittest
 
 import gemato.cli
 import gemato.exceptions
+import gemato.profile
 import gemato.recursiveloader
+import gemato.verify
 
 from tests.testutil import TempDirTestCase
 
@@ -2610,3 +2612,594 @@ DATA test 11 MD5 5f8db599de986fab7a21625b7916589c
         m.update_entries_for_directory('', last_mtime=st.st_mtime)
         self.assertEqual(m.find_path_entry('test').checksums['MD5'],
                 '5f8db599de986fab7a21625b7916589c')
+
+
+class StatOnlyVerificationTest(TempDirTestCase):
+    """
+    Tests for stat-only verification.
+    """
+
+    DIRS = ['sub']
+    FILES = {
+        'Manifest': u'''
+MANIFEST sub/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+DATA test 11 MD5 5f8db599de986fab7a21625b7916589c
+DATA other 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'sub/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'test': u'test string',
+        'other': u'test string',
+        'sub/test': u'test string',
+    }
+
+    def test_checksums_not_verified(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        self.assertTrue(m.assert_directory_verifies('', stat_only=True))
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                m.assert_directory_verifies, '')
+
+    def test_size_mismatch(self):
+        with io.open(os.path.join(self.dir, 'sub/test'), 'w',
+                encoding='utf8') as f:
+            f.write(u'test')
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                m.assert_directory_verifies, '', stat_only=True)
+
+    def test_missing_and_stray(self):
+        os.rename(os.path.join(self.dir, 'other'),
+                os.path.join(self.dir, 'stray'))
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        failures = []
+
+        def fail_handler(e):
+            failures.append((e.path, e.diff[0][0]))
+            return False
+
+        self.assertFalse(m.assert_directory_verifies('', stat_only=True,
+            fail_handler=fail_handler))
+        self.assertEqual(sorted(failures),
+                [('other', '__exists__'), ('stray', '__exists__')])
+
+    def test_cli(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify',
+            '--level=stat', self.dir]), 0)
+        self.assertEqual(gemato.cli.main(['gemato', 'verify', self.dir]),
+            1)
+
+
+class HashPolicyVerificationTest(TempDirTestCase):
+    """
+    Tests for verification with a subset of hashes.
+    """
+
+    FILES = {
+        'Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c SHA1 761295c9cbf9d6b2f6428414504a8deed3020641
+''',
+        'test': u'test string',
+    }
+
+    def test_assert_directory_verifies(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        self.assertTrue(m.assert_directory_verifies('',
+            hash_policy=gemato.verify.HashPolicy(allowed=['MD5'])))
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                m.assert_directory_verifies, '',
+                hash_policy=gemato.verify.HashPolicy(allowed=['SHA1']))
+
+    def test_cli(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify',
+            '--verify-hashes=MD5', self.dir]), 0)
+        self.assertEqual(gemato.cli.main(['gemato', 'verify',
+            '--verify-hashes=SHA1 SHA512', self.dir]), 1)
+
+
+class UpdateEntriesForPathsTest(TempDirTestCase):
+    """
+    Tests for change list-driven updates.
+    """
+
+    DIRS = ['a', 'b', 'c']
+    FILES = {
+        'Manifest': u'''
+MANIFEST a/Manifest 50 MD5 0f7cd9ed779a4844f98d28315dd9176a
+MANIFEST b/Manifest 50 MD5 0f7cd9ed779a4844f98d28315dd9176a
+DATA test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+DATA c/test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'test': u'',
+        'a/Manifest': u'''
+DATA test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'a/test': u'',
+        'b/Manifest': u'''
+DATA test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'b/test': u'',
+        'c/test': u'',
+    }
+
+    def setUp(self):
+        super(UpdateEntriesForPathsTest, self).setUp()
+        self.m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'), hashes=['MD5'])
+
+    def write(self, path, data=u'test string'):
+        with io.open(os.path.join(self.dir, path), 'w',
+                encoding='utf8') as f:
+            f.write(data)
+
+    def test_modified_file(self):
+        self.write('a/test')
+        self.m.update_entries_for_paths(['a/test'])
+        self.assertNotIn('b/Manifest', self.m.loaded_manifests)
+        self.assertEqual(self.m.find_path_entry('a/test').checksums['MD5'],
+                '6f8db599de986fab7a21625b7916589c')
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_new_and_removed_files(self):
+        self.write('a/new')
+        os.unlink(os.path.join(self.dir, 'b/test'))
+        self.m.update_entries_for_paths(['a/new', 'b/test'])
+        self.assertEqual(self.m.find_path_entry('a/new').path, 'new')
+        self.assertIsNone(self.m.find_path_entry('b/test'))
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_removed_directory(self):
+        os.unlink(os.path.join(self.dir, 'b/Manifest'))
+        os.unlink(os.path.join(self.dir, 'b/test'))
+        os.rmdir(os.path.join(self.dir, 'b'))
+        self.m.update_entries_for_paths(['b/Manifest', 'b/test'])
+        self.assertNotIn('b/Manifest', self.m.loaded_manifests)
+        self.assertIsNone(self.m.find_path_entry('b/Manifest'))
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_modified_sub_manifest(self):
+        self.write('a/new', u'')
+        self.write('a/Manifest', u'''
+DATA test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+DATA new 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''')
+        self.m.update_entries_for_paths(['a/Manifest', 'a/new'])
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_new_sub_manifest(self):
+        self.write('c/Manifest', u'''
+DATA test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''')
+        self.m.update_entries_for_paths(['c/Manifest', 'c/test'])
+        self.assertEqual(self.m.find_path_entry('c/Manifest').path,
+                'c/Manifest')
+        self.assertEqual(self.m.find_path_entry('c/test').path, 'test')
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_new_directory(self):
+        os.mkdir(os.path.join(self.dir, 'd'))
+        self.write('d/test')
+        self.m.update_entries_for_paths(['d/test'])
+        self.assertEqual(self.m.find_path_entry('d/test').path, 'd/test')
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_new_directory_with_manifest(self):
+        os.mkdir(os.path.join(self.dir, 'd'))
+        self.write('d/test')
+        self.write('d/metadata.xml', u'')
+        self.m.profile = gemato.profile.EbuildRepositoryProfile()
+        self.m.update_entries_for_paths(['d/metadata.xml', 'd/test'])
+        self.assertIn('d/Manifest', self.m.loaded_manifests)
+        self.assertEqual(self.m.find_path_entry('d/test').path, 'test')
+        self.m.save_manifests()
+        gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest')).assert_directory_verifies()
+
+    def test_directory(self):
+        self.write('c/new')
+        self.m.update_entries_for_paths(['c'])
+        self.assertEqual(self.m.find_path_entry('c/new').path, 'c/new')
+
+    def test_dotfile(self):
+        self.write('.new')
+        self.m.update_entries_for_paths(['.new', 'c/.new'])
+        self.assertIsNone(self.m.find_path_entry('.new'))
+        self.assertIsNone(self.m.find_path_entry('c/.new'))
+
+    def test_cli(self):
+        self.write('a/new')
+        os.unlink(os.path.join(self.dir, 'b/test'))
+        self.write('.changes', u'A\ta/new\nD\tb/test\nM\tc/test\n')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'update', '--hashes=MD5',
+                '--changed-files', os.path.join(self.dir, '.changes'),
+                self.dir]),
+            0)
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', self.dir]),
+            0)
+
+
+class CLIPathGroupingTest(TempDirTestCase):
+    """
+    Tests for verifying multiple paths in the same tree.
+    """
+
+    DIRS = ['a', 'b', 'c']
+    FILES = {
+        'Manifest': u'''
+MANIFEST a/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+MANIFEST b/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+MANIFEST c/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+''',
+        'a/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'b/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'c/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'a/test': u'test string',
+        'b/test': u'test string',
+        'c/test': u'TEST STRING',
+    }
+
+    def setUp(self):
+        super(CLIPathGroupingTest, self).setUp()
+        self.loads = []
+        self.orig_load_manifest = (
+                gemato.recursiveloader.ManifestRecursiveLoader.load_manifest)
+        loads = self.loads
+        orig = self.orig_load_manifest
+
+        def counting_load_manifest(self, relpath, *args, **kwargs):
+            loads.append(relpath)
+            return orig(self, relpath, *args, **kwargs)
+
+        gemato.recursiveloader.ManifestRecursiveLoader.load_manifest = (
+                counting_load_manifest)
+
+    def tearDown(self):
+        gemato.recursiveloader.ManifestRecursiveLoader.load_manifest = (
+                self.orig_load_manifest)
+        super(CLIPathGroupingTest, self).tearDown()
+
+    def test_one_load(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify',
+            os.path.join(self.dir, 'a'), os.path.join(self.dir, 'b'),
+            os.path.join(self.dir, 'a')]), 0)
+        self.assertEqual(sorted(self.loads),
+                ['Manifest', 'a/Manifest', 'b/Manifest'])
+
+    def test_nested_paths(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify',
+            os.path.join(self.dir, 'a'), self.dir]), 1)
+        self.assertEqual(sorted(self.loads),
+                ['Manifest', 'a/Manifest', 'b/Manifest', 'c/Manifest'])
+
+    def test_parallel(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify', '-j', '3',
+            os.path.join(self.dir, 'a'), os.path.join(self.dir, 'b')]), 0)
+        self.assertEqual(sorted(self.loads),
+                ['Manifest', 'a/Manifest', 'b/Manifest'])
+
+    def test_parallel_failure(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify', '-j', '3',
+            '-k', os.path.join(self.dir, 'a'), os.path.join(self.dir, 'b'),
+            os.path.join(self.dir, 'c')]), 1)
+        self.assertEqual(gemato.cli.main(['gemato', 'verify', '-j', '3',
+            os.path.join(self.dir, 'a'), os.path.join(self.dir, 'b'),
+            os.path.join(self.dir, 'c')]), 1)
+
+
+class VerifyDistfilesTest(TempDirTestCase):
+    """
+    Tests for bulk distfile verification.
+    """
+
+    DIRS = ['distfiles', 'sub', 'distfiles/subdir']
+    FILES = {
+        'Manifest': u'''
+IGNORE distfiles
+MANIFEST sub/Manifest 170 MD5 ee7643074fa2384eaa6ec8b3dabe12c3
+DIST top-1.txt 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'sub/Manifest': u'''
+DIST good-1.txt 11 MD5 6f8db599de986fab7a21625b7916589c
+DIST bad-1.txt 11 MD5 6f8db599de986fab7a21625b7916589c
+DIST missing-1.txt 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'distfiles/top-1.txt': u'',
+        'distfiles/good-1.txt': u'test string',
+        'distfiles/bad-1.txt': u'TEST STRING',
+        'distfiles/unknown-1.txt': u'',
+        'distfiles/.hidden': u'',
+    }
+
+    def setUp(self):
+        super(VerifyDistfilesTest, self).setUp()
+        self.distdir = os.path.join(self.dir, 'distfiles')
+        self.m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+
+    def verify(self, **kwargs):
+        failures = []
+
+        def fail_handler(e):
+            failures.append((e.path, e.diff[0][0]))
+            return False
+
+        ret = self.m.verify_distfiles(self.distdir,
+                fail_handler=fail_handler, **kwargs)
+        return ret, failures
+
+    def test_verify_distfiles(self):
+        self.assertEqual(self.verify(),
+            (False, [('bad-1.txt', 'MD5'),
+                     ('missing-1.txt', '__exists__'),
+                     ('unknown-1.txt', '__exists__')]))
+
+    def test_verify_distfiles_serial(self):
+        self.assertEqual(self.verify(jobs=1),
+            (False, [('bad-1.txt', 'MD5'),
+                     ('missing-1.txt', '__exists__'),
+                     ('unknown-1.txt', '__exists__')]))
+
+    def test_verify_distfiles_ignore_missing_unknown(self):
+        self.assertEqual(
+            self.verify(check_missing=False, check_unknown=False),
+            (False, [('bad-1.txt', 'MD5')]))
+
+    def test_verify_distfiles_good(self):
+        os.unlink(os.path.join(self.distdir, 'bad-1.txt'))
+        os.unlink(os.path.join(self.distdir, 'unknown-1.txt'))
+        self.assertEqual(self.verify(check_missing=False), (True, []))
+
+    def test_verify_distfiles_default_fail_handler(self):
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.m.verify_distfiles, self.distdir)
+
+    def test_cli(self):
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify-distfiles', '-k',
+                self.distdir, self.dir]),
+            1)
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify-distfiles',
+                '--ignore-missing', '--ignore-unknown', '-j', '2',
+                self.distdir, self.dir]),
+            1)
+        os.unlink(os.path.join(self.distdir, 'bad-1.txt'))
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify-distfiles',
+                '--ignore-missing', '--ignore-unknown',
+                self.distdir, self.dir]),
+            0)
+
+
+class ConcurrentCompressionTest(TempDirTestCase):
+    """
+    Test for compressing many Manifests concurrently.
+    """
+
+    DIRS = ['a', 'a/sub', 'b', 'c', 'c/sub']
+    FILES = dict([
+        ('Manifest', u''),
+        ('test', u'test string'),
+    ] + [(os.path.join(d, 'Manifest'), u'') for d in DIRS]
+      + [(os.path.join(d, 'test'), u'test string') for d in DIRS])
+    # make one Manifest larger than a single compression chunk
+    FILES['b/Manifest'] = u''.join(
+            u'DATA old-{} 0 MD5 d41d8cd98f00b204e9800998ecf8427e\n'.format(i)
+            for i in range(3000))
+    FILES.update((u'b/old-{}'.format(i), u'') for i in range(3000))
+
+    def test_save_manifests(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'),
+            hashes=['MD5'], compress_level=1)
+        m.update_entries_for_directory('')
+        m.save_manifests(compress_watermark=0, jobs=4)
+        for d in [''] + self.DIRS:
+            self.assertTrue(os.path.exists(
+                os.path.join(self.dir, d, 'Manifest.gz')))
+            self.assertFalse(os.path.exists(
+                os.path.join(self.dir, d, 'Manifest')))
+        m2 = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest.gz'))
+        m2.assert_directory_verifies('')
+
+    def test_cli(self):
+        self.assertEqual(
+                gemato.cli.main(['gemato', 'update',
+                    '--hashes=MD5', '--compress-watermark=0',
+                    '--compress-level=1', '-j', '4', self.dir]),
+                0)
+        self.assertEqual(
+                gemato.cli.main(['gemato', 'verify', self.dir]),
+                0)
+
+    def test_cli_invalid_level(self):
+        self.assertRaises(SystemExit, gemato.cli.main,
+                ['gemato', 'update', '--hashes=MD5',
+                    '--compress-watermark=0', '--compress-format=bz2',
+                    '--compress-level=0', self.dir])
+        self.assertRaises(SystemExit, gemato.cli.main,
+                ['gemato', 'update', '--hashes=MD5',
+                    '--compress-watermark=0', '--compress-level=10',
+                    self.dir])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, 'Manifest')))
+
+
+class WriteOnceTest(TempDirTestCase):
+    """
+    Test that the Manifests are written exactly once when their
+    compression changes.
+    """
+
+    DIRS = ['sub']
+    FILES = {
+        'Manifest': u'''
+MANIFEST sub/Manifest 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'sub/Manifest': u'',
+        'sub/test': u'test string',
+    }
+
+    def setUp(self):
+        super(WriteOnceTest, self).setUp()
+        os.chmod(os.path.join(self.dir, 'Manifest'), 0o640)
+        self.written = []
+        self.orig_write = (gemato.recursiveloader.ManifestRecursiveLoader
+                ._write_manifest_data)
+
+        def counting_write(loader, relpath, *args, **kwargs):
+            self.written.append(relpath)
+            return self.orig_write(loader, relpath, *args, **kwargs)
+
+        (gemato.recursiveloader.ManifestRecursiveLoader
+                ._write_manifest_data) = counting_write
+
+    def tearDown(self):
+        (gemato.recursiveloader.ManifestRecursiveLoader
+                ._write_manifest_data) = self.orig_write
+        super(WriteOnceTest, self).tearDown()
+
+    def test_compress(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'),
+            hashes=['MD5'])
+        m.update_entries_for_directory('')
+        m.save_manifests(compress_watermark=0)
+        self.assertListEqual(sorted(self.written),
+                ['Manifest.gz', 'sub/Manifest.gz'])
+        self.assertListEqual(sorted(os.listdir(self.dir)),
+                ['Manifest.gz', 'sub'])
+        self.assertListEqual(sorted(os.listdir(os.path.join(self.dir, 'sub'))),
+                ['Manifest.gz', 'test'])
+        m2 = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest.gz'))
+        m2.assert_directory_verifies('')
+
+    def test_preserve_mode(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'),
+            hashes=['MD5'])
+        m.update_entries_for_directory('')
+        m.save_manifests()
+        self.assertListEqual(sorted(self.written),
+                ['Manifest', 'sub/Manifest'])
+        self.assertEqual(
+                os.stat(os.path.join(self.dir, 'Manifest')).st_mode & 0o777,
+                0o640)
+
+
+class TransactionalSaveTest(TempDirTestCase):
+    """
+    Test that save_manifests() commits all Manifests or none of them.
+    """
+
+    DIRS = ['sub', 'sub/deeper']
+    FILES = {
+        'Manifest': u'''
+MANIFEST sub/Manifest 65 MD5 6af76e314820a44aba2b4bd3e6280c20
+''',
+        'sub/Manifest': u'''
+MANIFEST deeper/Manifest 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'sub/deeper/Manifest': u'',
+        'sub/deeper/test': u'test string',
+    }
+
+    def setUp(self):
+        super(TransactionalSaveTest, self).setUp()
+        self.synced = []
+        self.orig_sync_files = gemato.util.sync_files
+
+        def recording_sync_files(paths, pool=None):
+            paths = list(paths)
+            self.synced.append(paths)
+            # nothing must be committed before the sync
+            for p in paths:
+                self.assertTrue(os.path.basename(p).startswith('.'))
+            return self.orig_sync_files(paths, pool=pool)
+
+        gemato.util.sync_files = recording_sync_files
+
+    def tearDown(self):
+        gemato.util.sync_files = self.orig_sync_files
+        super(TransactionalSaveTest, self).tearDown()
+
+    def list_files(self):
+        return sorted(os.path.join(os.path.relpath(d, self.dir), f)
+                      for d, dirs, files in os.walk(self.dir)
+                      for f in files)
+
+    def test_save_manifests(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'),
+            hashes=['MD5'])
+        m.update_entries_for_directory('')
+        m.save_manifests()
+        self.assertEqual(len(self.synced), 1)
+        self.assertEqual(len(self.synced[0]), 3)
+        self.assertListEqual(self.list_files(),
+                ['./Manifest', 'sub/Manifest', 'sub/deeper/Manifest',
+                 'sub/deeper/test'])
+        m2 = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        m2.assert_directory_verifies('')
+
+    def test_no_sync(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'),
+            hashes=['MD5'])
+        m.update_entries_for_directory('')
+        m.save_manifests(sync=False)
+        self.assertListEqual(self.synced, [])
+
+    def test_failure(self):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'),
+            hashes=['MD5'])
+        m.update_entries_for_directory('')
+        cls = gemato.recursiveloader.ManifestRecursiveLoader
+        orig_serialize = cls._serialize_manifest
+
+        def failing_serialize(loader, relpath, sort=False):
+            if relpath == 'Manifest':
+                raise RuntimeError('test')
+            return orig_serialize(loader, relpath, sort=sort)
+
+        cls._serialize_manifest = failing_serialize
+        try:
+            self.assertRaises(RuntimeError, m.save_manifests)
+        finally:
+            cls._serialize_manifest = orig_serialize
+        # the original files must be left intact
+        self.assertListEqual(self.list_files(),
+                ['./Manifest', 'sub/Manifest', 'sub/deeper/Manifest',
+                 'sub/deeper/test'])
+        for f, data in self.FILES.items():
+            with io.open(os.path.join(self.dir, f), 'r',
+                    encoding='utf8') as fd:
+                self.assertEqual(fd.read(), data)
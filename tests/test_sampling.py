@@ -0,0 +1,99 @@
+# gemato: Sampling verification tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import os.path
+
+import gemato.cli
+import gemato.recursiveloader
+import gemato.sampling
+import gemato.verify
+
+from tests.testutil import TempDirTestCase
+
+
+class SamplingTest(TempDirTestCase):
+    DIRS = ['sub']
+    FILES = {
+        'Manifest': u'''
+MANIFEST sub/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+DATA a 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA b 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA c 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA d 11 MD5 6f8db599de986fab7a21625b7916589c
+IGNORE e
+''',
+        'sub/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'a': u'test string',
+        'b': u'test string',
+        'c': u'test string',
+        'd': u'test string',
+        'e': u'',
+        'sub/test': u'test string',
+    }
+
+    def verify(self, rate, seed=0):
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        sampler = gemato.sampling.VerificationSampler(rate, seed=seed)
+        failures = []
+
+        def fail_handler(e):
+            failures.append((e.path, e.diff[0][0]))
+            return False
+
+        ret = m.assert_directory_verifies(sampler=sampler,
+                fail_handler=fail_handler)
+        return ret, failures, sampler
+
+    def test_stratified(self):
+        ret, failures, sampler = self.verify(0.25)
+        self.assertEqual((ret, failures), (True, []))
+        # sub/Manifest, sub/test and one file from top-level Manifest
+        self.assertEqual(sampler.files_hashed, 3)
+        self.assertEqual(sampler.files_total, 6)
+        self.assertTrue(sampler.should_hash('sub/Manifest'))
+        self.assertTrue(sampler.should_hash('sub/test'))
+        self.assertEqual(len([x for x in 'abcd'
+            if sampler.should_hash(x)]), 1)
+        self.assertEqual(sampler.bytes_hashed, 73)
+        self.assertEqual(sampler.bytes_total, 106)
+
+    def test_full(self):
+        ret, failures, sampler = self.verify(1)
+        self.assertEqual(sampler.files_hashed, sampler.files_total)
+        self.assertEqual(sampler.coverage, 1.0)
+
+    def test_size_always_verified(self):
+        with io.open(os.path.join(self.dir, 'c'), 'w',
+                encoding='utf8') as f:
+            f.write(u'test strings')
+        ret, failures, sampler = self.verify(0.25)
+        self.assertEqual((ret, failures), (False, [('c', '__size__')]))
+
+    def test_missing_and_stray(self):
+        os.unlink(os.path.join(self.dir, 'a'))
+        with io.open(os.path.join(self.dir, 'f'), 'w',
+                encoding='utf8') as f:
+            f.write(u'')
+        ret, failures, sampler = self.verify(0.25)
+        self.assertEqual((ret, sorted(failures)),
+                (False, [('a', '__exists__'), ('f', '__exists__')]))
+
+    def test_sampled_mismatch(self):
+        for x in 'abcd':
+            with io.open(os.path.join(self.dir, x), 'w',
+                    encoding='utf8') as f:
+                f.write(u'TEST STRING')
+        ret, failures, sampler = self.verify(0.5)
+        self.assertFalse(ret)
+        self.assertEqual(len(failures), 2)
+        self.assertTrue(all(sampler.should_hash(p) for p, k in failures))
+
+    def test_cli(self):
+        self.assertEqual(gemato.cli.main(['gemato', 'verify',
+            '--sample', '0.5', self.dir]), 0)
@@ -0,0 +1,234 @@
+# gemato: Verification daemon tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import os
+import os.path
+import threading
+import time
+import unittest
+
+import gemato.cli
+import gemato.exceptions
+import gemato.inotify
+import gemato.serve
+import gemato.verify
+
+from tests.testutil import TempDirTestCase
+
+
+class ServeTestCase(TempDirTestCase):
+    DIRS = ['sub']
+    FILES = {
+        'Manifest': u'''
+MANIFEST sub/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'test': u'test string',
+        'sub/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'sub/test': u'test string',
+    }
+
+    def write(self, path, data):
+        with io.open(os.path.join(self.dir, path), 'w',
+                encoding='utf8') as f:
+            f.write(data)
+
+
+class TreeMonitorTest(ServeTestCase):
+    def setUp(self):
+        super(TreeMonitorTest, self).setUp()
+        self.monitor = gemato.serve.TreeMonitor(
+                os.path.join(self.dir, 'Manifest'))
+
+    def test_initial(self):
+        self.assertEqual(self.monitor.query(''), ('PENDING', []))
+        self.assertEqual(self.monitor.query('sub'), ('PENDING', []))
+        self.assertTrue(self.monitor.process_pending())
+        self.assertEqual(self.monitor.query(''), ('OK', []))
+        self.assertEqual(self.monitor.query('sub'), ('OK', []))
+        self.assertFalse(self.monitor.process_pending())
+
+    def test_modified_file(self):
+        self.monitor.process_pending()
+        self.write('sub/test', u'TEST STRING')
+        self.monitor.mark_dirty(['sub/test'])
+        self.assertEqual(self.monitor.query('sub'), ('PENDING', []))
+        self.assertEqual(self.monitor.query('test'), ('OK', []))
+        self.monitor.process_pending()
+        self.assertEqual(self.monitor.query(''), ('FAIL', ['sub/test']))
+        self.assertEqual(self.monitor.query('test'), ('OK', []))
+
+        self.write('sub/test', u'test string')
+        self.monitor.mark_dirty(['sub/test'])
+        self.monitor.process_pending()
+        self.assertEqual(self.monitor.query(''), ('OK', []))
+
+    def test_stray_file(self):
+        self.monitor.process_pending()
+        self.write('sub/stray', u'')
+        self.monitor.mark_dirty(['sub/stray', 'sub/.dotfile'])
+        self.monitor.process_pending()
+        self.assertEqual(self.monitor.query('sub'), ('FAIL', ['sub/stray']))
+
+    def test_removed_directory(self):
+        self.monitor.process_pending()
+        os.unlink(os.path.join(self.dir, 'sub/Manifest'))
+        os.unlink(os.path.join(self.dir, 'sub/test'))
+        os.rmdir(os.path.join(self.dir, 'sub'))
+        self.monitor.mark_dirty(['sub'])
+        self.monitor.process_pending()
+        self.assertEqual(self.monitor.query(''),
+                ('FAIL', ['sub/Manifest', 'sub/test']))
+
+    def test_modified_manifest(self):
+        self.monitor.process_pending()
+        self.write('sub/Manifest', u'''
+DATA test 11 MD5 00000000000000000000000000000000
+''')
+        self.monitor.mark_dirty(['sub/Manifest'])
+        self.monitor.process_pending()
+        self.assertEqual(self.monitor.query(''),
+                ('FAIL', ['sub/Manifest']))
+
+    def test_verify_timeout(self):
+        self.assertEqual(self.monitor.verify('', timeout=0.01),
+                ('PENDING', []))
+
+    def test_unsupported_hash(self):
+        def verify_path(*args, **kwargs):
+            raise gemato.exceptions.UnsupportedHash('whirlpool')
+
+        orig = gemato.verify.verify_path
+        gemato.verify.verify_path = verify_path
+        try:
+            self.monitor.process_pending()
+        finally:
+            gemato.verify.verify_path = orig
+        self.assertEqual(self.monitor.query(''), ('FAIL', ['']))
+
+    def test_worker_crash(self):
+        def crash(self):
+            raise RuntimeError('crash')
+
+        orig = gemato.serve.TreeMonitor.process_pending
+        gemato.serve.TreeMonitor.process_pending = crash
+        try:
+            t = threading.Thread(target=self.monitor.run,
+                    kwargs={'settle_time': 0})
+            t.start()
+            # must return rather than waiting forever
+            self.assertEqual(self.monitor.verify(''), ('PENDING', []))
+            t.join()
+        finally:
+            gemato.serve.TreeMonitor.process_pending = orig
+
+
+class InotifyWatcherTest(ServeTestCase):
+    def setUp(self):
+        super(InotifyWatcherTest, self).setUp()
+        try:
+            self.watcher = gemato.inotify.InotifyWatcher(self.dir)
+        except OSError:
+            raise unittest.SkipTest('inotify not supported')
+
+    def tearDown(self):
+        self.watcher.close()
+        super(InotifyWatcherTest, self).tearDown()
+
+    def test_no_events(self):
+        self.assertListEqual(self.watcher.read_events(), [])
+
+    def test_modified_file(self):
+        self.write('sub/test', u'TEST STRING')
+        self.assertIn('sub/test', self.watcher.read_events())
+
+    def test_dotfile(self):
+        self.write('.test', u'')
+        self.assertListEqual(self.watcher.read_events(), [])
+
+    def test_new_directory(self):
+        os.mkdir(os.path.join(self.dir, 'new'))
+        self.assertIn('new', self.watcher.read_events())
+        self.write('new/test', u'')
+        self.assertIn('new/test', self.watcher.read_events())
+
+    def test_removed_file(self):
+        os.unlink(os.path.join(self.dir, 'sub/test'))
+        self.assertIn('sub/test', self.watcher.read_events())
+
+
+class VerificationServerTest(ServeTestCase):
+    def setUp(self):
+        super(VerificationServerTest, self).setUp()
+        self.socket_path = os.path.join(self.dir, '.socket')
+        self.server = gemato.serve.VerificationServer(
+                os.path.join(self.dir, 'Manifest'), self.socket_path)
+        self.errors = []
+        self.thread = threading.Thread(target=self.run_server)
+        self.thread.start()
+        for i in range(100):
+            if os.path.exists(self.socket_path) or self.errors:
+                break
+            time.sleep(0.01)
+
+    def run_server(self):
+        try:
+            self.server.serve_forever()
+        except OSError as e:
+            self.errors.append(e)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        super(VerificationServerTest, self).tearDown()
+
+    def test_query(self):
+        if self.errors:
+            raise unittest.SkipTest('inotify not supported')
+        self.assertEqual(
+            gemato.serve.query(self.socket_path, 'verify', self.dir),
+            ('OK', []))
+        self.write('sub/test', u'TEST STRING')
+        self.assertEqual(
+            gemato.serve.query(self.socket_path, 'verify',
+                os.path.join(self.dir, 'sub')),
+            ('FAIL', ['sub/test']))
+        self.assertEqual(
+            gemato.serve.query(self.socket_path, 'status',
+                os.path.join(self.dir, 'test')),
+            ('OK', []))
+
+    def test_invalid_request(self):
+        if self.errors:
+            raise unittest.SkipTest('inotify not supported')
+        self.assertEqual(
+            gemato.serve.query(self.socket_path, 'verify', '/'),
+            ('ERROR Path outside the tree: /', []))
+
+    def test_cli(self):
+        if self.errors:
+            raise unittest.SkipTest('inotify not supported')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'query', '-S', self.socket_path,
+                self.dir]),
+            0)
+        self.write('test', u'TEST STRING')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'query', '-S', self.socket_path,
+                self.dir]),
+            1)
+
+
+class RemoveSocketTest(ServeTestCase):
+    def test_missing(self):
+        gemato.serve.remove_socket(os.path.join(self.dir, 'nonexistent'))
+
+    def test_regular_file(self):
+        self.assertRaises(OSError, gemato.serve.remove_socket,
+                os.path.join(self.dir, 'test'))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'test')))
@@ -0,0 +1,101 @@
+# gemato: Shared Manifest cache tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import os
+import os.path
+
+import gemato.exceptions
+import gemato.recursiveloader
+import gemato.sharedcache
+
+from tests.testutil import TempDirTestCase
+
+
+class SharedManifestCacheTest(TempDirTestCase):
+    DIRS = ['sub', 'sub/deeper', 'other']
+    FILES = {
+        'Manifest': u'''
+TIMESTAMP 2017-01-01T01:01:01Z
+MANIFEST sub/Manifest 128 MD5 30fd28b98a23031c72793908dd35c530
+MANIFEST other/Manifest 73 MD5 a2c3a8ed94a4a1b7ba0a8a9ecab1b7e0
+DIST topdistfile-1.txt 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+DATA sub/deeper/test 0 SHA1 da39a3ee5e6b4b0d3255bfef95601890afd80709
+IGNORE ignored
+''',
+        'sub/Manifest': u'''
+MANIFEST deeper/Manifest 50 MD5 0f7cd9ed779a4844f98d28315dd9176a
+DIST subdistfile-1.txt 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'sub/deeper/Manifest': u'''
+DATA test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+        'other/Manifest': u'''
+IGNORE ign
+DATA ign/test 0 MD5 d41d8cd98f00b204e9800998ecf8427e
+''',
+    }
+
+    PATHS = ['test', 'sub/test', 'sub/deeper/test', 'sub/Manifest',
+            'sub/deeper/Manifest', 'other/Manifest', 'ignored',
+            'ignored/foo', 'other/ign', 'other/ign/test',
+            'other/ign/foo/bar', 'other/ignx']
+    DISTS = [('topdistfile-1.txt', ''), ('topdistfile-1.txt', 'sub'),
+            ('subdistfile-1.txt', ''), ('subdistfile-1.txt', 'sub'),
+            ('subdistfile-1.txt', 'sub/deeper'),
+            ('subdistfile-1.txt', 'other'), ('nonexistent', 'sub')]
+
+    def setUp(self):
+        super(SharedManifestCacheTest, self).setUp()
+        self.top_path = os.path.join(self.dir, 'Manifest')
+        self.cache_path = os.path.join(self.dir, '.cache')
+        self.loader = gemato.recursiveloader.ManifestRecursiveLoader(
+                self.top_path, verify_openpgp=False)
+        # fix the hashes in the fixture
+        self.loader.loaded_manifests['other/Manifest'] = (
+                self.loader.load_manifest('other/Manifest'))
+        self.loader.update_entry_for_path('other/Manifest')
+        self.loader.save_manifest('Manifest')
+        gemato.sharedcache.SharedManifestCache.publish(self.loader,
+                self.cache_path)
+
+    def assertEntryEqual(self, e1, e2):
+        if e1 is None or e2 is None:
+            self.assertEqual(e1, e2)
+        else:
+            self.assertEqual(e1.to_list(), e2.to_list())
+
+    def test_find_path_entry(self):
+        with gemato.sharedcache.SharedManifestCache(self.cache_path,
+                self.top_path) as c:
+            for p in self.PATHS:
+                self.assertEntryEqual(c.find_path_entry(p),
+                        self.loader.find_path_entry(p))
+
+    def test_find_dist_entry(self):
+        with gemato.sharedcache.SharedManifestCache(self.cache_path,
+                self.top_path) as c:
+            for f, p in self.DISTS:
+                self.assertEntryEqual(c.find_dist_entry(f, p),
+                        self.loader.find_dist_entry(f, p))
+
+    def test_attributes(self):
+        with gemato.sharedcache.SharedManifestCache(self.cache_path) as c:
+            self.assertEqual(c.top_level_manifest_filename, 'Manifest')
+            self.assertFalse(c.openpgp_signed)
+
+    def test_stale(self):
+        with io.open(self.top_path, 'a', encoding='utf8') as f:
+            f.write(u'\n')
+        self.assertRaises(gemato.exceptions.ManifestCacheInvalid,
+                gemato.sharedcache.SharedManifestCache, self.cache_path,
+                self.top_path)
+
+    def test_invalid(self):
+        for data in (b'', b'GEMATOC\0'):
+            with io.open(self.cache_path, 'wb') as f:
+                f.write(data)
+            self.assertRaises(gemato.exceptions.ManifestCacheInvalid,
+                    gemato.sharedcache.SharedManifestCache, self.cache_path)
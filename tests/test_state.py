@@ -0,0 +1,628 @@
+# gemato: Persistent verification state tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import io
+import json
+import os
+import os.path
+import time
+import unittest
+
+import gemato.cli
+import gemato.exceptions
+import gemato.manifest
+import gemato.recursiveloader
+import gemato.state
+import gemato.verify
+
+from tests.testutil import TempDirTestCase
+
+
+class CountingVerifyPath(object):
+    """
+    A wrapper for gemato.verify.verify_path() counting the verified
+    paths.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.orig = gemato.verify.verify_path
+
+    def __call__(self, path, *args, **kwargs):
+        self.paths.append(path)
+        return self.orig(path, *args, **kwargs)
+
+    def __enter__(self):
+        gemato.verify.verify_path = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_cb):
+        gemato.verify.verify_path = self.orig
+
+
+class StateTestCase(TempDirTestCase):
+    def setUp(self):
+        super(StateTestCase, self).setUp()
+        # files in the test are created just before verifying
+        self.racy_window = gemato.state.RACY_WINDOW_NS
+        gemato.state.RACY_WINDOW_NS = 0
+        self.state_path = os.path.join(self.dir, '.state')
+
+    def tearDown(self):
+        gemato.state.RACY_WINDOW_NS = self.racy_window
+        super(StateTestCase, self).tearDown()
+
+    def verify(self, path='', preload=True, **kwargs):
+        state = gemato.state.VerificationState(self.state_path)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        # load Manifests first to count only the verified files
+        if preload:
+            m.load_manifests_for_path(path, recursive=True)
+        try:
+            with CountingVerifyPath() as c:
+                ret = m.assert_directory_verifies(path, state=state,
+                        **kwargs)
+        finally:
+            state.save()
+        return ret, sorted(os.path.relpath(p, self.dir) for p in c.paths)
+
+
+class VerificationStateTest(StateTestCase):
+    DIRS = ['sub']
+    FILES = {
+        'Manifest': u'''
+MANIFEST sub/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'test': u'test string',
+        'sub/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'sub/test': u'test string',
+    }
+
+    def test_first_run(self):
+        self.assertEqual(self.verify(),
+                (True, ['sub/Manifest', 'sub/test', 'test']))
+
+    def test_second_run(self):
+        self.verify()
+        self.assertEqual(self.verify(), (True, []))
+
+    def test_modified_file(self):
+        self.verify()
+        path = os.path.join(self.dir, 'sub/test')
+        st = os.stat(path)
+        with io.open(path, 'w', encoding='utf8') as f:
+            f.write(u'TEST STRING')
+        os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify)
+
+    def test_failed_file_not_recorded(self):
+        with io.open(os.path.join(self.dir, 'test'), 'w',
+                encoding='utf8') as f:
+            f.write(u'TEST STRING')
+        self.assertFalse(self.verify(fail_handler=lambda e: False)[0])
+        self.assertEqual(self.verify(fail_handler=lambda e: False),
+                (False, ['test']))
+
+    def test_stray_file(self):
+        self.verify()
+        with io.open(os.path.join(self.dir, 'sub/stray'), 'w',
+                encoding='utf8') as f:
+            f.write(u'')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify)
+
+    def test_modified_manifest(self):
+        self.verify()
+        with io.open(os.path.join(self.dir, 'sub/Manifest'), 'a',
+                encoding='utf8') as f:
+            f.write(u'DATA other 0 MD5 d41d8cd98f00b204e9800998ecf8427e\n')
+        with io.open(os.path.join(self.dir, 'sub/other'), 'w',
+                encoding='utf8') as f:
+            f.write(u'')
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'), verify_openpgp=False)
+        m.loaded_manifests['sub/Manifest'] = gemato.manifest.ManifestFile()
+        m.update_entry_for_path('sub/Manifest', hashes=['MD5'])
+        m.save_manifest('Manifest')
+
+        # the top-level Manifest has changed too
+        self.assertEqual(self.verify(),
+                (True, ['sub/Manifest', 'sub/other', 'sub/test', 'test']))
+
+    def test_modified_top_manifest(self):
+        self.verify()
+        with io.open(os.path.join(self.dir, 'Manifest'), 'a',
+                encoding='utf8') as f:
+            f.write(u'\n')
+        self.assertEqual(self.verify(),
+                (True, ['test']))
+
+    def test_subdirectory(self):
+        self.assertEqual(self.verify('sub'),
+                (True, ['sub/Manifest', 'sub/test']))
+        self.assertEqual(self.verify(),
+                (True, ['test']))
+        self.assertEqual(self.verify('sub'), (True, []))
+
+    def test_unreliable_filesystem(self):
+        self.verify()
+        state = gemato.state.VerificationState(self.state_path)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        state.begin(m)
+        state.reliable = False
+        self.assertFalse(state.is_verified('test',
+            state.get_identity(os.path.join(self.dir, 'test'))))
+
+    def test_corrupted_state(self):
+        with io.open(self.state_path, 'w', encoding='utf8') as f:
+            f.write(u'{garbage')
+        self.assertEqual(self.verify(),
+                (True, ['sub/Manifest', 'sub/test', 'test']))
+
+    def test_cli(self):
+        for i in range(2):
+            self.assertEqual(
+                gemato.cli.main(['gemato', 'verify',
+                    '--state-file', self.state_path, self.dir]),
+                0)
+        self.assertTrue(os.path.exists(self.state_path))
+
+
+class MultipleSubManifestStateTest(StateTestCase):
+    DIRS = ['a', 'b']
+    FILES = {
+        'Manifest': u'''
+MANIFEST a/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+MANIFEST b/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+''',
+        'a/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'a/test': u'test string',
+        'b/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'b/test': u'test string',
+    }
+
+    def test_modified_sibling_manifest(self):
+        self.verify()
+        with io.open(os.path.join(self.dir, 'b/Manifest'), 'a',
+                encoding='utf8') as f:
+            f.write(u'DATA other 0 MD5 d41d8cd98f00b204e9800998ecf8427e\n')
+        with io.open(os.path.join(self.dir, 'b/other'), 'w',
+                encoding='utf8') as f:
+            f.write(u'')
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'), verify_openpgp=False)
+        m.loaded_manifests['b/Manifest'] = gemato.manifest.ManifestFile()
+        m.update_entry_for_path('b/Manifest', hashes=['MD5'])
+        m.save_manifest('Manifest')
+
+        self.assertEqual(self.verify(),
+                (True, ['b/Manifest', 'b/other', 'b/test']))
+
+    def test_parent_entry_for_file(self):
+        self.verify()
+        with io.open(os.path.join(self.dir, 'Manifest'), 'a',
+                encoding='utf8') as f:
+            f.write(u'DATA a/test 11 SHA1 0000000000000000000000000000000000000000\n')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify)
+
+
+class SubtreeSkipStateTest(StateTestCase):
+    DIRS = ['a', 'a/sub', 'b']
+    FILES = {
+        'Manifest': u'''
+MANIFEST a/Manifest 105 MD5 fcc50dac7546bceb8ed3f2fc5c339b9d
+MANIFEST b/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+''',
+        'a/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA sub/test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'a/test': u'test string',
+        'a/sub/test': u'test string',
+        'b/Manifest': u'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'b/test': u'test string',
+    }
+
+    def test_second_run(self):
+        self.assertEqual(self.verify(preload=False),
+                (True, ['a/Manifest', 'a/Manifest', 'a/sub/test', 'a/test',
+                    'b/Manifest', 'b/Manifest', 'b/test']))
+        self.assertEqual(self.verify(preload=False), (True, []))
+        state = gemato.state.VerificationState(self.state_path)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        state.begin(m)
+        m.get_file_entry_dict(skip_manifest=state.skip_manifest)
+        self.assertListEqual(list(m.loaded_manifests), ['Manifest'])
+
+    def test_stray_file(self):
+        self.verify(preload=False)
+        with io.open(os.path.join(self.dir, 'a/sub/stray'), 'w',
+                encoding='utf8') as f:
+            f.write(u'')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify, preload=False)
+
+    def test_removed_file(self):
+        self.verify(preload=False)
+        os.unlink(os.path.join(self.dir, 'a/sub/test'))
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify, preload=False)
+
+    def test_modified_file(self):
+        self.verify(preload=False)
+        with io.open(os.path.join(self.dir, 'b/test'), 'w',
+                encoding='utf8') as f:
+            f.write(u'TEST STRING')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify, preload=False)
+
+    def test_failure_not_pruned(self):
+        with io.open(os.path.join(self.dir, 'b/test'), 'w',
+                encoding='utf8') as f:
+            f.write(u'TEST STRING')
+        self.assertFalse(self.verify(preload=False,
+            fail_handler=lambda e: False)[0])
+        self.assertEqual(self.verify(preload=False,
+            fail_handler=lambda e: False),
+                (False, ['b/Manifest', 'b/test']))
+
+    def test_failure_in_subdirectory(self):
+        self.verify(preload=False)
+        with io.open(os.path.join(self.dir, 'a/sub/test'), 'w',
+                encoding='utf8') as f:
+            f.write(u'TEST STRING')
+        self.assertFalse(self.verify('a/sub', fail_handler=lambda e: False)[0])
+        # 'a' must not be skipped anymore
+        self.assertEqual(self.verify(preload=False,
+            fail_handler=lambda e: False),
+                (False, ['a/Manifest', 'a/sub/test']))
+
+    def test_parent_entry(self):
+        self.verify(preload=False)
+        with io.open(os.path.join(self.dir, 'Manifest'), 'a',
+                encoding='utf8') as f:
+            f.write(u'DATA a/sub/test 11 SHA1 0000000000000000000000000000000000000000\n')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify, preload=False)
+
+    def test_subdirectory(self):
+        self.verify(preload=False)
+        self.assertEqual(self.verify('a', preload=False), (True, []))
+        self.assertEqual(self.verify('a/sub', preload=False), (True, []))
+
+
+class StatIdentityTest(TempDirTestCase):
+    FILES = {
+        'test': u'',
+    }
+
+    def test_regular_file(self):
+        st = os.stat(os.path.join(self.dir, 'test'))
+        ident = gemato.state.get_stat_identity(st)
+        self.assertEqual(ident[:3], (st.st_dev, st.st_ino, 0))
+
+    def test_directory(self):
+        st = os.stat(self.dir)
+        ident = gemato.state.get_stat_identity(st)
+        self.assertEqual(ident[:2], (st.st_dev, st.st_ino))
+
+    def test_directory_modified(self):
+        ident = gemato.state.get_stat_identity(os.stat(self.dir))
+        os.rename(os.path.join(self.dir, 'test'),
+                os.path.join(self.dir, 'test2'))
+        st = os.stat(self.dir)
+        # force different mtime in case of coarse timestamps
+        os.utime(self.dir, (st.st_atime, st.st_mtime + 1))
+        self.assertNotEqual(
+            gemato.state.get_stat_identity(os.stat(self.dir)), ident)
+
+
+class FilesystemReliabilityTest(unittest.TestCase):
+    def check(self, fstype):
+        orig = gemato.state.get_filesystem_type
+        gemato.state.get_filesystem_type = lambda path: fstype
+        try:
+            return gemato.state.is_filesystem_reliable('/')
+        finally:
+            gemato.state.get_filesystem_type = orig
+
+    def test_reliable(self):
+        self.assertTrue(self.check('ext4'))
+
+    def test_unreliable(self):
+        self.assertFalse(self.check('vfat'))
+
+    def test_fuse_subtype(self):
+        self.assertFalse(self.check('fuse.sshfs'))
+
+    def test_unknown(self):
+        self.assertFalse(self.check(None))
+
+
+class SignatureCacheFileTest(TempDirTestCase):
+    def test_save(self):
+        path = os.path.join(self.dir, 'cache')
+        cache = gemato.state.SignatureCache(path, clock=lambda: 1000)
+        cache.record('foo')
+        cache.save()
+        with io.open(path, 'r', encoding='utf8') as f:
+            data = json.load(f)
+        self.assertEqual(data['signatures'], {'foo': 4600})
+        self.assertNotIn('trees', data)
+        cache = gemato.state.SignatureCache(path, clock=lambda: 1000)
+        self.assertTrue(cache.is_verified('foo'))
+
+    def test_mode_preserved(self):
+        path = os.path.join(self.dir, 'cache')
+        with io.open(path, 'wb'):
+            pass
+        os.chmod(path, 0o644)
+        cache = gemato.state.SignatureCache(path)
+        cache.record('foo')
+        cache.save()
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+
+class DirectoryMtimeStateTest(TempDirTestCase):
+    DIRS = ['a', 'a/sub', 'b']
+    FILES = {
+        'Manifest': u'',
+        'a/test': u'',
+        'a/sub/test': u'',
+        'b/test': u'',
+    }
+
+    def setUp(self):
+        super(DirectoryMtimeStateTest, self).setUp()
+        self.state_path = os.path.join(self.dir, '.state')
+        self.update()
+        # pretend everything was last changed long ago
+        self.old_mtime = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk(self.dir):
+            for f in dirnames + filenames:
+                os.utime(os.path.join(dirpath, f),
+                        (self.old_mtime, self.old_mtime))
+
+    def update(self, last_mtime=None):
+        state = gemato.state.DirectoryMtimeState(self.state_path)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'), hashes=['MD5'])
+        m.update_entries_for_directory('', last_mtime=last_mtime,
+                dir_state=state)
+        m.save_manifests()
+        state.save()
+        return m
+
+    def write(self, path, data=u'test string'):
+        with io.open(os.path.join(self.dir, path), 'w',
+                encoding='utf8') as f:
+            f.write(data)
+
+    def test_state(self):
+        state = gemato.state.DirectoryMtimeState(self.state_path)
+        self.assertEqual(
+            sorted(state.trees[os.path.realpath(self.dir)]['dirs']),
+            ['', 'a', 'a/sub', 'b'])
+
+    def test_unchanged_subtree_skipped(self):
+        # in-place modification does not change directory mtime
+        self.write('a/sub/test')
+        m = self.update(last_mtime=self.old_mtime + 50)
+        self.assertEqual(m.find_path_entry('a/sub/test').checksums['MD5'],
+                'd41d8cd98f00b204e9800998ecf8427e')
+
+    def test_without_last_mtime(self):
+        self.write('a/sub/test')
+        m = self.update()
+        self.assertEqual(m.find_path_entry('a/sub/test').checksums['MD5'],
+                '6f8db599de986fab7a21625b7916589c')
+
+    def test_new_file(self):
+        self.write('a/sub/new')
+        m = self.update(last_mtime=self.old_mtime + 50)
+        self.assertIsNotNone(m.find_path_entry('a/sub/new'))
+        self.assertIsNotNone(m.find_path_entry('b/test'))
+        m.assert_directory_verifies()
+
+    def test_removed_directory(self):
+        os.unlink(os.path.join(self.dir, 'a/sub/test'))
+        os.rmdir(os.path.join(self.dir, 'a/sub'))
+        m = self.update(last_mtime=self.old_mtime + 50)
+        self.assertIsNone(m.find_path_entry('a/sub/test'))
+        m.assert_directory_verifies()
+        state = gemato.state.DirectoryMtimeState(self.state_path)
+        self.assertEqual(
+            sorted(state.trees[os.path.realpath(self.dir)]['dirs']),
+            ['', 'a', 'b'])
+
+    def test_new_subdirectory(self):
+        os.mkdir(os.path.join(self.dir, 'a/sub/new'))
+        self.write('a/sub/new/test')
+        m = self.update(last_mtime=self.old_mtime + 50)
+        self.assertIsNotNone(m.find_path_entry('a/sub/new/test'))
+        m.assert_directory_verifies()
+
+    def test_cli(self):
+        self.write('b/new')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'update', '--hashes=MD5',
+                '--timestamp', '--dir-state', self.state_path, self.dir]),
+            0)
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'update', '--hashes=MD5',
+                '--incremental', '--dir-state', self.state_path,
+                self.dir]),
+            0)
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', self.dir]),
+            0)
+
+
+class DistfilesStateTest(StateTestCase):
+    DIRS = ['distfiles']
+    FILES = {
+        'Manifest': u'''
+DIST a-1.txt 11 MD5 6f8db599de986fab7a21625b7916589c
+DIST b-1.txt 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'distfiles/a-1.txt': u'test string',
+        'distfiles/b-1.txt': u'test string',
+    }
+
+    def verify_distfiles(self, **kwargs):
+        state = gemato.state.VerificationState(self.state_path)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        try:
+            with CountingVerifyPath() as c:
+                ret = m.verify_distfiles(
+                        os.path.join(self.dir, 'distfiles'), jobs=1,
+                        state=state, **kwargs)
+        finally:
+            state.save()
+        return ret, sorted(os.path.relpath(p, self.dir) for p in c.paths)
+
+    def test_second_run(self):
+        self.assertEqual(self.verify_distfiles(),
+                (True, ['distfiles/a-1.txt', 'distfiles/b-1.txt']))
+        self.assertEqual(self.verify_distfiles(), (True, []))
+
+    def test_modified_file(self):
+        self.verify_distfiles()
+        with io.open(os.path.join(self.dir, 'distfiles/a-1.txt'), 'w',
+                encoding='utf8') as f:
+            f.write(u'TEST STRING')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify_distfiles)
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify_distfiles)
+
+    def test_modified_entry(self):
+        self.verify_distfiles()
+        with io.open(os.path.join(self.dir, 'Manifest'), 'w',
+                encoding='utf8') as f:
+            f.write(u'''
+DIST a-1.txt 11 MD5 6f8db599de986fab7a21625b7916589c
+DIST b-1.txt 11 SHA1 661295c9cbf9d6b2f6428414504a8deed3020641
+''')
+        self.assertEqual(self.verify_distfiles(),
+                (True, ['distfiles/b-1.txt']))
+
+
+class CheckpointTest(TempDirTestCase):
+    DIRS = ['sub', 'sub/deep', 'tub']
+    FILES = {
+        'Manifest': u'''
+DATA a 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA z 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA sub/b 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA sub/c 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA sub/missing 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA sub/deep/d 11 MD5 6f8db599de986fab7a21625b7916589c
+DATA tub/e 11 MD5 6f8db599de986fab7a21625b7916589c
+''',
+        'a': u'test string',
+        'z': u'test string',
+        'sub/b': u'test string',
+        'sub/c': u'TEST STRING',
+        'sub/deep/d': u'test string',
+        'tub/e': u'test string',
+    }
+
+    def setUp(self):
+        super(CheckpointTest, self).setUp()
+        self.checkpoint_path = os.path.join(self.dir, '.checkpoint')
+
+    def verify(self, **kwargs):
+        checkpoint = gemato.state.VerificationCheckpoint(
+                self.checkpoint_path, **kwargs)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+            os.path.join(self.dir, 'Manifest'))
+        m.load_manifests_for_path('', recursive=True)
+        failures = []
+
+        def fail_handler(e):
+            failures.append(e.path)
+            return False
+
+        try:
+            with CountingVerifyPath() as c:
+                ret = m.assert_directory_verifies(checkpoint=checkpoint,
+                        fail_handler=fail_handler)
+        finally:
+            checkpoint.save()
+        return (checkpoint.complete, ret, failures,
+                [os.path.relpath(p, self.dir) for p in c.paths])
+
+    def test_no_budget(self):
+        self.assertEqual(self.verify(),
+                (True, False, ['sub/c', 'sub/missing'],
+                 ['a', 'z', 'sub/b', 'sub/c', 'sub/deep/d', 'tub/e',
+                  'sub/missing']))
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_byte_budget(self):
+        self.assertEqual(self.verify(byte_budget=1),
+                (False, True, [], ['a']))
+        self.assertTrue(os.path.exists(self.checkpoint_path))
+        self.assertEqual(self.verify(byte_budget=20),
+                (False, True, [], ['z', 'sub/b']))
+        self.assertEqual(self.verify(byte_budget=1),
+                (False, False, ['sub/c'], ['sub/c']))
+        self.assertEqual(self.verify(byte_budget=1),
+                (False, False, [], ['sub/deep/d']))
+        # the missing file is checked in the final run
+        self.assertEqual(self.verify(byte_budget=1),
+                (True, False, ['sub/missing'], ['tub/e', 'sub/missing']))
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_time_budget(self):
+        times = iter(range(100))
+        self.assertEqual(self.verify(time_budget=2,
+                clock=lambda: next(times)),
+            (False, True, [], ['a', 'z']))
+        self.assertEqual(self.verify()[3],
+                ['sub/b', 'sub/c', 'sub/deep/d', 'tub/e', 'sub/missing'])
+
+    def test_failures_recorded(self):
+        self.verify(byte_budget=50)
+        checkpoint = gemato.state.VerificationCheckpoint(
+                self.checkpoint_path)
+        tree = list(checkpoint.trees.values())[0]
+        self.assertEqual(tree['failures'], ['sub/c'])
+        self.assertEqual(tree['pending'], ['sub/missing'])
+        self.assertEqual(tree['position'], ['sub/deep', 'd'])
+        self.assertFalse(tree['ret'])
+
+    def test_modified_manifest(self):
+        self.verify(byte_budget=1)
+        with io.open(os.path.join(self.dir, 'Manifest'), 'a',
+                encoding='utf8') as f:
+            f.write(u'IGNORE foo\n')
+        self.assertEqual(self.verify(byte_budget=1)[3], ['a'])
+
+    def test_cli(self):
+        args = ['gemato', 'verify', '-k', '--checkpoint',
+                self.checkpoint_path, '--byte-budget', '20', self.dir]
+        self.assertEqual(gemato.cli.main(args), 0)
+        self.assertTrue(os.path.exists(self.checkpoint_path))
+        self.assertEqual(gemato.cli.main(args), 1)
+        self.assertTrue(os.path.exists(self.checkpoint_path))
+        self.assertEqual(gemato.cli.main(args), 1)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
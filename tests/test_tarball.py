@@ -0,0 +1,400 @@
+# gemato: Tarball support tests
+# vim:fileencoding=utf-8
+# (c) 2017 Michał Górny
+# Licensed under the terms of 2-clause BSD license
+
+import gzip
+import io
+import os.path
+import tarfile
+import unittest
+
+import gemato.cli
+import gemato.exceptions
+import gemato.hash
+import gemato.profile
+import gemato.recursiveloader
+import gemato.tarball
+
+from tests.testutil import TempDirTestCase
+
+
+SUB_MANIFEST = b'''
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+'''
+
+TOP_MANIFEST = b'''
+MANIFEST sub/Manifest 51 MD5 c6db000922f4290c7f0a333102ecda8f
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+IGNORE ignored
+'''
+
+
+def make_tarball(members, mode='w'):
+    """
+    Create a tarball with @members, a list of (name, data) tuples
+    (data of None indicates a directory, and a tuple of (type,
+    linkname) indicates a link). Returns a file object.
+    """
+
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode=mode) as tf:
+        for name, data in members:
+            ti = tarfile.TarInfo(name)
+            if data is None:
+                ti.type = tarfile.DIRTYPE
+                tf.addfile(ti)
+            elif isinstance(data, tuple):
+                ti.type, ti.linkname = data
+                tf.addfile(ti)
+            else:
+                ti.size = len(data)
+                tf.addfile(ti, io.BytesIO(data))
+    f.seek(0)
+    return f
+
+
+class TarballVerificationTest(unittest.TestCase):
+    MEMBERS = [
+        ('snap', None),
+        ('snap/test', b'test string'),
+        ('snap/sub', None),
+        ('snap/sub/test', b'test string'),
+        ('snap/sub/Manifest', SUB_MANIFEST),
+        ('snap/Manifest', TOP_MANIFEST),
+        ('snap/ignored', None),
+        ('snap/ignored/foo', b'foo'),
+        ('snap/.git', None),
+        ('snap/.git/foo', b'foo'),
+    ]
+
+    def verify(self, members, **kwargs):
+        failures = []
+
+        def fail_handler(e):
+            failures.append((e.path, e.diff[0][0]))
+            return False
+
+        m = gemato.tarball.TarballManifestLoader(make_tarball(members),
+                **kwargs)
+        ret = m.assert_directory_verifies(fail_handler=fail_handler)
+        return ret, failures
+
+    def test_good(self):
+        self.assertEqual(self.verify(self.MEMBERS), (True, []))
+
+    def test_compressed(self):
+        m = gemato.tarball.TarballManifestLoader(
+                make_tarball(self.MEMBERS, mode='w:gz'))
+        self.assertTrue(m.assert_directory_verifies())
+        self.assertEqual(m.root_directory, 'snap')
+
+    def test_no_prefix(self):
+        self.assertEqual(self.verify(
+            [(n[5:], d) for n, d in self.MEMBERS if n != 'snap']),
+            (True, []))
+
+    def test_explicit_top_manifest(self):
+        self.assertEqual(self.verify(self.MEMBERS,
+            top_manifest_path='./snap/Manifest'), (True, []))
+
+    def test_explicit_hashes(self):
+        self.assertEqual(self.verify(self.MEMBERS, hashes=['MD5']),
+                (True, []))
+
+    def test_stray_file(self):
+        self.assertEqual(self.verify(self.MEMBERS
+            + [('snap/sub/stray', b'')]),
+            (False, [('sub/stray', '__exists__')]))
+
+    def test_missing_file(self):
+        self.assertEqual(self.verify(
+            [x for x in self.MEMBERS if x[0] != 'snap/test']),
+            (False, [('test', '__exists__')]))
+
+    def test_mismatched_file(self):
+        self.assertEqual(self.verify(
+            [(n, b'TEST STRING' if n == 'snap/sub/test' else d)
+             for n, d in self.MEMBERS]),
+            (False, [('sub/test', 'MD5')]))
+
+    def test_directory_in_place_of_file(self):
+        self.assertEqual(self.verify(
+            [(n, None if n == 'snap/test' else d)
+             for n, d in self.MEMBERS]),
+            (False, [('test', '__type__')]))
+
+    def test_mismatched_sub_manifest(self):
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify,
+                [(n, SUB_MANIFEST + b'\n' if n == 'snap/sub/Manifest' else d)
+                 for n, d in self.MEMBERS])
+
+    def test_no_manifest(self):
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                self.verify,
+                [x for x in self.MEMBERS
+                 if os.path.basename(x[0]) != 'Manifest'])
+
+    def test_ambiguous_top_manifest(self):
+        self.assertRaises(ValueError,
+                self.verify,
+                self.MEMBERS + [('other/Manifest', b'')])
+
+    def test_hard_link(self):
+        self.assertEqual(self.verify(
+            [(n, (tarfile.LNKTYPE, 'snap/test')
+              if n == 'snap/sub/test' else d)
+             for n, d in self.MEMBERS]),
+            (True, []))
+
+    def test_symlink(self):
+        self.assertRaises(gemato.exceptions.UnsupportedTarballMember,
+                self.verify,
+                [(n, (tarfile.SYMTYPE, '../test')
+                  if n == 'snap/sub/test' else d)
+                 for n, d in self.MEMBERS])
+
+    def test_stray_symlink(self):
+        self.assertEqual(self.verify(self.MEMBERS
+            + [('snap/sub/link', (tarfile.SYMTYPE, 'test'))]),
+            (False, [('sub/link', '__exists__')]))
+
+    def test_ignored_symlink(self):
+        self.assertEqual(self.verify(self.MEMBERS
+            + [('snap/ignored/link', (tarfile.SYMTYPE, 'foo'))]),
+            (True, []))
+
+    def test_state_released(self):
+        m = gemato.tarball.TarballManifestLoader(
+                make_tarball(self.MEMBERS))
+        self.assertEqual(m.pending, {})
+        self.assertEqual(m.manifest_data, {})
+        self.assertEqual(m.failures, [])
+
+
+class NewHashInSubManifestTarballTest(unittest.TestCase):
+    """
+    Test for a sub-Manifest using a hash not used by the Manifests
+    preceding it.
+    """
+
+    def test_new_hash(self):
+        sub = u'''
+DATA test 11 SHA1 661295c9cbf9d6b2f6428414504a8deed3020641
+'''.encode('utf8')
+        top = u'''
+MANIFEST sub/Manifest {} MD5 {}
+DATA test 11 MD5 6f8db599de986fab7a21625b7916589c
+'''.format(len(sub), gemato.hash.hash_bytes(sub, 'md5')).encode('utf8')
+        m = gemato.tarball.TarballManifestLoader(make_tarball([
+            ('snap', None),
+            ('snap/Manifest', top),
+            ('snap/test', b'test string'),
+            ('snap/sub', None),
+            ('snap/sub/test', b'test string'),
+            ('snap/sub/Manifest', sub),
+        ]))
+        self.assertTrue(m.assert_directory_verifies())
+
+
+class CompressedSubManifestTarballTest(unittest.TestCase):
+    def test_compressed_sub_manifest(self):
+        sub_data = io.BytesIO()
+        with gzip.GzipFile(fileobj=sub_data, mode='wb') as f:
+            f.write(SUB_MANIFEST)
+        sub_data = sub_data.getvalue()
+        top = u'''
+MANIFEST sub/Manifest.gz {} MD5 {}
+'''.format(len(sub_data),
+            gemato.hash.hash_bytes(sub_data, 'md5')).encode('utf8')
+        m = gemato.tarball.TarballManifestLoader(make_tarball([
+            ('sub/test', b'test string'),
+            ('sub/Manifest.gz', sub_data),
+            ('Manifest', top),
+        ]))
+        self.assertTrue(m.assert_directory_verifies())
+
+
+class TarballCLITest(TempDirTestCase):
+    def write_tarball(self, members):
+        path = os.path.join(self.dir, 'snap.tar.gz')
+        with io.open(path, 'wb') as f:
+            f.write(make_tarball(members, mode='w:gz').getvalue())
+        return path
+
+    def test_cli(self):
+        path = self.write_tarball(TarballVerificationTest.MEMBERS)
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', '--from-tar', path]),
+            0)
+
+    def test_cli_failure(self):
+        path = self.write_tarball(TarballVerificationTest.MEMBERS
+                + [('snap/stray', b'')])
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', '-k', '--from-tar',
+                path]),
+            1)
+
+    def test_cli_symlink(self):
+        path = self.write_tarball(
+                [(n, (tarfile.SYMTYPE, 'sub/test') if n == 'snap/test' else d)
+                 for n, d in TarballVerificationTest.MEMBERS])
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', '--from-tar', path]),
+            1)
+
+    def test_cli_invalid_tarball(self):
+        path = os.path.join(self.dir, 'snap.tar.gz')
+        with io.open(path, 'wb') as f:
+            f.write(b'not a tarball')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', '--from-tar', path]),
+            1)
+
+
+class TarballCreationTest(TempDirTestCase):
+    MEMBERS = [
+        ('snap', None),
+        ('snap/test', b'test string'),
+        ('snap/cat', None),
+        ('snap/cat/pkg', None),
+        ('snap/cat/pkg/metadata.xml', b''),
+        ('snap/cat/pkg/files', None),
+        ('snap/cat/pkg/files/test.patch', b'test string'),
+        ('snap/cat/pkg/sub', None),
+        ('snap/cat/pkg/sub/test', b'test string'),
+        # Manifest that is not going to be replaced
+        ('snap/cat/pkg/sub/Manifest', SUB_MANIFEST),
+        ('snap/.git', None),
+        ('snap/.git/foo', b'foo'),
+        # stale Manifest to be replaced
+        ('snap/Manifest', b'DATA foo 0 MD5 d41d8cd98f00b204e9800998ecf8427e\n'),
+    ]
+
+    def create(self, members, out=None, **kwargs):
+        outdir = os.path.join(self.dir, 'out')
+        os.mkdir(outdir)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+                os.path.join(outdir, 'Manifest'), allow_create=True,
+                hashes=['MD5'], **kwargs)
+        members = gemato.tarball.TarballMembers(make_tarball(members),
+                hashes=m.hashes, out=out)
+        prefix = members.find_common_prefix()
+        gemato.tarball.update_entries_from_members(m, members, prefix)
+        m.save_manifests()
+        if out is not None:
+            gemato.tarball.add_manifests_to_tarball(m, out, prefix,
+                    members)
+        return m
+
+    def test_default_profile(self):
+        m = self.create(self.MEMBERS)
+        self.assertListEqual(sorted(m.loaded_manifests), ['Manifest'])
+        self.assertEqual(m.find_path_entry('cat/pkg/sub/test').checksums,
+                {'MD5': '6f8db599de986fab7a21625b7916589c'})
+        self.assertIsNone(m.find_path_entry('foo'))
+        self.assertEqual(m.find_path_entry('cat/pkg/sub/Manifest').tag,
+                'DATA')
+        self.assertIsNone(m.find_path_entry('.git/foo'))
+
+    def test_ebuild_profile(self):
+        m = self.create(self.MEMBERS,
+                profile=gemato.profile.BackwardsCompatEbuildRepositoryProfile())
+        self.assertListEqual(sorted(m.loaded_manifests),
+                ['Manifest', 'cat/Manifest', 'cat/pkg/Manifest'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, 'out/cat/pkg/Manifest')))
+        self.assertEqual(m.find_path_entry('cat/pkg/files/test.patch').tag,
+                'AUX')
+        self.assertEqual(m.find_path_entry('cat/pkg/metadata.xml').tag,
+                'MISC')
+        m2 = gemato.recursiveloader.ManifestRecursiveLoader(
+                os.path.join(self.dir, 'out/Manifest'))
+        m2.load_manifests_for_path('', recursive=True)
+        self.assertListEqual(sorted(m2.loaded_manifests),
+                ['Manifest', 'cat/Manifest', 'cat/pkg/Manifest'])
+
+    def test_repack(self):
+        f = io.BytesIO()
+        with tarfile.open(fileobj=f, mode='w|') as out:
+            self.create(self.MEMBERS, out=out,
+                    profile=gemato.profile.EbuildRepositoryProfile())
+        f.seek(0)
+        with tarfile.open(fileobj=f, mode='r') as tf:
+            self.assertListEqual(sorted(tf.getnames()),
+                    ['snap', 'snap/.git', 'snap/.git/foo',
+                     'snap/Manifest', 'snap/cat', 'snap/cat/Manifest',
+                     'snap/cat/pkg', 'snap/cat/pkg/Manifest',
+                     'snap/cat/pkg/files', 'snap/cat/pkg/files/test.patch',
+                     'snap/cat/pkg/metadata.xml', 'snap/cat/pkg/sub',
+                     'snap/cat/pkg/sub/Manifest', 'snap/cat/pkg/sub/test',
+                     'snap/test'])
+        f.seek(0)
+        m = gemato.tarball.TarballManifestLoader(f)
+        self.assertEqual(m.root_directory, 'snap')
+        self.assertTrue(m.assert_directory_verifies())
+        self.assertListEqual(sorted(m.loaded_manifests),
+                ['Manifest', 'cat/Manifest', 'cat/pkg/Manifest'])
+
+    def test_symlink(self):
+        f = io.BytesIO()
+        with tarfile.open(fileobj=f, mode='w') as tf:
+            ti = tarfile.TarInfo('link')
+            ti.type = tarfile.SYMTYPE
+            ti.linkname = 'test'
+            tf.addfile(ti)
+        f.seek(0)
+        outdir = os.path.join(self.dir, 'out')
+        os.mkdir(outdir)
+        m = gemato.recursiveloader.ManifestRecursiveLoader(
+                os.path.join(outdir, 'Manifest'), allow_create=True,
+                hashes=['MD5'])
+        members = gemato.tarball.TarballMembers(f, hashes=m.hashes)
+        self.assertRaises(gemato.exceptions.ManifestInvalidPath,
+                gemato.tarball.update_entries_from_members, m, members)
+
+    def test_cli_output_dir(self):
+        path = os.path.join(self.dir, 'snap.tar')
+        with io.open(path, 'wb') as f:
+            f.write(make_tarball(self.MEMBERS).getvalue())
+        outdir = os.path.join(self.dir, 'out')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'create', '--hashes=MD5',
+                '--profile=ebuild', '--from-tar', path, outdir]),
+            0)
+        self.assertTrue(os.path.exists(
+            os.path.join(outdir, 'cat/pkg/Manifest')))
+
+    def test_cli_output_tar(self):
+        path = os.path.join(self.dir, 'snap.tar')
+        with io.open(path, 'wb') as f:
+            f.write(make_tarball(self.MEMBERS).getvalue())
+        out_path = os.path.join(self.dir, 'new.tar.gz')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'create', '--hashes=MD5',
+                '--timestamp', '--from-tar', path,
+                '--output-tar', out_path]),
+            0)
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'verify', '--from-tar', out_path]),
+            0)
+
+    def test_cli_output_tar_failure(self):
+        path = os.path.join(self.dir, 'snap.tar')
+        with io.open(path, 'wb') as f:
+            f.write(make_tarball(self.MEMBERS
+                + [('snap/link', (tarfile.SYMTYPE, 'test'))]).getvalue())
+        out_path = os.path.join(self.dir, 'new.tar.gz')
+        with io.open(out_path, 'wb') as f:
+            f.write(b'old tarball')
+        self.assertEqual(
+            gemato.cli.main(['gemato', 'create', '--hashes=MD5',
+                '--from-tar', path, '--output-tar', out_path]),
+            1)
+        # the previous file must be left intact, with no leftovers
+        with io.open(out_path, 'rb') as f:
+            self.assertEqual(f.read(), b'old tarball')
+        self.assertListEqual(sorted(os.listdir(self.dir)),
+                ['new.tar.gz', 'snap.tar'])
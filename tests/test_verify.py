@@ -964,3 +964,155 @@ class EntryCompatibilityVerificationTest(unittest.TestCase):
         self.assertEqual(gemato.verify.verify_entry_compatibility(e1, e2),
                 (True, [('MD5', 'd41d8cd98f00b204e9800998ecf8427e', None),
                         ('SHA1', None, 'da39a3ee5e6b4b0d3255bfef95601890afd80709')]))
+
+
+class VerifyingSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.e = gemato.manifest.ManifestEntryDIST.from_list(
+                ('DIST', 'test-1.txt', '11',
+                 'MD5', '6f8db599de986fab7a21625b7916589c',
+                 'SHA1', '661295c9cbf9d6b2f6428414504a8deed3020641'))
+
+    def test_matching(self):
+        s = gemato.verify.VerifyingSink(self.e)
+        s.write(b'test ')
+        s.write(b'string')
+        self.assertEqual(s.close(), (True, []))
+        self.assertEqual(s.result, (True, []))
+        self.assertTrue(s.closed)
+
+    def test_pass_through(self):
+        f = io.BytesIO()
+        with gemato.verify.VerifyingSink(self.e, f) as s:
+            s.write(b'test string')
+        self.assertEqual(s.result, (True, []))
+        self.assertEqual(f.getvalue(), b'test string')
+
+    def test_mismatched_checksums(self):
+        s = gemato.verify.VerifyingSink(self.e)
+        s.write(b'TEST STRING')
+        self.assertEqual(s.close(),
+                (False, [('MD5', '6f8db599de986fab7a21625b7916589c',
+                          '2d7d687432758a8eeeca7b7e5d518e7f'),
+                         ('SHA1', '661295c9cbf9d6b2f6428414504a8deed3020641',
+                          'd39d009c05797a93a79720952e99c7054a24e7c4')]))
+
+    def test_too_short(self):
+        s = gemato.verify.VerifyingSink(self.e)
+        s.write(b'test')
+        ret, diff = s.close()
+        self.assertFalse(ret)
+        self.assertEqual(diff[0], ('__size__', 11, 4))
+
+    def test_oversize(self):
+        f = io.BytesIO()
+        s = gemato.verify.VerifyingSink(self.e, f)
+        s.write(b'test ')
+        self.assertRaises(gemato.exceptions.ManifestMismatch,
+                s.write, b'string!')
+        # the oversize data is not passed through
+        self.assertEqual(f.getvalue(), b'test ')
+        self.assertEqual(s.close(), (False, [('__size__', 11, 12)]))
+        self.assertRaises(ValueError, s.write, b'')
+
+
+class StatOnlyVerificationTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'test string')
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_get_file_metadata(self):
+        st = os.stat(self.path)
+        self.assertEqual(list(gemato.verify.get_file_metadata(
+            self.path, hashes=['MD5'], stat_only=True)),
+            [True, st.st_dev, (stat.S_IFREG, 'regular file'), 11,
+             st.st_mtime])
+
+    def test_get_file_metadata_missing(self):
+        self.assertEqual(list(gemato.verify.get_file_metadata(
+            self.path + '.missing', hashes=['MD5'], stat_only=True)),
+            [False])
+
+    def test_mismatched_checksum(self):
+        e = gemato.manifest.ManifestEntryDATA.from_list(
+                ('DATA', 'test', '11', 'MD5', '2d7d687432758a8eeeca7b7e5d518e7f'))
+        self.assertEqual(gemato.verify.verify_path(self.path, e,
+            stat_only=True), (True, []))
+
+    def test_mismatched_size(self):
+        e = gemato.manifest.ManifestEntryDATA.from_list(
+                ('DATA', 'test', '12', 'MD5', '6f8db599de986fab7a21625b7916589c'))
+        self.assertEqual(gemato.verify.verify_path(self.path, e,
+            stat_only=True), (False, [('__size__', 12, 11)]))
+
+    def test_missing(self):
+        e = gemato.manifest.ManifestEntryDATA.from_list(
+                ('DATA', 'test', '11', 'MD5', '6f8db599de986fab7a21625b7916589c'))
+        self.assertEqual(gemato.verify.verify_path(self.path + '.missing',
+            e, stat_only=True), (False, [('__exists__', True, False)]))
+
+    def test_directory(self):
+        e = gemato.manifest.ManifestEntryDATA.from_list(
+                ('DATA', 'test', '11', 'MD5', '6f8db599de986fab7a21625b7916589c'))
+        self.assertEqual(gemato.verify.verify_path(
+            os.path.dirname(self.path), e, stat_only=True),
+            (False, [('__type__', 'regular file', 'directory')]))
+
+
+class HashPolicyTest(unittest.TestCase):
+    MD5 = '6f8db599de986fab7a21625b7916589c'
+    SHA1 = '661295c9cbf9d6b2f6428414504a8deed3020641'
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'test string')
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_select_allowed(self):
+        p = gemato.verify.HashPolicy(allowed=['SHA1', 'SHA512'])
+        self.assertEqual(p.select(['MD5', 'SHA1']), ('SHA1',))
+        self.assertEqual(p.select(['MD5', 'SHA1', 'SHA512']),
+                ('SHA1', 'SHA512'))
+
+    def test_select_fallback(self):
+        p = gemato.verify.HashPolicy(allowed=['SHA512'])
+        self.assertEqual(p.select(['MD5', 'SHA1']), ('MD5', 'SHA1'))
+
+    def test_select_fastest(self):
+        p = gemato.verify.HashPolicy(fastest=True)
+        self.assertEqual(len(p.select(['MD5', 'SHA1', 'SHA512'])), 1)
+        p = gemato.verify.HashPolicy(allowed=['SHA1', 'SHA512'],
+                fastest=True)
+        self.assertIn(p.select(['MD5', 'SHA1', 'SHA512'])[0],
+                ('SHA1', 'SHA512'))
+
+    def test_select_fastest_unsupported(self):
+        p = gemato.verify.HashPolicy(fastest=True)
+        self.assertEqual(p.select(['MD5', 'UNKNOWN-HASH']), ('MD5',))
+
+    def test_verify_subset(self):
+        # mismatched SHA1 is not verified
+        e = gemato.manifest.ManifestEntryDATA.from_list(
+                ('DATA', 'test', '11', 'MD5', self.MD5,
+                 'SHA1', self.SHA1.replace('6', '7')))
+        p = gemato.verify.HashPolicy(allowed=['MD5'])
+        self.assertEqual(gemato.verify.verify_path(self.path, e,
+            hash_policy=p), (True, []))
+        self.assertEqual(gemato.verify.verify_path(self.path, e)[0],
+            False)
+
+    def test_verify_subset_mismatch(self):
+        e = gemato.manifest.ManifestEntryDATA.from_list(
+                ('DATA', 'test', '11', 'MD5', self.MD5,
+                 'SHA1', self.SHA1.replace('6', '7')))
+        p = gemato.verify.HashPolicy(allowed=['SHA1'])
+        self.assertEqual(gemato.verify.verify_path(self.path, e,
+            hash_policy=p),
+            (False, [('SHA1', self.SHA1.replace('6', '7'), self.SHA1)]))